@@ -1,29 +1,30 @@
-from flask import Flask
-from backend.routes.auth import auth_bp
-from backend.routes.payments import payments_bp
-from backend.routes.game import game_bp
+import os
+import time
+import logging
+from pathlib import Path
+from dotenv import load_dotenv
+from flask import Flask, send_from_directory
 from flask_cors import CORS
 
 # -----------------------------
-# Configurar logging
+# Cargar variables de entorno
 # -----------------------------
-logging.basicConfig(level=logging.DEBUG)
-logger = logging.getLogger(__name__)
+# Antes de importar los blueprints, que leen la configuración al importarse
+load_dotenv()
 
 # -----------------------------
-# Cargar variables de entorno
+# Configurar logging
 # -----------------------------
-load_dotenv()
+# JSON por una cola con hilo de escritura propio; niveles con LOG_LEVEL / LOG_LEVELS
+from backend import logging_setup
+logging_setup.configure()
+logger = logging.getLogger(__name__)
 
-PI_API_KEY = os.getenv('PI_API_KEY')
-if not PI_API_KEY:
-    logger.warning(
-        'PI_API_KEY no encontrada en variables de entorno, '
-        'algunas funciones de Pi Network no estarán disponibles.'
-    )
+# Usado por el after_request de abajo (solo depende de Flask y backend.db)
+from backend import tracing
 
 # -----------------------------
-# Inicializar Flask
+# Rutas del frontend
 # -----------------------------
 # `app.py` está en la raíz de "pi-starter", así que
 # BASE_DIR = directorio donde vive este archivo ("pi-starter/").
@@ -32,92 +33,122 @@ BASE_DIR = Path(__file__).parent
 # Ahora FRONTEND_FOLDER = "pi-starter/frontend"
 FRONTEND_FOLDER = BASE_DIR / 'frontend'
 
-# Configuramos Flask para que use FRONTEND_FOLDER como carpeta estática
-app = Flask(__name__)
-CORS(app)
-# Configuración de variables de entorno, si aplica
-# app.config.from_envvar('APP_CONFIG_FILE')
-# Registro de blueprints existentes\app.register_blueprint(auth_bp)
-app.register_blueprint(payments_bp)
-app.register_blueprint(game_bp)
 
-# -----------------------------
-# Middleware: habilitar CORS y quitar X-Frame-Options
-# -----------------------------
-@app.after_request
 def after_request(response):
+    """
+    Middleware: habilitar CORS y quitar X-Frame-Options
+    """
     # Permitir cualquier origen
     response.headers.add('Access-Control-Allow-Origin', '*')
     # Permitir estos headers en las peticiones
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
+    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,Idempotency-Key,X-Request-ID')
     # Permitir estos métodos
     response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
+    # X-Request-ID y Server-Timing con el desglose de tiempos de la petición
+    tracing.finish(response)
     # Eliminar X-Frame-Options para permitir embed en Pi Browser
     response.headers.pop('X-Frame-Options', None)
+    # Que el frontend pueda leer cuándo reintentar tras un 429/503
+    response.headers.add('Access-Control-Expose-Headers', 'Retry-After,Server-Timing,X-Request-ID')
     return response
 
-# -----------------------------
-# Ruta raíz: servir index.html
-# -----------------------------
-@app.route('/')
-def index():
-    """
-    Sirve el archivo index.html al visitar la raíz (/).
-    """
-    return send_from_directory(FRONTEND_FOLDER, 'index.html')
 
-# -----------------------------
-# Ruta /validation-key: servir validation-key.txt
-# -----------------------------
-@app.route('/validation-key')
-def serve_validation_key_txt():
-    """
-    Sirve el archivo validation-key.txt (texto plano) que vive en frontend/.
-    Responde a GET /validation-key.
-    """
-    return send_from_directory(
-        directory=str(FRONTEND_FOLDER),
-        path='validation-key.txt',
-        mimetype='text/plain'
-    )
+def register_frontend(app, assets):
+    @app.route('/')
+    def index():
+        """
+        Sirve el archivo index.html al visitar la raíz (/).
+        """
+        return assets.serve('index.html') or send_from_directory(FRONTEND_FOLDER, 'index.html')
+
+    @app.route('/validation-key')
+    def serve_validation_key_txt():
+        """
+        Sirve el archivo validation-key.txt (texto plano) que vive en frontend/.
+        Responde a GET /validation-key.
+        """
+        response = assets.serve('validation-key.txt', mimetype='text/plain')
+        if response is None:
+            return "Archivo no encontrado", 404
+        return response
+
+    @app.route('/<path:path>')
+    def serve_frontend(path):
+        """
+        Sirve cualquier recurso estático que exista en frontend/,
+        o en subcarpetas js/, css/, img/ o assets/. Si no existe, devuelve 404.
+        Por ejemplo:
+          - /js/auth.js        → frontend/js/auth.js
+          - /css/style.css     → frontend/css/style.css
+          - /favicon.ico       → frontend/favicon.ico
+        La ruta se resuelve con el índice construido al arrancar (sin tocar el
+        disco), con ETag, 304 y variantes gzip/brotli según Accept-Encoding.
+        """
+        response = assets.serve(path)
+        if response is None:
+            return "Archivo no encontrado", 404
+        return response
+
 
 # -----------------------------
-# Fallback para cualquier otro archivo estático
+# Fábrica de la aplicación
 # -----------------------------
-@app.route('/<path:path>')
-def serve_frontend(path):
+def create_app():
     """
-    Intenta servir cualquier recurso estático que exista en frontend/,
-    o en subcarpetas js/, css/, img/ o assets/. Si no existe, devuelve 404.
-    Por ejemplo:
-      - /js/auth.js        → frontend/js/auth.js
-      - /css/style.css     → frontend/css/style.css
-      - /favicon.ico       → frontend/favicon.ico
+    Crea la app Flask. Solo hace trabajo barato y sin hilos ni conexiones
+    (importar blueprints, indexar estáticos), de modo que gunicorn --preload
+    puede ejecutarla una vez en el maestro y los workers la heredan. El
+    calentamiento de cada worker (leaderboard, conexiones con la API de Pi)
+    lo hace backend/warmup.py; /readyz dice cuándo ha terminado.
     """
-    # 1) Intentar directamente en la carpeta frontend/
-    requested = FRONTEND_FOLDER / path
-    if requested.exists() and requested.is_file():
-        return send_from_directory(str(FRONTEND_FOLDER), path)
+    started = time.perf_counter()
 
-    # 2) Intentar en subcarpetas comunes: js/, css/, img/, assets/
-    for sub in ['js', 'css', 'img', 'assets']:
-        candidate = FRONTEND_FOLDER / sub / path
-        if candidate.exists() and candidate.is_file():
-            return send_from_directory(str(FRONTEND_FOLDER / sub), path)
+    # Los blueprints se importan aquí para que importar app.py no arrastre nada más
+    from backend.routes.game import game_bp, rate_exempt
+    from backend.routes.auth import auth_routes
+    from backend.routes.payments import payment_routes
+    from backend.static_assets import AssetIndex
+    from backend import metrics, warmup, admission
 
-    # 3) Si no se encontró, devolver 404
-    return "Archivo no encontrado", 404
+    if not os.getenv('PI_API_KEY'):
+        logger.warning(
+            'PI_API_KEY no encontrada en variables de entorno, '
+            'algunas funciones de Pi Network no estarán disponibles.'
+        )
+
+    app = Flask(__name__)
+    CORS(app)
+    # Trazas por petición: primero, para que midan también los demás hooks
+    tracing.init_app(app)
+    # Configuración de variables de entorno, si aplica
+    # app.config.from_envvar('APP_CONFIG_FILE')
+    app.register_blueprint(game_bp)
+    app.register_blueprint(auth_routes)
+    app.register_blueprint(payment_routes)
+    # Contadores e histogramas por ruta, expuestos en /metrics
+    metrics.init_app(app)
+    # /healthz, /readyz y calentamiento del worker
+    warmup.init_app(app)
+    # Límites de ritmo por IP y usuario en las rutas que acaban llamando a la API de Pi
+    admission.init_app(
+        app, (game_bp, auth_routes, payment_routes),
+        exempt={f'{game_bp.name}.{name}' for name in rate_exempt}
+    )
+    app.after_request(after_request)
+
+    # Índice de archivos estáticos construido una sola vez al arrancar
+    assets = AssetIndex(FRONTEND_FOLDER)
+    if os.getenv("FLASK_DEBUG", "false").lower() in ("true", "1"):
+        # En desarrollo, recargar el índice cuando cambian los archivos
+        assets.watch()
+    register_frontend(app, assets)
+
+    logger.info('App creada en %.1f ms', (time.perf_counter() - started) * 1000)
+    return app
 
-# -----------------------------
-# Importar y registrar blueprints de rutas del backend
-# -----------------------------
-# Asegúrate de que tus módulos "routes/auth.py" y "routes/payments.py"
-# existan en la carpeta pi-starter/backend/routes/.
-from backend.routes.auth import auth_routes
-from backend.routes.payments import payment_routes
 
-app.register_blueprint(auth_routes)
-app.register_blueprint(payment_routes)
+# `gunicorn app:app`, `uvicorn asgi:app` y `python app.py` usan esta instancia
+app = create_app()
 
 # -----------------------------
 # Punto de entrada cuando se ejecuta directamente
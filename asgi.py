@@ -0,0 +1,226 @@
+import os
+import io
+import sys
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from flask import request_started
+
+from app import app as flask_app
+from backend import pi_client, warmup, admission
+from backend.routes import auth, payments, game
+
+"""
+Modo de servicio ASGI: uvicorn asgi:app
+
+Las rutas de /api y /api/payments que solo esperan a la API de Pi Network
+se ejecutan como corrutinas (pi_client.arequest), así un worker puede tener
+cientos de llamadas en vuelo sin un hilo por cada una. El resto de rutas
+(juego, estáticos, /metrics) se sirven con la app Flask de siempre en un
+pool de hilos, salvo el stream SSE del leaderboard, que espera como
+corrutina para no ocupar un hilo por cliente conectado.
+
+Las dos vías pasan por la misma app: enrutado de Flask, before_request /
+after_request (CORS, métricas) y manejadores de errores, de modo que las
+respuestas son las mismas que con gunicorn.
+
+Requiere httpx y uvicorn (opcionales en el modo WSGI).
+"""
+
+logger = logging.getLogger(__name__)
+
+# Hilos para las rutas que se sirven con la app WSGI
+WSGI_THREADS = int(os.getenv('ASGI_WSGI_THREADS', '32'))
+
+# endpoint de Flask -> vista asíncrona
+ASYNC_VIEWS = {
+    **{f'{auth.auth_routes.name}.{name}': view for name, view in auth.async_views.items()},
+    **{f'{payments.payment_routes.name}.{name}': view for name, view in payments.async_views.items()},
+    **{f'{game.game_bp.name}.{name}': view for name, view in game.async_views.items()},
+}
+
+_executor = ThreadPoolExecutor(max_workers=WSGI_THREADS, thread_name_prefix='asgi-wsgi')
+_DONE = object()
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    return b''.join(chunks)
+
+
+def _environ(scope, body):
+    """
+    Entorno WSGI equivalente a la petición ASGI (con el cuerpo ya leído).
+    """
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for raw_name, raw_value in scope.get('headers', []):
+        name = raw_name.decode('latin-1').upper().replace('-', '_')
+        value = raw_value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+            continue
+        if name == 'CONTENT_LENGTH':
+            continue
+        key = f'HTTP_{name}'
+        if key in environ:
+            value = environ[key] + ('; ' if name == 'COOKIE' else ', ') + value
+        environ[key] = value
+    return environ
+
+
+def _headers(header_list):
+    return [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in header_list]
+
+
+async def _dispatch_async(view):
+    """
+    Lo mismo que Flask.full_dispatch_request(), pero esperando a la vista.
+    Debe llamarse con el contexto de la petición activo.
+    """
+    try:
+        request_started.send(flask_app)
+        rv = flask_app.preprocess_request()
+        if rv is None:
+            # Límite de ritmo sin bloquear el event loop (ver admission.check_deferred)
+            rv = await admission.check_deferred()
+        if rv is None:
+            rv = await view()
+    except Exception as e:
+        rv = flask_app.handle_user_exception(e)
+    return flask_app.finalize_request(rv)
+
+
+async def _serve_async(view, environ, receive, send):
+    environ[admission.ASYNC_ENVIRON_KEY] = True
+    ctx = flask_app.request_context(environ)
+    error = None
+    try:
+        ctx.push()
+        try:
+            response = await _dispatch_async(view)
+        except Exception as e:
+            error = e
+            response = flask_app.handle_exception(e)
+        # Generador asíncrono (SSE): se envía por trozos fuera del contexto
+        chunks = response.response if hasattr(response.response, '__aiter__') else None
+        if chunks is None:
+            body = b''.join(response.iter_encoded())
+            response.close()
+    finally:
+        ctx.pop(error)
+
+    await send({'type': 'http.response.start', 'status': response.status_code,
+                'headers': _headers(response.headers.to_wsgi_list())})
+    if chunks is None:
+        await send({'type': 'http.response.body', 'body': body})
+    else:
+        await _stream_body(chunks, receive, send)
+
+
+async def _stream_body(chunks, receive, send):
+    """
+    Envía un cuerpo asíncrono hasta que se acabe o el cliente se desconecte
+    (enviar a un cliente ya desconectado no siempre da error).
+    """
+    async def pump():
+        async for chunk in chunks:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def disconnected():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    tasks = [asyncio.ensure_future(pump()), asyncio.ensure_future(disconnected())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await chunks.aclose()
+
+
+async def _serve_wsgi(environ, send):
+    loop = asyncio.get_running_loop()
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = headers
+
+    iterable = await loop.run_in_executor(_executor, flask_app.wsgi_app, environ, start_response)
+    try:
+        iterator = iter(iterable)
+        # Las respuestas en streaming llaman a start_response con el primer trozo
+        chunk = await loop.run_in_executor(_executor, next, iterator, _DONE)
+        await send({'type': 'http.response.start', 'status': started['status'],
+                    'headers': _headers(started['headers'])})
+        while chunk is not _DONE:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            chunk = await loop.run_in_executor(_executor, next, iterator, _DONE)
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(iterable, 'close'):
+            await loop.run_in_executor(_executor, iterable.close)
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # Calentamiento del worker en segundo plano; /readyz avisa cuando termina
+            warmup.start()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await pi_client.close_async_client()
+            _executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    environ = _environ(scope, await _read_body(receive))
+    try:
+        endpoint, _ = flask_app.url_map.bind_to_environ(environ).match(method=environ['REQUEST_METHOD'])
+    except Exception:
+        # 404/405/redirecciones: que las resuelva Flask como siempre
+        endpoint = None
+
+    view = ASYNC_VIEWS.get(endpoint)
+    if view is not None:
+        await _serve_async(view, environ, receive, send)
+    else:
+        await _serve_wsgi(environ, send)
@@ -0,0 +1,426 @@
+import os
+import json
+import math
+import time
+import random
+import asyncio
+import hashlib
+import threading
+import logging
+import sqlite3
+from flask import request, jsonify
+from backend import metrics, tracing
+from backend.db import DATA_DIR, get_connection, transaction
+
+try:
+    import fcntl
+except ImportError:  # Windows: el límite de llamadas a la API queda por proceso
+    fcntl = None
+
+"""
+Control de admisión delante de las rutas /api (auth, pagos y juego) y de
+las llamadas a la API de Pi Network, compartido entre los workers de gunicorn.
+
+1. Ritmo por IP y por usuario (token buckets en SQLite): cada petición a
+   las rutas protegidas gasta un token del bucket de su IP y, si se puede
+   identificar, del de su usuario (accessToken o Authorization: Bearer,
+   guardado como hash; user_address en las partidas). Sin tokens se
+   responde 429 con Retry-After al momento, antes de llamar a la API.
+
+2. Llamadas simultáneas a la API de Pi (UPSTREAM_CONCURRENCY entre todos
+   los workers): cada llamada ocupa un slot, un fichero de DATA_DIR con
+   flock que el sistema libera solo si el proceso muere. Si no queda
+   ninguno libre la llamada espera en una cola corta (QUEUE_MAX por
+   worker, QUEUE_TIMEOUT segundos como mucho); con la cola llena o al
+   agotar la espera se rechaza (pi_client.UpstreamBusyError -> 503 con
+   Retry-After) en lugar de acumular peticiones lentas.
+
+Si SQLite falla, el ritmo no se limita (mejor dejar pasar que tirar la API).
+"""
+
+logger = logging.getLogger(__name__)
+
+DB_NAME = 'admission'
+SLOTS_DIR = os.path.join(DATA_DIR, 'upstream_slots')
+
+# ADMISSION_ENABLED=0 desactiva los límites de ritmo (p.ej. en pruebas de carga)
+ENABLED = os.getenv('ADMISSION_ENABLED', '1') not in ('0', 'false', 'False')
+
+# Peticiones por segundo y ráfaga máxima por IP y por usuario
+IP_RATE = float(os.getenv('ADMISSION_IP_RATE', '10'))
+IP_BURST = float(os.getenv('ADMISSION_IP_BURST', '40'))
+USER_RATE = float(os.getenv('ADMISSION_USER_RATE', '5'))
+USER_BURST = float(os.getenv('ADMISSION_USER_BURST', '20'))
+
+# Variables que definen las plataformas del Procfile (Heroku, Render, Railway, Fly.io),
+# que siempre ponen un proxy delante de la app
+_PLATFORM_ENV = ('DYNO', 'RENDER', 'RAILWAY_ENVIRONMENT', 'FLY_APP_NAME')
+# Proxies de confianza delante de la app: la IP del cliente sale de X-Forwarded-For.
+# Por defecto 1 en esas plataformas y 0 en el resto; sin esto todos los clientes
+# compartirían el bucket de la IP del proxy
+TRUSTED_PROXIES = int(os.getenv(
+    'ADMISSION_TRUSTED_PROXIES', '1' if any(os.getenv(name) for name in _PLATFORM_ENV) else '0'
+))
+
+# Llamadas simultáneas a la API de Pi entre todos los workers (0 = sin límite)
+UPSTREAM_CONCURRENCY = int(os.getenv('ADMISSION_UPSTREAM_CONCURRENCY', '16'))
+# Llamadas que pueden esperar un slot a la vez en cada worker, y cuánto como mucho
+QUEUE_MAX = int(os.getenv('ADMISSION_QUEUE_MAX', '32'))
+QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', '1.0'))
+# Retry-After de las respuestas 503 por saturación
+BUSY_RETRY_AFTER = 1
+
+# asgi.py marca con esta clave del environ las peticiones que atiende como
+# corrutina; el before_request deja entonces la comprobación para check_deferred()
+ASYNC_ENVIRON_KEY = 'admission.async'
+_DEFERRED_ENVIRON_KEY = 'admission.deferred'
+
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+_lock = threading.Lock()
+_waiting = 0
+_stats = {'admitted': 0, 'rate_limited': 0, 'slots_acquired': 0, 'queued': 0, 'queue_full': 0, 'queue_timeout': 0}
+
+_slots = None
+_slots_pid = None
+_proxy_warned = False
+
+
+class QueueFull(Exception):
+    """
+    No hay slot libre para llamar a la API y la cola de espera está llena
+    (o se agotó la espera).
+    """
+
+
+def _connection():
+    global _schema_ready
+    conn = get_connection(DB_NAME)
+    if not _schema_ready:
+        with _schema_lock:
+            if not _schema_ready:
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS buckets (
+                        key        TEXT PRIMARY KEY,
+                        tokens     REAL NOT NULL,
+                        updated_at REAL NOT NULL
+                    )
+                ''')
+                conn.execute('CREATE INDEX IF NOT EXISTS buckets_updated ON buckets (updated_at)')
+                _schema_ready = True
+    # Estado desechable: no hace falta fsync en cada petición
+    conn.execute('PRAGMA synchronous=OFF')
+    return conn
+
+
+# -----------------------------
+# Token buckets por IP y usuario
+# -----------------------------
+def take(buckets, now=None):
+    """
+    Gasta un token de cada bucket [(key, rate, burst), ...] en una sola
+    transacción, o de ninguno si alguno está vacío. Devuelve (0, None) si se
+    admite, o (segundos hasta que haya un token, key) del bucket que lo impide.
+    """
+    conn = _connection()
+    now = time.time() if now is None else now
+    with transaction(conn):
+        levels = []
+        for key, rate, burst in buckets:
+            row = conn.execute('SELECT tokens, updated_at FROM buckets WHERE key = ?', (key,)).fetchone()
+            tokens = burst if row is None else min(burst, row['tokens'] + (now - row['updated_at']) * rate)
+            if tokens < 1:
+                return (1 - tokens) / rate, key
+            levels.append((key, tokens - 1, now))
+        conn.executemany(
+            'INSERT OR REPLACE INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?)', levels
+        )
+        # De vez en cuando, borrar los buckets que ya estarían llenos (equivalen a no tener fila)
+        if random.random() < 0.01:
+            idle = max(burst / rate for rate, burst in ((IP_RATE, IP_BURST), (USER_RATE, USER_BURST)) if rate > 0)
+            conn.execute('DELETE FROM buckets WHERE updated_at < ?', (now - idle,))
+    return 0, None
+
+
+def client_ip():
+    """
+    IP del cliente, saltando los proxies de confianza de X-Forwarded-For.
+    """
+    global _proxy_warned
+    if TRUSTED_PROXIES > 0:
+        forwarded = [ip.strip() for ip in request.headers.get('X-Forwarded-For', '').split(',') if ip.strip()]
+        if forwarded:
+            return forwarded[-min(TRUSTED_PROXIES, len(forwarded))]
+    elif not _proxy_warned and 'X-Forwarded-For' in request.headers:
+        _proxy_warned = True
+        logger.warning(
+            'Petición con X-Forwarded-For y ADMISSION_TRUSTED_PROXIES=0: si la app está detrás '
+            'de un proxy, todos los clientes comparten su límite de ritmo por IP'
+        )
+    return request.remote_addr or 'unknown'
+
+
+def _hash(value):
+    return hashlib.sha256(value.encode('utf-8')).hexdigest()[:32]
+
+
+def user_key(data=None):
+    """
+    Identificador del usuario de la petición, o None si no se conoce.
+    Los tokens de acceso solo se guardan como hash.
+    """
+    authorization = request.headers.get('Authorization', '')
+    if authorization.startswith('Bearer '):
+        return f'user:{_hash(authorization[7:])}'
+    if isinstance(data, dict):
+        if isinstance(data.get('accessToken'), str):
+            return f"user:{_hash(data['accessToken'])}"
+        if isinstance(data.get('user_address'), str):
+            return f"user:{_hash(data['user_address'])}"
+    return None
+
+
+def _json_body():
+    # Sin request.get_json(): si el JSON es inválido la ruta debe seguir respondiendo como siempre
+    try:
+        with tracing.span('json_parse'):
+            return json.loads(request.get_data(cache=True))
+    except ValueError:
+        return None
+
+
+def _too_many(retry_after, scope):
+    retry_after = max(1, math.ceil(retry_after))
+    response = jsonify({
+        'error': 'Demasiadas peticiones, espera un momento antes de volver a intentarlo',
+        'limit': scope,
+        'retryAfter': retry_after,
+    })
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def _request_buckets():
+    """
+    Buckets [(key, rate, burst), ...] que gasta la petición en curso.
+    """
+    if not ENABLED or request.method == 'OPTIONS':
+        return []
+    data = _json_body() if request.is_json else None
+    buckets = [(f'ip:{client_ip()}', IP_RATE, IP_BURST)]
+    user = user_key(data)
+    if user is not None:
+        buckets.append((user, USER_RATE, USER_BURST))
+    # Un ritmo <= 0 desactiva ese límite
+    return [bucket for bucket in buckets if bucket[1] > 0]
+
+
+def check_rate():
+    """
+    before_request de las rutas protegidas: 429 si la IP o el usuario
+    agotaron su ritmo.
+    """
+    buckets = _request_buckets()
+    if not buckets:
+        return None
+    try:
+        retry_after, blocked = take(buckets)
+    except sqlite3.Error as e:
+        logger.warning('No se pudo comprobar el ritmo de %s: %s', buckets[0][0], e)
+        return None
+    return _verdict(retry_after, blocked)
+
+
+async def check_deferred():
+    """
+    check_rate() de las vistas asíncronas (asgi.py), si el before_request la
+    aplazó: la escritura en SQLite, que puede esperar al lock de otro worker,
+    va al pool de hilos en lugar de bloquear el event loop.
+    """
+    if not request.environ.pop(_DEFERRED_ENVIRON_KEY, False):
+        return None
+    buckets = _request_buckets()
+    if not buckets:
+        return None
+    try:
+        retry_after, blocked = await asyncio.get_running_loop().run_in_executor(None, take, buckets)
+    except sqlite3.Error as e:
+        logger.warning('No se pudo comprobar el ritmo de %s: %s', buckets[0][0], e)
+        return None
+    return _verdict(retry_after, blocked)
+
+
+def _verdict(retry_after, blocked):
+    if retry_after:
+        scope = blocked.split(':', 1)[0]
+        _stats['rate_limited'] += 1
+        metrics.inc('admission_rejected_total', (('reason', scope),))
+        return _too_many(retry_after, scope)
+    _stats['admitted'] += 1
+    return None
+
+
+def init_app(app, blueprints, exempt=()):
+    """
+    Aplica los límites de ritmo a las rutas de los blueprints dados, salvo a
+    los endpoints de `exempt` (lecturas locales que no llaman a la API de Pi:
+    así no escriben en la base de buckets en cada petición).
+    """
+    names = {blueprint.name for blueprint in blueprints}
+    exempt = set(exempt)
+
+    def before_request():
+        if request.blueprint in names and request.endpoint not in exempt:
+            if request.environ.get(ASYNC_ENVIRON_KEY):
+                # Vista asíncrona: asgi.py llama después a check_deferred()
+                request.environ[_DEFERRED_ENVIRON_KEY] = True
+                return None
+            return check_rate()
+        return None
+
+    app.before_request(before_request)
+
+
+# -----------------------------
+# Slots de llamadas a la API de Pi
+# -----------------------------
+def _get_slots():
+    """
+    [(threading.Lock, fichero)] de este proceso (se abren de nuevo tras un fork).
+    """
+    global _slots, _slots_pid
+    if _slots is None or _slots_pid != os.getpid():
+        with _lock:
+            if _slots is None or _slots_pid != os.getpid():
+                files = [None] * UPSTREAM_CONCURRENCY
+                if fcntl is not None:
+                    os.makedirs(SLOTS_DIR, exist_ok=True)
+                    files = [open(os.path.join(SLOTS_DIR, f'slot-{i}.lock'), 'a+b') for i in range(UPSTREAM_CONCURRENCY)]
+                _slots = [(threading.Lock(), f) for f in files]
+                _slots_pid = os.getpid()
+    return _slots
+
+
+def _try_acquire():
+    """
+    Ocupa un slot libre sin esperar; devuelve su índice o None.
+    """
+    slots = _get_slots()
+    # Empezar en un slot al azar para no competir todos por el primero
+    start = random.randrange(len(slots))
+    for offset in range(len(slots)):
+        index = (start + offset) % len(slots)
+        # flock es por fichero abierto: el Lock evita que dos hilos del proceso compartan slot
+        thread_lock, lock_file = slots[index]
+        if not thread_lock.acquire(blocking=False):
+            continue
+        if lock_file is None:
+            return index
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return index
+        except OSError:
+            thread_lock.release()
+    return None
+
+
+def _enqueue():
+    global _waiting
+    with _lock:
+        if _waiting >= QUEUE_MAX:
+            _stats['queue_full'] += 1
+            metrics.inc('admission_rejected_total', (('reason', 'queue_full'),))
+            raise QueueFull(f'Cola de llamadas a la API llena ({QUEUE_MAX} esperando)')
+        _waiting += 1
+        _stats['queued'] += 1
+
+
+def _dequeue(started):
+    global _waiting
+    with _lock:
+        _waiting -= 1
+    waited = time.monotonic() - started
+    metrics.observe('admission_queue_wait_seconds', (), waited)
+    tracing.record('upstream_queue', time.perf_counter() - waited, waited)
+
+
+def _timed_out():
+    _stats['queue_timeout'] += 1
+    metrics.inc('admission_rejected_total', (('reason', 'queue_timeout'),))
+    return QueueFull(f'Sin slot libre para llamar a la API tras {QUEUE_TIMEOUT}s')
+
+
+def _poll_delay(attempt):
+    # Sondeo rápido al principio y más espaciado después
+    return min(0.05, 0.002 * 2 ** attempt)
+
+
+def acquire():
+    """
+    Ocupa un slot de llamada a la API, esperando como mucho QUEUE_TIMEOUT.
+    Devuelve el índice (None si no hay límite) para pasárselo a release().
+    Lanza QueueFull si la cola está llena o se agota la espera.
+    """
+    if UPSTREAM_CONCURRENCY <= 0:
+        return None
+    index = _try_acquire()
+    if index is None:
+        _enqueue()
+        started = time.monotonic()
+        attempt = 0
+        try:
+            while index is None and time.monotonic() - started < QUEUE_TIMEOUT:
+                time.sleep(_poll_delay(attempt))
+                attempt += 1
+                index = _try_acquire()
+        finally:
+            _dequeue(started)
+        if index is None:
+            raise _timed_out()
+    _stats['slots_acquired'] += 1
+    return index
+
+
+async def acquire_async():
+    """
+    Versión asíncrona de acquire(): espera sin bloquear el bucle de eventos.
+    """
+    if UPSTREAM_CONCURRENCY <= 0:
+        return None
+    index = _try_acquire()
+    if index is None:
+        _enqueue()
+        started = time.monotonic()
+        attempt = 0
+        try:
+            while index is None and time.monotonic() - started < QUEUE_TIMEOUT:
+                await asyncio.sleep(_poll_delay(attempt))
+                attempt += 1
+                index = _try_acquire()
+        finally:
+            _dequeue(started)
+        if index is None:
+            raise _timed_out()
+    _stats['slots_acquired'] += 1
+    return index
+
+
+def release(index):
+    if index is None:
+        return
+    thread_lock, lock_file = _get_slots()[index]
+    if lock_file is not None:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+    thread_lock.release()
+
+
+def stats():
+    with _lock:
+        stats = dict(_stats)
+        stats['waiting'] = _waiting
+    stats['slots_in_use'] = sum(1 for thread_lock, _ in (_slots or []) if thread_lock.locked()) \
+        if _slots_pid == os.getpid() else 0
+    stats['upstream_concurrency'] = UPSTREAM_CONCURRENCY
+    return stats
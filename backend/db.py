@@ -0,0 +1,66 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+"""
+Utilidades compartidas para las bases de datos SQLite locales del backend.
+Cada proceso (worker de gunicorn) y cada hilo obtiene su propia conexión;
+todas usan WAL para que los lectores no bloqueen al escritor.
+"""
+
+# Directorio donde viven los ficheros de datos locales
+DATA_DIR = os.getenv(
+    'DATA_DIR',
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data')
+)
+
+# Milisegundos que SQLite espera por un lock antes de fallar
+BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+
+_local = threading.local()
+
+
+def db_path(name):
+    """
+    Ruta absoluta del fichero SQLite `name` dentro de DATA_DIR.
+    """
+    return os.path.join(DATA_DIR, f'{name}.db')
+
+
+def get_connection(name):
+    """
+    Devuelve la conexión SQLite del hilo actual para la base `name`.
+    Las conexiones no se comparten entre procesos: tras un fork se abre una nueva.
+    """
+    conns = getattr(_local, 'conns', None)
+    if conns is None or getattr(_local, 'pid', None) != os.getpid():
+        conns = _local.conns = {}
+        _local.pid = os.getpid()
+
+    conn = conns.get(name)
+    if conn is None:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        # isolation_level=None: las transacciones se abren explícitamente con transaction()
+        conn = sqlite3.connect(db_path(name), timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+        conns[name] = conn
+    return conn
+
+
+@contextmanager
+def transaction(conn):
+    """
+    Abre una transacción de escritura (BEGIN IMMEDIATE) que serializa a los
+    escritores entre procesos; hace COMMIT al salir o ROLLBACK si hay error.
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
@@ -1,70 +1,170 @@
-import json, os
+import sys
+import time
+import argparse
+import resource
 from decimal import Decimal
-from backend.routes.payments import send_pi_to_user
+from backend import leaderboard_store, payouts
+from backend.prize_plan import plan_prizes
 
 """
-Ejecutar semanalmente (p.ej. cron job) para leer leaderboard.json,
+Ejecutar semanalmente (p.ej. cron job) para leer el leaderboard,
 calcular pool de premios y enviar Pi a los ganadores.
+
+Los pagos se planifican primero en el ledger de backend/payouts.py y se
+envían en paralelo; si la ejecución se interrumpe, volver a lanzar el script
+reanuda el mismo plan sin repetir pagos. Cada ejecución cierra la temporada
+activa del leaderboard (el juego sigue en la nueva) y la archiva solo cuando
+todos los pagos están confirmados.
+
+El plan se calcula recorriendo el leaderboard sin cargarlo en memoria
+(backend/prize_plan.py). Con --dry-run solo se muestra el plan y lo que
+tardó en calcularse: no cierra la temporada, no guarda nada y no envía Pi.
+
+El envío de Pi lo hace backend.routes.payments.send_pi_to_user(address,
+amount) -> bool (transferencia A2U desde la wallet de la app). Esta
+instalación todavía no la implementa: sin ella el script solo admite
+--dry-run y --reconcile, y se niega a empezar una distribución real antes
+de cerrar la temporada o guardar ningún plan.
 """
 
-def distribute_prizes():
-    base_path = os.path.dirname(os.path.realpath(__file__))
-    lb_path = os.path.join(base_path, 'routes', 'leaderboard.json')
-
-    # 1. Cargar leaderboard
-    if not os.path.exists(lb_path):
-        print("No hay leaderboard para procesar.")
-        return
-
-    with open(lb_path, 'r') as f:
-        leaderboard = json.load(f)
-
-    # Si no hay participantes, terminar
-    if not leaderboard:
-        print("Sin participantes esta semana.")
-        return
-
-    # 2. Calcular pool basado en número de partidas (simplificación)
-    #    pool = 0.009 Pi * número de entradas
-    num_entries = len(leaderboard)
-    pool = Decimal('0.009') * num_entries
-
-    # 3. Ordenar por puntaje descendente
-    sorted_lb = sorted(leaderboard, key=lambda x: x['score'], reverse=True)
-
-    # 4. Calcular top 10% (al menos 1 ganador)
-    top_count = max(1, int(len(sorted_lb) * 0.10))
-    winners = sorted_lb[:top_count]
-
-    # 5. Definir estructura de premios
-    prizes = []
-    if top_count >= 1:
-        prizes.append(pool * Decimal('0.40'))  # 1.er
-    if top_count >= 2:
-        prizes.append(pool * Decimal('0.20'))  # 2.º
-    if top_count >= 3:
-        prizes.append(pool * Decimal('0.10'))  # 3.º
-
-    remaining_pool = pool - sum(prizes)
-    if top_count > 3:
-        share = remaining_pool / (top_count - 3)
-        for _ in range(top_count - 3):
-            prizes.append(share)
-    if top_count < 3:
-        prizes = [pool / top_count] * top_count
-
-    # 6. Enviar Pi a cada ganador
-    for idx, winner in enumerate(winners):
-        address = winner['address']
-        amount = float(prizes[idx])
-        success = send_pi_to_user(address, amount)
-        print(f"Enviando {amount} Pi a {address}: {'Éxito' if success else 'Fallo'}")
-
-    # 7. Reiniciar leaderboard.json
-    with open(lb_path, 'w') as f:
-        json.dump([], f, indent=2)
-
-    print("Distribución semanal completada.")
+def _payout_sender():
+    """
+    Función de envío de premios, o None si esta instalación no tiene una.
+    """
+    from backend.routes import payments
+    return getattr(payments, 'send_pi_to_user', None)
+
+def _season_to_pay():
+    """
+    Temporada cerrada más antigua sin distribución cerrada. Las que ya se
+    pagaron pero no llegaron a archivarse se archivan aquí. Si no queda
+    ninguna, cierra la temporada activa (rollover) y devuelve esa.
+    """
+    for season in leaderboard_store.closed_seasons():
+        if not payouts.season_paid(season):
+            return season
+        leaderboard_store.archive_season(season)
+        print(f"Temporada {season} ya pagada: archivada.")
+    return leaderboard_store.rollover()
+
+def _season_to_plan():
+    """
+    Temporada que pagaría la próxima ejecución, sin cerrar ni archivar nada.
+    """
+    for season in leaderboard_store.closed_seasons():
+        if not payouts.season_paid(season):
+            return season
+    return leaderboard_store.active_season()
+
+def dry_run(season=None, show=10):
+    """
+    Calcula y muestra el plan de premios con sus tiempos, sin efectos.
+    """
+    run_id = payouts.open_run()
+    if run_id:
+        print(f"Hay una distribución abierta ({run_id}); la próxima ejecución la reanuda:")
+        print(f"  {payouts.run_summary(run_id)}")
+    season = season or _season_to_plan()
+
+    started = time.perf_counter()
+    num_entries = leaderboard_store.count_entries(season)
+    counted = time.perf_counter()
+    plan, pool = plan_prizes(leaderboard_store.iter_entries(season), num_entries)
+    planned = time.perf_counter()
+
+    total = sum((amount for _, amount in plan), Decimal(0))
+    print(f"Temporada {season}: {num_entries} participantes, {len(plan)} ganadores, pool {pool} Pi.")
+    for position, (address, amount) in enumerate(plan[:show], start=1):
+        print(f"  #{position} {address} {amount} Pi")
+    if len(plan) > show:
+        print(f"  ... {len(plan) - show} más; último #{len(plan)} {plan[-1][0]} {plan[-1][1]} Pi")
+    print(f"Suma de premios {total} Pi ({'cuadra' if total == pool else 'NO cuadra'} con el pool).")
+    print(
+        f"Tiempo: contar {counted - started:.3f}s, plan {planned - counted:.3f}s; "
+        f"memoria máxima del proceso {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB."
+    )
+    print("Dry run: no se ha guardado ni enviado nada.")
+    return total == pool
+
+def distribute_prizes(concurrency=None, rate=None, send=None):
+    # 0. Sin función de envío no se toca nada: ni la temporada ni el ledger
+    send = send or _payout_sender()
+    if send is None:
+        raise RuntimeError('No hay función de envío de Pi (backend.routes.payments.send_pi_to_user)')
+
+    # 1. Reanudar una distribución interrumpida, o planificar una nueva
+    run_id = payouts.open_run()
+    if run_id:
+        season = payouts.run_season(run_id)
+        print(f"Reanudando distribución {run_id} (temporada {season}).")
+    else:
+        # Cerrar la temporada activa; los puntajes nuevos ya van a la siguiente
+        season = _season_to_pay()
+        num_entries = leaderboard_store.count_entries(season)
+
+        # Si no hay participantes, terminar
+        if not num_entries:
+            leaderboard_store.archive_season(season)
+            print(f"Sin participantes en la temporada {season}.")
+            return
+
+        # 2. Guardar el plan completo antes de enviar nada
+        plan, pool = plan_prizes(leaderboard_store.iter_entries(season), num_entries)
+        run_id = payouts.create_run(plan, pool, num_entries, season=season)
+        print(f"Plan {run_id} (temporada {season}): {len(plan)} ganadores, pool {pool} Pi.")
+
+    # 3. Enviar Pi a los ganadores pendientes (en paralelo, con límite de ritmo)
+    summary = payouts.execute_run(run_id, send, concurrency=concurrency, rate=rate)
+    print(f"Resultado {run_id}: {summary['counts']}, enviado {summary['sent_total']} Pi.")
+
+    # 4. Archivar la temporada solo si todos los pagos están confirmados
+    if not payouts.is_reconciled(run_id):
+        print("Quedan pagos sin confirmar; la temporada NO se archiva.")
+        for item in payouts.unresolved_payouts(run_id):
+            print(f"  #{item['position']} {item['address']} {item['amount']} Pi: {item['status']} ({item['error']})")
+        print("Vuelve a ejecutar para reintentar los fallidos, o concilia los 'unknown' con --reconcile.")
+        return False
+
+    payouts.close_run(run_id)
+    if season is None:
+        # Run planificado antes de las temporadas: se pagó la temporada activa
+        season = leaderboard_store.rollover()
+    leaderboard_store.archive_season(season)
+    print(f"Distribución semanal completada; temporada {season} archivada.")
+    return True
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Distribución semanal de premios')
+    parser.add_argument('--concurrency', type=int, help='Envíos simultáneos')
+    parser.add_argument('--rate', type=float, help='Envíos por segundo como máximo')
+    parser.add_argument(
+        '--reconcile', nargs=2, metavar=('POSICION', 'ESTADO'),
+        help="Resolver a mano un pago 'unknown' de la distribución abierta: ESTADO = sent | failed"
+    )
+    parser.add_argument('--dry-run', action='store_true', help='Mostrar el plan y su tiempo sin guardar ni enviar nada')
+    parser.add_argument('--season', help='Temporada a planificar con --dry-run (por defecto, la que se pagaría)')
+    parser.add_argument('--show', type=int, default=10, help='Ganadores que se listan con --dry-run')
+    args = parser.parse_args(argv)
+
+    if args.dry_run:
+        return 0 if dry_run(args.season, args.show) else 1
+
+    if args.reconcile:
+        run_id = payouts.open_run()
+        if not run_id:
+            print("No hay ninguna distribución abierta.")
+            return 1
+        payouts.reconcile_payout(run_id, int(args.reconcile[0]), args.reconcile[1])
+        print(f"Pago #{args.reconcile[0]} del run {run_id} marcado como {args.reconcile[1]}.")
+        return 0
+
+    send = _payout_sender()
+    if send is None:
+        print("No hay función de envío de Pi (backend.routes.payments.send_pi_to_user): "
+              "no se inicia la distribución. Usa --dry-run para ver el plan.", file=sys.stderr)
+        return 2
+
+    return 0 if distribute_prizes(args.concurrency, args.rate, send) is not False else 1
 
 if __name__ == '__main__':
-    distribute_prizes()
\ No newline at end of file
+    sys.exit(main())
@@ -0,0 +1,162 @@
+import os
+import mmap
+import struct
+from datetime import datetime, timedelta
+
+"""
+Formato binario compacto para temporadas cerradas del leaderboard.
+
+Las entradas se guardan ordenadas por ranking (puntaje desc, timestamp,
+dirección) en secciones de tamaño conocido, de modo que el fichero se puede
+abrir con mmap y consultar el top-N sin cargarlo entero:
+
+  cabecera     MAGIC, versión, nº de entradas, desplazamientos de cada sección
+  puntajes     primer puntaje (zigzag varint) y después las diferencias con
+               el anterior (varint sin signo; son >= 0 porque van ordenados)
+  checkpoints  cada CHECKPOINT_EVERY entradas: (offset en puntajes, puntaje)
+               para saltar a una posición sin decodificar desde el principio
+  índice       count + 1 offsets u32 dentro del bloque de direcciones
+  direcciones  direcciones UTF-8 concatenadas
+  timestamps   count enteros u64 (microsegundos desde epoch, UTC)
+"""
+
+MAGIC = b'PLBA'
+VERSION = 1
+CHECKPOINT_EVERY = 128
+
+# magic, versión, flags, count, y offsets de: puntajes, checkpoints, índice, direcciones, timestamps, fin
+_HEADER = struct.Struct('<4sHHI6Q')
+_CHECKPOINT = struct.Struct('<Iq')
+
+
+def _encode_varint(value, out):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _decode_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _zigzag(value):
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+# Los timestamps del leaderboard son ISO en UTC sin zona (datetime.utcnow)
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def _timestamp_us(timestamp):
+    return (datetime.fromisoformat(timestamp) - _EPOCH) // _MICROSECOND
+
+
+def write_archive(path, entries):
+    """
+    Escribe `entries` (dicts ya ordenados por ranking) en `path` de forma atómica.
+    """
+    scores = bytearray()
+    checkpoints = bytearray()
+    offsets = [0]
+    blob = bytearray()
+    timestamps = bytearray()
+
+    previous = None
+    for i, entry in enumerate(entries):
+        if i % CHECKPOINT_EVERY == 0:
+            checkpoints += _CHECKPOINT.pack(len(scores), entry['score'])
+        if previous is None:
+            _encode_varint(_zigzag(entry['score']), scores)
+        else:
+            _encode_varint(previous - entry['score'], scores)
+        previous = entry['score']
+        blob += entry['address'].encode('utf-8')
+        offsets.append(len(blob))
+        timestamps += struct.pack('<Q', _timestamp_us(entry['timestamp']))
+
+    count = len(offsets) - 1
+    index = struct.pack(f'<{len(offsets)}I', *offsets)
+    scores_off = _HEADER.size
+    checkpoints_off = scores_off + len(scores)
+    index_off = checkpoints_off + len(checkpoints)
+    blob_off = index_off + len(index)
+    ts_off = blob_off + len(blob)
+    end = ts_off + len(timestamps)
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, 0, count,
+                             scores_off, checkpoints_off, index_off, blob_off, ts_off, end))
+        for section in (scores, checkpoints, index, blob, timestamps):
+            f.write(section)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class SeasonArchive:
+    """
+    Lector de un fichero de temporada archivada mediante mmap.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, _, self.count, self._scores_off, self._checkpoints_off,
+         self._index_off, self._blob_off, self._ts_off, _) = _HEADER.unpack_from(self._buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'Fichero de archivo no válido: {path}')
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self._buf.close()
+
+    def _address(self, i):
+        start, end = struct.unpack_from('<II', self._buf, self._index_off + i * 4)
+        return bytes(self._buf[self._blob_off + start:self._blob_off + end]).decode('utf-8')
+
+    def _timestamp(self, i):
+        (us,) = struct.unpack_from('<Q', self._buf, self._ts_off + i * 8)
+        return (_EPOCH + us * _MICROSECOND).isoformat()
+
+    def top(self, limit, offset=0):
+        """
+        Entradas en posiciones [offset, offset + limit) con su ranking.
+        """
+        if offset >= self.count or limit <= 0:
+            return []
+        # Saltar al checkpoint anterior a offset y decodificar desde ahí
+        block = offset // CHECKPOINT_EVERY
+        rel, score = _CHECKPOINT.unpack_from(self._buf, self._checkpoints_off + block * _CHECKPOINT.size)
+        pos = self._scores_off + rel
+        i = block * CHECKPOINT_EVERY
+        _, pos = _decode_varint(self._buf, pos)
+
+        entries = []
+        last = min(self.count, offset + limit)
+        while i < last:
+            if i >= offset:
+                entries.append({
+                    'rank': i + 1,
+                    'address': self._address(i),
+                    'score': score,
+                    'timestamp': self._timestamp(i),
+                })
+            i += 1
+            if i < last:
+                delta, pos = _decode_varint(self._buf, pos)
+                score -= delta
+        return entries
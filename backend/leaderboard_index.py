@@ -0,0 +1,207 @@
+import random
+import threading
+from backend import leaderboard_store, tracing
+
+"""
+Índice en memoria del leaderboard para consultas de ranking.
+Usa una skip list indexable (cada enlace guarda cuántas posiciones salta),
+de modo que insertar, borrar, obtener el ranking de una dirección o saltar
+a la posición N cuestan O(log n). El índice se sincroniza incrementalmente
+con leaderboard_store leyendo solo las entradas con seq mayor al último visto.
+"""
+
+MAX_LEVEL = 32
+
+
+class _Node:
+    __slots__ = ('key', 'next', 'width')
+
+    def __init__(self, key, level):
+        self.key = key
+        self.next = [None] * level
+        self.width = [1] * level
+
+
+class IndexableSkipList:
+    """
+    Lista ordenada con acceso por posición y cálculo de ranking en O(log n).
+    Las claves deben ser únicas y comparables.
+    """
+
+    def __init__(self):
+        self._head = _Node(None, MAX_LEVEL)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _random_level(self):
+        level = 1
+        while level < MAX_LEVEL and random.random() < 0.5:
+            level += 1
+        return level
+
+    def _find_predecessors(self, key):
+        """
+        Para cada nivel, devuelve el último nodo con clave < key y su posición.
+        """
+        update = [None] * MAX_LEVEL
+        positions = [0] * MAX_LEVEL
+        node = self._head
+        pos = 0
+        for i in reversed(range(MAX_LEVEL)):
+            while node.next[i] is not None and node.next[i].key < key:
+                pos += node.width[i]
+                node = node.next[i]
+            update[i] = node
+            positions[i] = pos
+        return update, positions
+
+    def insert(self, key):
+        update, positions = self._find_predecessors(key)
+        pos = positions[0]
+        level = self._random_level()
+        node = _Node(key, level)
+        for i in range(MAX_LEVEL):
+            prev = update[i]
+            if i < level:
+                node.next[i] = prev.next[i]
+                prev.next[i] = node
+                node.width[i] = prev.width[i] - (pos - positions[i])
+                prev.width[i] = pos - positions[i] + 1
+            else:
+                prev.width[i] += 1
+        self._size += 1
+
+    def remove(self, key):
+        update, _ = self._find_predecessors(key)
+        node = update[0].next[0]
+        if node is None or node.key != key:
+            raise KeyError(key)
+        for i in range(MAX_LEVEL):
+            prev = update[i]
+            if prev.next[i] is node:
+                prev.width[i] += node.width[i] - 1
+                prev.next[i] = node.next[i]
+            else:
+                prev.width[i] -= 1
+        self._size -= 1
+
+    def rank(self, key):
+        """
+        Posición (empezando en 1) de `key`, o None si no está.
+        """
+        update, positions = self._find_predecessors(key)
+        node = update[0].next[0]
+        if node is None or node.key != key:
+            return None
+        return positions[0] + 1
+
+    def slice(self, offset, limit):
+        """
+        Devuelve hasta `limit` claves a partir de la posición `offset` (desde 0).
+        """
+        if offset >= self._size or limit <= 0:
+            return []
+        target = offset + 1
+        node = self._head
+        pos = 0
+        for i in reversed(range(MAX_LEVEL)):
+            while node.next[i] is not None and pos + node.width[i] <= target:
+                pos += node.width[i]
+                node = node.next[i]
+        keys = []
+        while node is not None and len(keys) < limit:
+            keys.append(node.key)
+            node = node.next[0]
+        return keys
+
+
+def _sort_key(entry):
+    # Mayor puntaje primero; a igual puntaje, quien lo logró antes
+    return (-entry['score'], entry['timestamp'], entry['address'])
+
+
+class LeaderboardIndex:
+    """
+    Vista ordenada del leaderboard de este proceso, actualizada por incrementos.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._list = IndexableSkipList()
+        self._keys = {}
+        self._generation = None
+        self._seq = 0
+
+    def _rebuild(self):
+        generation, seq, entries = leaderboard_store.load_snapshot()
+        self._list = IndexableSkipList()
+        self._keys = {}
+        for entry in entries:
+            key = _sort_key(entry)
+            self._list.insert(key)
+            self._keys[entry['address']] = key
+        self._generation = generation
+        self._seq = seq
+
+    def _apply(self, entry):
+        old_key = self._keys.get(entry['address'])
+        if old_key is not None:
+            self._list.remove(old_key)
+        key = _sort_key(entry)
+        self._list.insert(key)
+        self._keys[entry['address']] = key
+
+    def sync(self):
+        """
+        Incorpora los cambios escritos en el almacenamiento (por este u otro worker).
+        """
+        with self._lock:
+            generation, seq = leaderboard_store.current_version()
+            if generation != self._generation:
+                self._rebuild()
+                return
+            if seq == self._seq:
+                return
+            for entry in leaderboard_store.changes_since(self._seq):
+                self._apply(entry)
+                self._seq = max(self._seq, entry['seq'])
+
+    def total(self):
+        return len(self._list)
+
+    @tracing.traced('lb_read')
+    def top(self, limit, offset=0):
+        """
+        Entradas en posiciones [offset, offset + limit) con su ranking.
+        """
+        self.sync()
+        with self._lock:
+            keys = self._list.slice(offset, limit)
+            total = len(self._list)
+        entries = [
+            {'rank': offset + i + 1, 'address': address, 'score': -neg_score, 'timestamp': timestamp}
+            for i, (neg_score, timestamp, address) in enumerate(keys)
+        ]
+        return entries, total
+
+    @tracing.traced('lb_read')
+    def rank_of(self, address, sync=True):
+        """
+        Ranking de `address` o None si no ha jugado.
+        sync=False usa el índice tal cual (quien llama acaba de sincronizarlo).
+        """
+        if sync:
+            self.sync()
+        with self._lock:
+            key = self._keys.get(address)
+            if key is None:
+                return None
+            rank = self._list.rank(key)
+            total = len(self._list)
+        return {'address': address, 'score': -key[0], 'timestamp': key[1], 'rank': rank, 'total': total}
+
+
+# Índice compartido por las peticiones de este worker
+leaderboard_index = LeaderboardIndex()
@@ -0,0 +1,419 @@
+import json
+import os
+import time
+import threading
+import logging
+from datetime import datetime
+from backend import tracing
+from backend.db import get_connection, transaction, DATA_DIR
+from backend.leaderboard_archive import write_archive, SeasonArchive
+
+"""
+Almacenamiento del leaderboard en SQLite (modo WAL).
+Sustituye a leaderboard.json: cada partida es un upsert indexado por dirección
+(O(log n)) en lugar de leer y reescribir el fichero completo, y las escrituras
+de varios workers de gunicorn se serializan sin perder datos.
+
+El leaderboard está particionado por temporadas. Solo una está activa y
+recibe puntajes; rollover() la cierra y abre la siguiente sin mover datos.
+Las temporadas ya pagadas se archivan en ficheros binarios compactos (ver
+leaderboard_archive.py) y sus filas se borran de la base.
+
+Estados de una temporada: active -> closed -> archived
+"""
+
+logger = logging.getLogger(__name__)
+
+DB_NAME = 'leaderboard'
+
+# Carpeta de los ficheros de temporadas archivadas
+ARCHIVE_DIR = os.path.join(DATA_DIR, 'archives')
+
+# Ficheros JSON antiguos que se importan la primera vez que se crea la base
+LEGACY_JSON_PATHS = [
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), 'leaderboard.json'),
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), 'routes', 'leaderboard.json'),
+]
+
+# Orden del ranking: mayor puntaje primero; a igual puntaje, quien lo logró antes
+RANK_ORDER = 'score DESC, timestamp, address'
+
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+# Lectores abiertos de temporadas archivadas (ruta -> SeasonArchive)
+_archives = {}
+_archives_lock = threading.Lock()
+
+
+def _connection():
+    """
+    Conexión del hilo actual con el esquema ya creado.
+    """
+    global _schema_ready
+    conn = get_connection(DB_NAME)
+    if not _schema_ready:
+        with _schema_lock:
+            if not _schema_ready:
+                _create_schema(conn)
+                _schema_ready = True
+    return conn
+
+
+def _new_season_id(conn):
+    """
+    Semana ISO actual (p.ej. 2026-W42), con sufijo si esa temporada ya existe.
+    """
+    base = time.strftime('%G-W%V', time.gmtime())
+    season = base
+    suffix = 1
+    while conn.execute('SELECT 1 FROM leaderboard_seasons WHERE season = ?', (season,)).fetchone():
+        suffix += 1
+        season = f'{base}.{suffix}'
+    return season
+
+
+def _create_schema(conn):
+    with transaction(conn):
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS leaderboard_seasons (
+                season    TEXT PRIMARY KEY,
+                status    TEXT NOT NULL,
+                opened_at REAL NOT NULL,
+                closed_at REAL,
+                entries   INTEGER,
+                archive   TEXT
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS leaderboard_entries (
+                season    TEXT NOT NULL,
+                address   TEXT NOT NULL,
+                score     INTEGER NOT NULL,
+                timestamp TEXT NOT NULL,
+                seq       INTEGER NOT NULL,
+                PRIMARY KEY (season, address)
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS leaderboard_entries_seq ON leaderboard_entries (seq)')
+        conn.execute(
+            'CREATE INDEX IF NOT EXISTS leaderboard_entries_rank '
+            'ON leaderboard_entries (season, score DESC, timestamp, address)'
+        )
+        # seq: contador global de cambios; generation: se incrementa en cada rollover
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS leaderboard_meta (
+                key   TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            )
+        ''')
+        conn.execute("INSERT OR IGNORE INTO leaderboard_meta (key, value) VALUES ('seq', 0)")
+        conn.execute("INSERT OR IGNORE INTO leaderboard_meta (key, value) VALUES ('generation', 0)")
+
+        if conn.execute("SELECT 1 FROM leaderboard_seasons WHERE status = 'active'").fetchone():
+            return
+
+        season = _new_season_id(conn)
+        conn.execute(
+            "INSERT INTO leaderboard_seasons (season, status, opened_at) VALUES (?, 'active', ?)",
+            (season, time.time())
+        )
+        # Tabla única (sin temporadas) de la versión anterior
+        legacy_table = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='leaderboard'"
+        ).fetchone()
+        if legacy_table:
+            conn.execute(
+                'INSERT INTO leaderboard_entries (season, address, score, timestamp, seq) '
+                'SELECT ?, address, score, timestamp, seq FROM leaderboard',
+                (season,)
+            )
+            conn.execute(
+                "UPDATE leaderboard_meta SET value = MAX(value, (SELECT COALESCE(MAX(seq), 0) FROM leaderboard)) "
+                "WHERE key = 'seq'"
+            )
+            conn.execute('DROP TABLE leaderboard')
+            logger.info('Leaderboard anterior migrado a la temporada %s', season)
+        else:
+            _import_legacy_json(conn, season)
+
+
+def _import_legacy_json(conn, season):
+    """
+    Migra las entradas de los leaderboard.json antiguos (si existen).
+    """
+    for path in LEGACY_JSON_PATHS:
+        if not os.path.exists(path):
+            continue
+        try:
+            with open(path, 'r') as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            logger.warning('No se pudo leer el leaderboard antiguo: %s', path)
+            continue
+        for entry in entries:
+            _upsert(conn, season, entry['address'], entry['score'], entry.get('timestamp'))
+        if entries:
+            logger.info('Importadas %s entradas desde %s', len(entries), path)
+
+
+def _active_season(conn):
+    return conn.execute("SELECT season FROM leaderboard_seasons WHERE status = 'active'").fetchone()[0]
+
+
+def _upsert(conn, season, address, score, timestamp=None):
+    conn.execute("UPDATE leaderboard_meta SET value = value + 1 WHERE key = 'seq'")
+    cursor = conn.execute(
+        '''
+        INSERT INTO leaderboard_entries (season, address, score, timestamp, seq)
+        VALUES (?, ?, ?, ?, (SELECT value FROM leaderboard_meta WHERE key = 'seq'))
+        ON CONFLICT (season, address) DO UPDATE SET
+            score = excluded.score,
+            timestamp = excluded.timestamp,
+            seq = excluded.seq
+        WHERE excluded.score > leaderboard_entries.score
+        ''',
+        (season, address, score, timestamp or datetime.utcnow().isoformat())
+    )
+    return cursor.rowcount > 0
+
+
+def active_season():
+    """
+    Identificador de la temporada que recibe puntajes.
+    """
+    return _active_season(_connection())
+
+
+@tracing.traced('lb_write')
+def upsert_best_score(address, score, timestamp=None):
+    """
+    Guarda `score` para `address` en la temporada activa solo si mejora su
+    mejor puntaje. Devuelve True si la entrada se creó o se actualizó.
+    """
+    conn = _connection()
+    with transaction(conn):
+        return _upsert(conn, _active_season(conn), address, score, timestamp)
+
+
+def upsert_many(entries, durable=True):
+    """
+    Aplica varios (address, score, timestamp) en una sola transacción.
+    Con `durable` el commit hace fsync (synchronous=FULL) una vez por lote.
+    Devuelve cuántas entradas se crearon o mejoraron.
+    """
+    conn = _connection()
+    # La conexión es la del hilo para todo el módulo: restaurar el modo al acabar
+    previous = conn.execute('PRAGMA synchronous').fetchone()[0]
+    conn.execute(f"PRAGMA synchronous={'FULL' if durable else 'NORMAL'}")
+    changed = 0
+    try:
+        with transaction(conn):
+            season = _active_season(conn)
+            for address, score, timestamp in entries:
+                if _upsert(conn, season, address, score, timestamp):
+                    changed += 1
+    finally:
+        conn.execute(f'PRAGMA synchronous={int(previous)}')
+    return changed
+
+
+@tracing.traced('lb_read')
+def get_entry(address, season=None):
+    """
+    Devuelve la entrada de `address` como dict, o None si no ha jugado.
+    """
+    conn = _connection()
+    row = conn.execute(
+        'SELECT address, score, timestamp FROM leaderboard_entries WHERE season = ? AND address = ?',
+        (season or _active_season(conn), address)
+    ).fetchone()
+    return dict(row) if row else None
+
+
+def count_entries(season=None):
+    """
+    Número de participantes de la temporada (la activa si no se indica).
+    """
+    conn = _connection()
+    return conn.execute(
+        'SELECT COUNT(*) FROM leaderboard_entries WHERE season = ?', (season or _active_season(conn),)
+    ).fetchone()[0]
+
+
+def iter_entries(season=None):
+    """
+    Recorre las entradas ({address, score, timestamp}) de la temporada sin
+    cargarlas en memoria.
+    """
+    conn = _connection()
+    cursor = conn.execute(
+        'SELECT address, score, timestamp FROM leaderboard_entries WHERE season = ?',
+        (season or _active_season(conn),)
+    )
+    for row in cursor:
+        yield dict(row)
+
+
+def _read_version(conn):
+    rows = dict(conn.execute('SELECT key, value FROM leaderboard_meta').fetchall())
+    return rows['generation'], rows['seq']
+
+
+def current_version():
+    """
+    Devuelve (generation, seq): permite saber en O(1) si el leaderboard cambió.
+    """
+    return _read_version(_connection())
+
+
+def load_snapshot():
+    """
+    Lee de forma consistente la versión actual y todas las entradas de la
+    temporada activa. Devuelve (generation, seq, entries).
+    """
+    conn = _connection()
+    conn.execute('BEGIN')
+    try:
+        generation, seq = _read_version(conn)
+        entries = [
+            dict(row) for row in conn.execute(
+                'SELECT address, score, timestamp FROM leaderboard_entries WHERE season = ?',
+                (_active_season(conn),)
+            )
+        ]
+    finally:
+        conn.execute('COMMIT')
+    return generation, seq, entries
+
+
+def changes_since(seq):
+    """
+    Entradas de la temporada activa creadas o mejoradas después de `seq`,
+    con su propio seq.
+    """
+    conn = _connection()
+    cursor = conn.execute(
+        'SELECT address, score, timestamp, seq FROM leaderboard_entries '
+        'WHERE seq > ? AND season = ? ORDER BY seq',
+        (seq, _active_season(conn))
+    )
+    return [dict(row) for row in cursor]
+
+
+def rollover(new_season=None):
+    """
+    Cierra la temporada activa y abre `new_season` (por defecto la semana ISO
+    actual). Solo cambia qué temporada es la activa: no copia ni borra filas.
+    Devuelve el identificador de la temporada cerrada.
+    """
+    conn = _connection()
+    with transaction(conn):
+        closed = _active_season(conn)
+        season = new_season or _new_season_id(conn)
+        now = time.time()
+        conn.execute(
+            "UPDATE leaderboard_seasons SET status = 'closed', closed_at = ?, "
+            "entries = (SELECT COUNT(*) FROM leaderboard_entries WHERE season = ?) WHERE season = ?",
+            (now, closed, closed)
+        )
+        conn.execute(
+            "INSERT INTO leaderboard_seasons (season, status, opened_at) VALUES (?, 'active', ?)",
+            (season, now)
+        )
+        conn.execute("UPDATE leaderboard_meta SET value = value + 1 WHERE key = 'generation'")
+    logger.info('Temporada %s cerrada; temporada activa: %s', closed, season)
+    return closed
+
+
+@tracing.traced('lb_read')
+def list_seasons():
+    """
+    Todas las temporadas con su estado, de la más reciente a la más antigua.
+    """
+    return [
+        dict(row) for row in _connection().execute(
+            'SELECT season, status, opened_at, closed_at, entries FROM leaderboard_seasons '
+            'ORDER BY opened_at DESC'
+        )
+    ]
+
+
+def closed_seasons():
+    """
+    Temporadas cerradas aún sin archivar, de la más antigua a la más reciente.
+    """
+    return [
+        row['season'] for row in _connection().execute(
+            "SELECT season FROM leaderboard_seasons WHERE status = 'closed' ORDER BY opened_at"
+        )
+    ]
+
+
+def _season_row(conn, season):
+    return conn.execute(
+        'SELECT status, archive FROM leaderboard_seasons WHERE season = ?', (season,)
+    ).fetchone()
+
+
+def _open_archive(path, reload=False):
+    with _archives_lock:
+        archive = _archives.get(path)
+        if archive is None or reload:
+            if archive is not None:
+                archive.close()
+            archive = _archives[path] = SeasonArchive(path)
+        return archive
+
+
+def archive_season(season):
+    """
+    Escribe una temporada cerrada en su fichero de archivo y borra sus filas
+    de la base. Devuelve la ruta del fichero.
+    """
+    conn = _connection()
+    row = _season_row(conn, season)
+    if row is None or row['status'] != 'closed':
+        raise ValueError(f'Solo se pueden archivar temporadas cerradas: {season}')
+
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    name = f'{season}.plb'
+    path = os.path.join(ARCHIVE_DIR, name)
+    cursor = conn.execute(
+        f'SELECT address, score, timestamp FROM leaderboard_entries WHERE season = ? ORDER BY {RANK_ORDER}',
+        (season,)
+    )
+    write_archive(path, (dict(r) for r in cursor))
+    entries = len(_open_archive(path, reload=True))
+
+    with transaction(conn):
+        conn.execute(
+            "UPDATE leaderboard_seasons SET status = 'archived', entries = ?, archive = ? WHERE season = ?",
+            (entries, name, season)
+        )
+        conn.execute('DELETE FROM leaderboard_entries WHERE season = ?', (season,))
+    logger.info('Temporada %s archivada: %s entradas, %s bytes', season, entries, os.path.getsize(path))
+    return path
+
+
+@tracing.traced('lb_read')
+def season_top(season, limit, offset=0):
+    """
+    Top de una temporada cerrada o archivada. Devuelve (entries con rank, total),
+    o None si la temporada no existe.
+    """
+    conn = _connection()
+    row = _season_row(conn, season)
+    if row is None:
+        return None
+    if row['status'] == 'archived':
+        archive = _open_archive(os.path.join(ARCHIVE_DIR, row['archive']))
+        return archive.top(limit, offset), len(archive)
+
+    rows = conn.execute(
+        f'SELECT address, score, timestamp FROM leaderboard_entries WHERE season = ? '
+        f'ORDER BY {RANK_ORDER} LIMIT ? OFFSET ?',
+        (season, limit, offset)
+    ).fetchall()
+    entries = [{'rank': offset + i + 1, **dict(r)} for i, r in enumerate(rows)]
+    return entries, count_entries(season)
@@ -0,0 +1,282 @@
+import os
+import json
+import time
+import asyncio
+import threading
+import logging
+from backend import leaderboard_store
+from backend.leaderboard_index import leaderboard_index
+
+"""
+Difusión en vivo del leaderboard por Server-Sent Events.
+
+Un hilo por worker (el hub) detecta los cambios del leaderboard y los reparte
+a los clientes conectados a /api/game/dribble/stream:
+
+  event: top   el top STREAM_TOP_N, serializado una sola vez para todos
+  event: rank  el puesto del propio suscriptor (?address=...), solo si cambió
+
+Los cambios de este worker avisan al hub al terminar cada lote de
+score_buffer; los de otros workers se ven consultando la versión del
+almacenamiento cada STREAM_POLL_INTERVAL segundos. Entre dos difusiones pasan
+al menos STREAM_COALESCE_MS: las partidas que llegan mientras tanto se
+juntan en una sola actualización, y un cliente lento solo recibe el estado
+más reciente de cada evento (no una cola de todos los intermedios).
+
+Con gunicorn cada conexión ocupa un hilo del worker mientras dure
+(usar -k gthread con suficientes --threads); en modo ASGI (asgi.py) las
+conexiones esperan como corrutinas.
+"""
+
+logger = logging.getLogger(__name__)
+
+# Entradas del top que se difunden
+TOP_N = int(os.getenv('STREAM_TOP_N', '10'))
+# Conexiones simultáneas como máximo por worker
+MAX_CLIENTS = int(os.getenv('STREAM_MAX_CLIENTS', '100'))
+# Tiempo mínimo entre dos difusiones
+COALESCE_SECONDS = float(os.getenv('STREAM_COALESCE_MS', '250')) / 1000
+# Cada cuánto se miran los cambios escritos por otros workers
+POLL_INTERVAL = float(os.getenv('STREAM_POLL_INTERVAL', '1.0'))
+# Comentario periódico para mantener viva la conexión y detectar clientes caídos
+KEEPALIVE_SECONDS = float(os.getenv('STREAM_KEEPALIVE_SECONDS', '15'))
+# Reintento sugerido al navegador si se corta la conexión
+RETRY_MS = 3000
+
+_KEEPALIVE = b': keepalive\n\n'
+
+_lock = threading.Lock()
+_cond = threading.Condition(_lock)
+_subscribers = set()
+_dirty = False
+_started_pid = None
+
+# Último top difundido
+_last_top = None
+
+_stats = {'connected': 0, 'rejected': 0, 'broadcasts': 0, 'top_events': 0, 'rank_events': 0, 'coalesced': 0}
+
+
+class TooManyClients(Exception):
+    """
+    El worker ya tiene MAX_CLIENTS conexiones abiertas.
+    """
+
+
+def _event(name, payload):
+    data = json.dumps(payload, separators=(',', ':'), ensure_ascii=False)
+    return f'event: {name}\ndata: {data}\n\n'.encode('utf-8')
+
+
+class Subscriber:
+    """
+    Conexión de un cliente. Guarda solo el último evento pendiente de cada
+    tipo; `loop` indica que el cliente espera en ese bucle de asyncio.
+    """
+
+    def __init__(self, address=None, loop=None):
+        self.address = address
+        self.last_rank = None
+        self._loop = loop
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._ready = asyncio.Event() if loop is not None else threading.Event()
+
+    def push(self, name, chunk):
+        with self._pending_lock:
+            if name in self._pending:
+                _stats['coalesced'] += 1
+            self._pending[name] = chunk
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._ready.set)
+        else:
+            self._ready.set()
+
+    def take(self):
+        """
+        Eventos pendientes listos para escribir (b'' si no hay ninguno).
+        """
+        with self._pending_lock:
+            self._ready.clear()
+            chunks = list(self._pending.values())
+            self._pending.clear()
+        return b''.join(chunks)
+
+    def wait(self, timeout):
+        self._ready.wait(timeout)
+
+    async def wait_async(self, timeout):
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+def _rank_event(subscriber):
+    """
+    Evento 'rank' para el suscriptor si su puesto o puntaje cambió, si no None.
+    """
+    # El índice ya se sincronizó al calcular el top de esta difusión
+    result = leaderboard_index.rank_of(subscriber.address, sync=False)
+    current = (result['rank'], result['score']) if result else None
+    if current == subscriber.last_rank:
+        return None
+    previous = subscriber.last_rank
+    subscriber.last_rank = current
+    payload = dict(result) if result else {'address': subscriber.address, 'rank': None}
+    payload['previousRank'] = previous[0] if previous else None
+    return _event('rank', payload)
+
+
+def _current_top():
+    entries, total = leaderboard_index.top(TOP_N)
+    return {'season': leaderboard_store.active_season(), 'total': total, 'entries': entries}
+
+
+def _broadcast():
+    global _last_top
+    top = _current_top()
+    if top != _last_top:
+        _last_top = top
+        # Una sola serialización para todos los suscriptores
+        top_event = _event('top', top)
+        _stats['top_events'] += 1
+    else:
+        top_event = None
+
+    with _lock:
+        subscribers = list(_subscribers)
+    for subscriber in subscribers:
+        if top_event is not None:
+            subscriber.push('top', top_event)
+        if subscriber.address:
+            rank_event = _rank_event(subscriber)
+            if rank_event is not None:
+                subscriber.push('rank', rank_event)
+                _stats['rank_events'] += 1
+    _stats['broadcasts'] += 1
+
+
+def _hub_loop():
+    global _dirty
+    version = None
+    while True:
+        with _cond:
+            if not _dirty:
+                _cond.wait(POLL_INTERVAL)
+            notified, _dirty = _dirty, False
+            idle = not _subscribers
+        if idle:
+            continue
+        try:
+            current = leaderboard_store.current_version()
+            if notified or current != version:
+                version = current
+                _broadcast()
+                # Lo que llegue durante esta pausa se difunde junto en la siguiente
+                time.sleep(COALESCE_SECONDS)
+        except Exception:
+            logger.exception('Error difundiendo el leaderboard')
+            time.sleep(POLL_INTERVAL)
+
+
+def _ensure_hub():
+    """
+    Arranca el hub en este proceso (una vez, también tras un fork).
+    """
+    global _started_pid, _subscribers, _last_top
+    if _started_pid == os.getpid():
+        return
+    with _lock:
+        if _started_pid == os.getpid():
+            return
+        # Los suscriptores heredados del padre no son conexiones de este proceso
+        _subscribers = set()
+        _last_top = None
+        threading.Thread(target=_hub_loop, name='leaderboard-stream', daemon=True).start()
+        _started_pid = os.getpid()
+
+
+def notify():
+    """
+    Avisa al hub de que el leaderboard cambió en este worker.
+    """
+    global _dirty
+    if _started_pid != os.getpid():
+        return
+    with _cond:
+        _dirty = True
+        _cond.notify()
+
+
+def subscribe(address=None, loop=None):
+    """
+    Registra un cliente y le deja preparado el estado actual (top y su puesto).
+    Lanza TooManyClients si el worker está lleno.
+    """
+    _ensure_hub()
+    with _lock:
+        if len(_subscribers) >= MAX_CLIENTS:
+            _stats['rejected'] += 1
+            raise TooManyClients(f'Máximo {MAX_CLIENTS} conexiones por worker')
+
+    subscriber = Subscriber(address, loop)
+    # Estado actual (el top del hub puede ser antiguo si no había clientes)
+    subscriber.push('top', _event('top', _current_top()))
+    if address:
+        rank_event = _rank_event(subscriber)
+        if rank_event is not None:
+            subscriber.push('rank', rank_event)
+
+    with _lock:
+        _subscribers.add(subscriber)
+        _stats['connected'] += 1
+    return subscriber
+
+
+def unsubscribe(subscriber):
+    with _lock:
+        _subscribers.discard(subscriber)
+
+
+def stream(subscriber):
+    """
+    Generador con el cuerpo de la respuesta SSE (servidores WSGI).
+    """
+    try:
+        yield f'retry: {RETRY_MS}\n\n'.encode('utf-8')
+        while True:
+            chunk = subscriber.take()
+            if chunk:
+                yield chunk
+                continue
+            subscriber.wait(KEEPALIVE_SECONDS)
+            chunk = subscriber.take()
+            yield chunk or _KEEPALIVE
+    finally:
+        unsubscribe(subscriber)
+
+
+async def stream_async(subscriber):
+    """
+    Igual que stream(), como generador asíncrono (modo ASGI).
+    """
+    try:
+        yield f'retry: {RETRY_MS}\n\n'.encode('utf-8')
+        while True:
+            chunk = subscriber.take()
+            if chunk:
+                yield chunk
+                continue
+            await subscriber.wait_async(KEEPALIVE_SECONDS)
+            chunk = subscriber.take()
+            yield chunk or _KEEPALIVE
+    finally:
+        unsubscribe(subscriber)
+
+
+def stats():
+    with _lock:
+        stats = dict(_stats)
+        stats['subscribers'] = len(_subscribers)
+    return stats
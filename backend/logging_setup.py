@@ -0,0 +1,183 @@
+import os
+import sys
+import json
+import queue
+import atexit
+import itertools
+import threading
+import logging
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+"""
+Configuración del logging del backend.
+
+Los hilos de las peticiones solo meten el LogRecord en una cola en memoria;
+un hilo en segundo plano (QueueListener) lo formatea y lo escribe en stderr.
+Si la cola se llena, el registro se descarta (y se cuenta) en lugar de
+bloquear la petición.
+
+Variables de entorno:
+  LOG_LEVEL              nivel global (por defecto INFO)
+  LOG_LEVELS             niveles por logger: "backend.routes.auth=DEBUG,werkzeug=WARNING"
+  LOG_FORMAT             json (por defecto) o text
+  LOG_QUEUE_SIZE         registros pendientes como máximo (por defecto 10000)
+  LOG_DEBUG_SAMPLE_EVERY se escribe 1 de cada N mensajes DEBUG iguales (por defecto 1: todos)
+
+El mensaje se formatea en el hilo de escritura, así que los argumentos de un
+logger.debug('...%s', objeto) no deben modificarse después de registrarlo.
+"""
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_LEVELS = os.getenv('LOG_LEVELS', '')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+DEBUG_SAMPLE_EVERY = int(os.getenv('LOG_DEBUG_SAMPLE_EVERY', '1'))
+
+# Atributos propios de LogRecord; el resto son campos pasados con extra={...}
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_lock = threading.Lock()
+_handler = None
+_stats = {'dropped': 0, 'sampled_out': 0}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Un objeto JSON por línea: ts, level, logger, msg, y los campos extra.
+    """
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'pid': record.process,
+            'thread': record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DebugSampler(logging.Filter):
+    """
+    Deja pasar 1 de cada `every` registros DEBUG con la misma plantilla de
+    mensaje (el primero siempre). Los demás niveles pasan todos.
+    """
+
+    def __init__(self, every):
+        super().__init__()
+        self.every = every
+        self._counters = {}
+
+    def filter(self, record):
+        if self.every <= 1 or record.levelno != logging.DEBUG:
+            return True
+        key = (record.name, record.msg)
+        counter = self._counters.get(key)
+        if counter is None:
+            counter = self._counters.setdefault(key, itertools.count())
+        if next(counter) % self.every == 0:
+            record.sample_every = self.every
+            return True
+        _stats['sampled_out'] += 1
+        return False
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    QueueHandler que nunca bloquea ni formatea en el hilo que registra, y que
+    arranca su hilo de escritura en cada proceso (también tras un fork).
+    """
+
+    def __init__(self, log_queue, target):
+        super().__init__(log_queue)
+        self.target = target
+        self._listener = None
+        self._listener_pid = None
+
+    def _ensure_listener(self):
+        if self._listener_pid == os.getpid():
+            return
+        with _lock:
+            if self._listener_pid == os.getpid():
+                return
+            # En un proceso hijo la cola heredada puede tener el lock tomado
+            self.queue = queue.Queue(LOG_QUEUE_SIZE)
+            self._listener = QueueListener(self.queue, self.target, respect_handler_level=True)
+            self._listener.start()
+            self._listener_pid = os.getpid()
+
+    def prepare(self, record):
+        # El listener vive en este mismo proceso: el formateo se deja para él
+        return record
+
+    def enqueue(self, record):
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _stats['dropped'] += 1
+
+    def stop(self):
+        if self._listener is not None and self._listener_pid == os.getpid():
+            self._listener.stop()
+            self._listener_pid = None
+
+
+def _parse_levels(spec):
+    levels = {}
+    for item in spec.split(','):
+        if '=' not in item:
+            continue
+        name, level = item.split('=', 1)
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure():
+    """
+    Instala el handler en cola en el logger raíz (idempotente).
+    """
+    global _handler
+    if _handler is not None:
+        return _handler
+
+    target = logging.StreamHandler(sys.stderr)
+    if LOG_FORMAT == 'text':
+        target.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s [%(process)d]: %(message)s'))
+    else:
+        target.setFormatter(JsonFormatter())
+
+    handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE), target)
+    handler.addFilter(DebugSampler(DEBUG_SAMPLE_EVERY))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+    for name, level in _parse_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+
+    # Vaciar la cola al terminar el proceso
+    atexit.register(handler.stop)
+    _handler = handler
+    return handler
+
+
+def stats():
+    """
+    Registros descartados por cola llena y por muestreo de DEBUG.
+    """
+    stats = dict(_stats)
+    if _handler is not None:
+        stats['pending'] = _handler.queue.qsize()
+    return stats
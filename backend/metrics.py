@@ -0,0 +1,276 @@
+import os
+import json
+import time
+import atexit
+import threading
+import logging
+from urllib.parse import urlsplit
+from flask import Response, g, request
+from backend.db import DATA_DIR
+
+"""
+Métricas del backend en formato de texto de Prometheus (GET /metrics).
+
+Cada worker de gunicorn acumula sus contadores e histogramas en memoria y los
+vuelca cada METRICS_FLUSH_SECONDS a un fichero propio (<pid>.json) dentro de
+METRICS_DIR. /metrics suma los ficheros de todos los workers, de modo que da
+igual qué worker atienda la petición. Los ficheros de workers ya terminados
+se siguen sumando para que los contadores no retrocedan; conviene vaciar
+METRICS_DIR al desplegar.
+
+Métricas:
+  http_requests_total{method, blueprint, route, status}
+  http_request_errors_total{method, blueprint, route}      (respuestas 5xx)
+  http_request_duration_seconds{method, blueprint, route}  (histograma)
+  pi_upstream_requests_total{method, endpoint, status}     (status: código, timeout o error)
+  pi_upstream_timeouts_total{method, endpoint}
+  pi_upstream_duration_seconds{method, endpoint}           (histograma)
+  pi_upstream_retries_total{family}
+  pi_upstream_short_circuits_total{family}                 (circuito abierto)
+"""
+
+logger = logging.getLogger(__name__)
+
+METRICS_DIR = os.getenv('METRICS_DIR', os.path.join(DATA_DIR, 'metrics'))
+FLUSH_SECONDS = float(os.getenv('METRICS_FLUSH_SECONDS', '1.0'))
+
+# Límites superiores (segundos) de los buckets de latencia
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HELP = {
+    'http_requests_total': ('counter', 'Peticiones HTTP atendidas'),
+    'http_request_errors_total': ('counter', 'Peticiones HTTP que terminaron en 5xx'),
+    'http_request_duration_seconds': ('histogram', 'Latencia de las peticiones HTTP'),
+    'pi_upstream_requests_total': ('counter', 'Llamadas a la API de Pi'),
+    'pi_upstream_timeouts_total': ('counter', 'Llamadas a la API de Pi que agotaron el timeout'),
+    'pi_upstream_duration_seconds': ('histogram', 'Latencia de las llamadas a la API de Pi'),
+    'pi_upstream_retries_total': ('counter', 'Reintentos de llamadas idempotentes a la API de Pi'),
+    'pi_upstream_short_circuits_total': ('counter', 'Llamadas rechazadas por un circuito abierto'),
+    'admission_rejected_total': ('counter', 'Peticiones o llamadas a la API rechazadas por el control de admisión'),
+    'admission_queue_wait_seconds': ('histogram', 'Espera de un slot libre para llamar a la API de Pi'),
+    'worker_time_to_ready_seconds': ('histogram', 'Tiempo desde el arranque del worker hasta estar listo'),
+}
+
+_lock = threading.Lock()
+# (nombre, etiquetas) -> valor
+_counters = {}
+# (nombre, etiquetas) -> [cuenta por bucket..., +Inf, suma]
+_histograms = {}
+_started_pid = None
+
+
+def inc(name, labels, value=1):
+    """
+    Suma `value` al contador `name` con las etiquetas dadas (tupla de pares).
+    """
+    _ensure_flusher()
+    with _lock:
+        key = (name, labels)
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, labels, seconds):
+    """
+    Registra una muestra de latencia en el histograma `name`.
+    """
+    _ensure_flusher()
+    with _lock:
+        key = (name, labels)
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                hist[i] += 1
+                break
+        else:
+            hist[len(LATENCY_BUCKETS)] += 1
+        hist[-1] += seconds
+
+
+# -----------------------------
+# Llamadas a la API de Pi
+# -----------------------------
+def upstream_endpoint(url):
+    """
+    Etiqueta de baja cardinalidad para una URL: host y ruta con los
+    identificadores (paymentId, txid...) sustituidos por :id.
+    """
+    parts = urlsplit(url)
+    segments = [
+        ':id' if len(seg) >= 8 and any(c.isdigit() for c in seg) else seg
+        for seg in parts.path.split('/') if seg
+    ]
+    return f"{parts.hostname}/{'/'.join(segments)}"
+
+
+def record_upstream(method, url, status, seconds):
+    """
+    Registra una llamada a la API de Pi; `status` es el código HTTP,
+    'timeout' o 'error'.
+    """
+    endpoint = upstream_endpoint(url)
+    labels = (('method', method), ('endpoint', endpoint))
+    inc('pi_upstream_requests_total', labels + (('status', str(status)),))
+    if status == 'timeout':
+        inc('pi_upstream_timeouts_total', labels)
+    observe('pi_upstream_duration_seconds', labels, seconds)
+
+
+# -----------------------------
+# Peticiones HTTP de Flask
+# -----------------------------
+def _before_request():
+    g.metrics_started = time.perf_counter()
+
+
+def _after_request(response):
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return response
+    # La regla (/api/game/dribble/rank/<address>) y no la URL, para no crear una serie por dirección
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    labels = (('method', request.method), ('blueprint', request.blueprint or 'app'), ('route', route))
+    inc('http_requests_total', labels + (('status', str(response.status_code)),))
+    if response.status_code >= 500:
+        inc('http_request_errors_total', labels)
+    observe('http_request_duration_seconds', labels, time.perf_counter() - started)
+    return response
+
+
+def init_app(app):
+    """
+    Instala los hooks de medición y la ruta /metrics en la aplicación.
+    """
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_endpoint, methods=['GET'])
+
+
+def metrics_endpoint():
+    _write_snapshot()
+    return Response(render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+# -----------------------------
+# Agregación entre workers
+# -----------------------------
+def _snapshot():
+    with _lock:
+        return {
+            'counters': [[name, list(labels), value] for (name, labels), value in _counters.items()],
+            'histograms': [[name, list(labels), list(hist)] for (name, labels), hist in _histograms.items()],
+        }
+
+
+def _write_snapshot():
+    """
+    Vuelca las métricas de este worker a su fichero (escritura atómica).
+    """
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f'{os.getpid()}.json')
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(_snapshot(), f)
+    os.replace(tmp_path, path)
+
+
+def collect():
+    """
+    Suma las métricas de todos los ficheros de METRICS_DIR.
+    Devuelve (counters, histograms) con las mismas claves que en memoria.
+    """
+    counters = {}
+    histograms = {}
+    try:
+        names = os.listdir(METRICS_DIR)
+    except FileNotFoundError:
+        names = []
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, name)) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            logger.warning('Fichero de métricas ilegible: %s', name)
+            continue
+        for metric, labels, value in snapshot['counters']:
+            key = (metric, tuple(tuple(pair) for pair in labels))
+            counters[key] = counters.get(key, 0) + value
+        for metric, labels, hist in snapshot['histograms']:
+            key = (metric, tuple(tuple(pair) for pair in labels))
+            total = histograms.get(key)
+            histograms[key] = hist if total is None else [a + b for a, b in zip(total, hist)]
+    return counters, histograms
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels) + '}'
+
+
+def render():
+    """
+    Texto en formato de exposición de Prometheus con las métricas de todos los workers.
+    """
+    counters, histograms = collect()
+    lines = []
+    for metric, (kind, help_text) in HELP.items():
+        lines.append(f'# HELP {metric} {help_text}')
+        lines.append(f'# TYPE {metric} {kind}')
+        if kind == 'counter':
+            for (name, labels), value in sorted(counters.items()):
+                if name == metric:
+                    lines.append(f'{metric}{_format_labels(labels)} {value}')
+            continue
+        for (name, labels), hist in sorted(histograms.items()):
+            if name != metric:
+                continue
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), hist[:-1]):
+                cumulative += count
+                lines.append(f'{metric}_bucket{_format_labels(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{metric}_sum{_format_labels(labels)} {hist[-1]}')
+            lines.append(f'{metric}_count{_format_labels(labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+def _flusher_loop():
+    while True:
+        time.sleep(FLUSH_SECONDS)
+        try:
+            _write_snapshot()
+        except OSError:
+            logger.exception('Error guardando las métricas')
+
+
+def _ensure_flusher():
+    """
+    Arranca el hilo que vuelca las métricas (una vez por proceso, también tras un fork).
+    """
+    global _started_pid, _counters, _histograms
+    if _started_pid == os.getpid():
+        return
+    with _lock:
+        if _started_pid == os.getpid():
+            return
+        if _started_pid is not None:
+            # Proceso hijo: no heredar (y duplicar) lo medido por el padre
+            _counters = {}
+            _histograms = {}
+        threading.Thread(target=_flusher_loop, name='metrics-flusher', daemon=True).start()
+        _started_pid = os.getpid()
+
+
+def _flush_at_exit():
+    if _started_pid == os.getpid():
+        _write_snapshot()
+
+
+atexit.register(_flush_at_exit)
@@ -0,0 +1,255 @@
+import os
+import json
+import time
+import uuid
+import random
+import threading
+import logging
+import requests
+from backend.db import get_connection, transaction
+
+"""
+Cola persistente de trabajos de pago (aprobar / completar) en SQLite.
+Las rutas encolan el trabajo y responden de inmediato con un jobId; un pool
+de hilos en segundo plano hace la llamada a la API de Pi Network y guarda el
+resultado, que se consulta en /api/payments/status/<jobId>. Los trabajos
+sobreviven a reinicios: los que quedaron a medias se vuelven a encolar.
+"""
+
+logger = logging.getLogger(__name__)
+
+DB_NAME = 'payment_jobs'
+
+# Hilos de trabajo por proceso
+WORKERS = int(os.getenv('PAYMENT_JOBS_WORKERS', '4'))
+# Máximo de trabajos pendientes (en cola o en curso) antes de rechazar nuevos
+MAX_PENDING = int(os.getenv('PAYMENT_JOBS_MAX_PENDING', '1000'))
+# Intentos máximos ante errores transitorios (red, timeout, 5xx)
+MAX_ATTEMPTS = int(os.getenv('PAYMENT_JOBS_MAX_ATTEMPTS', '5'))
+# Segundos tras los que un trabajo 'running' sin terminar se considera abandonado
+LEASE_SECONDS = float(os.getenv('PAYMENT_JOBS_LEASE_SECONDS', '120'))
+# Intervalo de sondeo de la cola (trabajos de otros workers y reintentos)
+POLL_INTERVAL = float(os.getenv('PAYMENT_JOBS_POLL_INTERVAL', '1.0'))
+
+# Acciones registradas: nombre -> función(payment_id, txid) que devuelve el cuerpo JSON
+_handlers = {}
+
+_start_lock = threading.Lock()
+_started_pid = None
+_wakeup = threading.Condition()
+
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+
+class QueueFull(Exception):
+    """
+    La cola alcanzó MAX_PENDING trabajos pendientes.
+    """
+
+
+def register_action(name, handler):
+    """
+    Registra la función que ejecuta los trabajos de tipo `name`.
+    """
+    _handlers[name] = handler
+
+
+def _connection():
+    global _schema_ready
+    conn = get_connection(DB_NAME)
+    if not _schema_ready:
+        with _schema_lock:
+            if not _schema_ready:
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS jobs (
+                        id              TEXT PRIMARY KEY,
+                        action          TEXT NOT NULL,
+                        payment_id      TEXT NOT NULL,
+                        txid            TEXT,
+                        status          TEXT NOT NULL,
+                        attempts        INTEGER NOT NULL DEFAULT 0,
+                        result          TEXT,
+                        error           TEXT,
+                        created_at      REAL NOT NULL,
+                        updated_at      REAL NOT NULL,
+                        next_attempt_at REAL NOT NULL
+                    )
+                ''')
+                conn.execute('CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, next_attempt_at)')
+                conn.execute('CREATE INDEX IF NOT EXISTS jobs_payment ON jobs (payment_id, action, status)')
+                _schema_ready = True
+    return conn
+
+
+def _row_to_dict(row):
+    return {
+        'jobId': row['id'],
+        'action': row['action'],
+        'paymentId': row['payment_id'],
+        'txid': row['txid'],
+        'status': row['status'],
+        'attempts': row['attempts'],
+        'result': json.loads(row['result']) if row['result'] else None,
+        'error': row['error'],
+        'createdAt': row['created_at'],
+        'updatedAt': row['updated_at'],
+    }
+
+
+def enqueue(action, payment_id, txid=None):
+    """
+    Encola un trabajo y devuelve su estado. Si ya hay uno pendiente para el
+    mismo pago y acción, devuelve ese en lugar de crear un duplicado.
+    Lanza QueueFull si hay demasiados trabajos pendientes.
+    """
+    if action not in _handlers:
+        raise ValueError(f'Acción de pago desconocida: {action}')
+    _ensure_workers()
+    conn = _connection()
+    now = time.time()
+    with transaction(conn):
+        existing = conn.execute(
+            "SELECT * FROM jobs WHERE payment_id = ? AND action = ? AND status IN ('queued', 'running')",
+            (payment_id, action)
+        ).fetchone()
+        if existing:
+            return _row_to_dict(existing)
+        pending = conn.execute(
+            "SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')"
+        ).fetchone()[0]
+        if pending >= MAX_PENDING:
+            raise QueueFull(f'Cola de pagos llena ({pending} trabajos pendientes)')
+        job_id = uuid.uuid4().hex
+        conn.execute(
+            '''
+            INSERT INTO jobs (id, action, payment_id, txid, status, created_at, updated_at, next_attempt_at)
+            VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)
+            ''',
+            (job_id, action, payment_id, txid, now, now, now)
+        )
+        row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    with _wakeup:
+        _wakeup.notify()
+    return _row_to_dict(row)
+
+
+def get_job(job_id):
+    """
+    Estado de un trabajo, o None si no existe.
+    """
+    row = _connection().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    return _row_to_dict(row) if row else None
+
+
+def _claim_next():
+    """
+    Toma el siguiente trabajo listo (o abandonado) y lo marca como 'running'.
+    """
+    conn = _connection()
+    now = time.time()
+    with transaction(conn):
+        row = conn.execute(
+            '''
+            SELECT * FROM jobs
+            WHERE (status = 'queued' AND next_attempt_at <= ?)
+               OR (status = 'running' AND updated_at <= ?)
+            ORDER BY next_attempt_at
+            LIMIT 1
+            ''',
+            (now, now - LEASE_SECONDS)
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute(
+            "UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ? WHERE id = ?",
+            (now, row['id'])
+        )
+    return row
+
+
+def _is_transient(error):
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    return False
+
+
+def _finish(job_id, status, result=None, error=None, retry_at=None):
+    conn = _connection()
+    now = time.time()
+    with transaction(conn):
+        conn.execute(
+            '''
+            UPDATE jobs SET status = ?, result = ?, error = ?, updated_at = ?,
+                            next_attempt_at = COALESCE(?, next_attempt_at)
+            WHERE id = ?
+            ''',
+            (status, json.dumps(result) if result is not None else None, error, now, retry_at, job_id)
+        )
+
+
+def _run_job(row):
+    attempts = row['attempts'] + 1
+    handler = _handlers.get(row['action'])
+    if handler is None:
+        _finish(row['id'], 'failed', error=f"Acción desconocida: {row['action']}")
+        return
+    try:
+        result = handler(row['payment_id'], row['txid'])
+    except Exception as e:
+        if _is_transient(e) and attempts < MAX_ATTEMPTS:
+            # Backoff exponencial con jitter, máximo 60 s
+            delay = min(60, 2 ** attempts) * random.uniform(0.5, 1.0)
+            # Con el circuito abierto no tiene sentido reintentar antes de que se pruebe de nuevo
+            delay = max(delay, getattr(e, 'retry_after', 0))
+            logger.warning('Trabajo %s falló (intento %s), reintento en %.1fs: %s', row['id'], attempts, delay, e)
+            _finish(row['id'], 'queued', error=str(e), retry_at=time.time() + delay)
+        else:
+            logger.error('Trabajo %s falló definitivamente: %s', row['id'], e)
+            _finish(row['id'], 'failed', error=str(e))
+        return
+    _finish(row['id'], 'succeeded', result=result)
+
+
+def _worker_loop():
+    while True:
+        try:
+            row = _claim_next()
+        except Exception:
+            logger.exception('Error leyendo la cola de pagos')
+            row = None
+        if row is None:
+            with _wakeup:
+                _wakeup.wait(POLL_INTERVAL)
+            continue
+        # Si falla hasta el registro del resultado, el trabajo sigue 'running' y
+        # se vuelve a tomar al caducar su lease: el hilo no debe morir
+        try:
+            _run_job(row)
+        except Exception:
+            logger.exception('Error ejecutando el trabajo de pago %s', row['id'])
+
+
+def _ensure_workers():
+    """
+    Arranca los hilos de trabajo en este proceso (una vez, también tras un fork).
+    """
+    global _started_pid
+    if _started_pid == os.getpid():
+        return
+    with _start_lock:
+        if _started_pid == os.getpid():
+            return
+        for i in range(WORKERS):
+            threading.Thread(target=_worker_loop, name=f'payment-job-{i}', daemon=True).start()
+        _started_pid = os.getpid()
+        logger.info('Iniciados %s hilos de trabajos de pago', WORKERS)
+
+
+def start():
+    """
+    Arranca los workers para retomar trabajos pendientes tras un reinicio.
+    """
+    _ensure_workers()
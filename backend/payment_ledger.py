@@ -0,0 +1,263 @@
+import os
+import json
+import time
+import random
+import asyncio
+import threading
+import logging
+from backend.cache import TTLCache, SingleFlight
+from backend.db import get_connection, transaction
+
+"""
+Registro de idempotencia de las operaciones de pago (aprobar / completar).
+
+La clave es la acción y el paymentId: cada pago se aprueba y se completa
+una sola vez, venga la repetición con la cabecera Idempotency-Key que sea.
+Esa cabecera solo sirve para comprobar que una repetición corresponde a la
+petición original: si las dos la traen y no coinciden se rechaza
+(IdempotencyMismatch). Cuando la operación termina bien se guarda el cuerpo
+de la respuesta: las repeticiones lo devuelven desde memoria o SQLite sin
+volver a llamar a la API de Pi Network.
+
+Mientras la primera llamada está en curso, las duplicadas esperan a su
+resultado: en el mismo proceso con SingleFlight, entre workers con una fila
+'pending' con lease en la base de datos. Si la llamada falla la fila se
+borra y la siguiente petición lo vuelve a intentar (solo se guardan éxitos).
+"""
+
+logger = logging.getLogger(__name__)
+
+DB_NAME = 'payments'
+
+# Días que se conservan los resultados
+RETENTION_SECONDS = float(os.getenv('PAYMENTS_IDEMPOTENCY_RETENTION_DAYS', '7')) * 86400
+# Segundos tras los que una llamada 'pending' sin terminar se da por abandonada
+LEASE_SECONDS = float(os.getenv('PAYMENTS_IDEMPOTENCY_LEASE_SECONDS', '60'))
+# Intervalo de sondeo mientras otro worker tiene la llamada en curso
+WAIT_POLL_SECONDS = 0.05
+MEMORY_MAX_ENTRIES = int(os.getenv('PAYMENTS_IDEMPOTENCY_MEMORY_ENTRIES', '10000'))
+
+_memory = TTLCache(MEMORY_MAX_ENTRIES, RETENTION_SECONDS)
+_flight = SingleFlight()
+# Equivalente de _flight para el modo ASGI: clave -> tarea en curso
+_async_flights = {}
+
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+_stats = {'replayed': 0, 'waited': 0, 'executed': 0, 'failed': 0, 'mismatched': 0}
+
+
+class IdempotencyMismatch(Exception):
+    """
+    La repetición de una operación trae una Idempotency-Key distinta de la original.
+    """
+
+
+def _connection():
+    global _schema_ready
+    conn = get_connection(DB_NAME)
+    if not _schema_ready:
+        with _schema_lock:
+            if not _schema_ready:
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS idempotency (
+                        key          TEXT PRIMARY KEY,
+                        status       TEXT NOT NULL,
+                        body         TEXT,
+                        lease_until  REAL NOT NULL,
+                        created_at   REAL NOT NULL,
+                        updated_at   REAL NOT NULL
+                    )
+                ''')
+                # Bases creadas cuando la cabecera formaba parte de la clave
+                columns = [row['name'] for row in conn.execute('PRAGMA table_info(idempotency)')]
+                if 'idempotency_key' not in columns:
+                    conn.execute('ALTER TABLE idempotency ADD COLUMN idempotency_key TEXT')
+                conn.execute('CREATE INDEX IF NOT EXISTS idempotency_updated ON idempotency (updated_at)')
+                _schema_ready = True
+    return conn
+
+
+def ledger_key(action, payment_id):
+    return f'{action}:{payment_id}'
+
+
+def _check(key, original, idempotency_key):
+    """
+    Lanza IdempotencyMismatch si la repetición y la original traen claves distintas.
+    """
+    if original and idempotency_key and original != idempotency_key:
+        _stats['mismatched'] += 1
+        raise IdempotencyMismatch(
+            f'La operación {key} ya se hizo con otra Idempotency-Key'
+        )
+
+
+def lookup(key):
+    """
+    (cuerpo, Idempotency-Key original) guardados para `key`, o None si la
+    operación no terminó bien todavía.
+    """
+    result = _memory.get(key)
+    if result is not None:
+        return result
+    row = _connection().execute(
+        "SELECT body, idempotency_key FROM idempotency WHERE key = ? AND status = 'done'", (key,)
+    ).fetchone()
+    if row is None:
+        return None
+    result = json.loads(row['body']), row['idempotency_key']
+    _memory.set(key, result)
+    return result
+
+
+def _claim(key, idempotency_key):
+    """
+    Intenta quedarse con la llamada. Devuelve ('done', (body, clave original))
+    si ya terminó, ('busy', None) si otro worker la tiene en curso o
+    ('claimed', None).
+    """
+    conn = _connection()
+    now = time.time()
+    with transaction(conn):
+        row = conn.execute(
+            'SELECT status, body, idempotency_key, lease_until FROM idempotency WHERE key = ?', (key,)
+        ).fetchone()
+        if row is not None and row['status'] == 'done':
+            return 'done', (json.loads(row['body']), row['idempotency_key'])
+        if row is not None and row['lease_until'] > now:
+            return 'busy', None
+        conn.execute(
+            '''
+            INSERT OR REPLACE INTO idempotency
+                (key, status, body, idempotency_key, lease_until, created_at, updated_at)
+            VALUES (?, 'pending', NULL, ?, ?, ?, ?)
+            ''',
+            (key, idempotency_key, now + LEASE_SECONDS, now, now)
+        )
+        # De vez en cuando, limpiar resultados antiguos
+        if random.random() < 0.01:
+            conn.execute('DELETE FROM idempotency WHERE updated_at < ?', (now - RETENTION_SECONDS,))
+    return 'claimed', None
+
+
+def _finish(key, body, idempotency_key):
+    conn = _connection()
+    now = time.time()
+    with transaction(conn):
+        conn.execute(
+            "UPDATE idempotency SET status = 'done', body = ?, updated_at = ? WHERE key = ?",
+            (json.dumps(body), now, key)
+        )
+    _memory.set(key, (body, idempotency_key))
+    _stats['executed'] += 1
+
+
+def _release(key):
+    conn = _connection()
+    with transaction(conn):
+        conn.execute("DELETE FROM idempotency WHERE key = ? AND status = 'pending'", (key,))
+    _stats['failed'] += 1
+
+
+def _run_once(key, fn, idempotency_key):
+    """
+    Devuelve (body, repetido, Idempotency-Key de quien hizo la llamada).
+    """
+    while True:
+        state, result = _claim(key, idempotency_key)
+        if state == 'done':
+            _memory.set(key, result)
+            return result[0], True, result[1]
+        if state == 'claimed':
+            break
+        # Otro worker la tiene en curso: esperar su resultado (o a que caduque su lease)
+        _stats['waited'] += 1
+        time.sleep(WAIT_POLL_SECONDS)
+
+    try:
+        body = fn()
+    except BaseException:
+        _release(key)
+        raise
+    _finish(key, body, idempotency_key)
+    return body, False, idempotency_key
+
+
+def run(key, fn, idempotency_key=None):
+    """
+    Ejecuta `fn()` (que devuelve el cuerpo JSON de la respuesta) una sola vez
+    por clave. Devuelve (body, replayed); las excepciones de `fn` se propagan
+    a todas las llamadas que la esperaban. Lanza IdempotencyMismatch si es una
+    repetición con otra Idempotency-Key.
+    """
+    result = lookup(key)
+    if result is not None:
+        _check(key, result[1], idempotency_key)
+        _stats['replayed'] += 1
+        return result[0], True
+    executed = []
+
+    def call():
+        executed.append(True)
+        return _run_once(key, fn, idempotency_key)
+
+    body, replayed, original = _flight.do(key, call)
+    # Quien esperó a otro hilo del proceso también recibe un resultado repetido
+    replayed = replayed or not executed
+    if replayed:
+        _check(key, original, idempotency_key)
+        _stats['replayed'] += 1
+    return body, replayed
+
+
+async def run_async(key, coro_fn, idempotency_key=None):
+    """
+    Versión asíncrona de run(): `coro_fn()` devuelve una corrutina.
+    """
+    result = lookup(key)
+    if result is not None:
+        _check(key, result[1], idempotency_key)
+        _stats['replayed'] += 1
+        return result[0], True
+
+    task = _async_flights.get(key)
+    if task is not None and task.get_loop() is asyncio.get_running_loop():
+        _stats['waited'] += 1
+        body, _, original = await asyncio.shield(task)
+        _check(key, original, idempotency_key)
+        return body, True
+
+    async def execute():
+        try:
+            while True:
+                state, result = _claim(key, idempotency_key)
+                if state == 'done':
+                    _memory.set(key, result)
+                    return result[0], True, result[1]
+                if state == 'claimed':
+                    break
+                _stats['waited'] += 1
+                await asyncio.sleep(WAIT_POLL_SECONDS)
+            try:
+                body = await coro_fn()
+            except BaseException:
+                _release(key)
+                raise
+            _finish(key, body, idempotency_key)
+            return body, False, idempotency_key
+        finally:
+            if _async_flights.get(key) is task:
+                del _async_flights[key]
+
+    task = _async_flights[key] = asyncio.ensure_future(execute())
+    body, replayed, original = await asyncio.shield(task)
+    if replayed:
+        _check(key, original, idempotency_key)
+        _stats['replayed'] += 1
+    return body, replayed
+
+
+def stats():
+    return {**_stats, 'memory': _memory.stats(), 'single_flight_shared': _flight.shared}
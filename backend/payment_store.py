@@ -0,0 +1,254 @@
+import os
+import json
+import time
+import random
+import threading
+import logging
+from backend.db import get_connection, transaction
+
+"""
+Estado local de los pagos (SQLite), indexado por usuario.
+
+Las rutas de aprobar / completar / cancelar guardan aquí el pago que
+devuelve la API de Pi Network en cada paso, y /api/payments/incomplete
+responde con los pagos abiertos del usuario sin llamar a la API.
+
+Un hilo en segundo plano (uno solo entre todos los workers, con un lease en
+la base de datos) consulta periódicamente en la API los pagos que siguen
+abiertos y actualiza su estado (completados o cancelados desde otro sitio).
+
+El estado solo avanza: created -> approved -> completed / cancelled.
+"""
+
+logger = logging.getLogger(__name__)
+
+DB_NAME = 'payments'
+
+# Segundos entre pasadas del reconciliador
+RECONCILE_INTERVAL = float(os.getenv('PAYMENTS_RECONCILE_INTERVAL', '60'))
+# Pagos abiertos consultados en la API por pasada
+RECONCILE_BATCH = int(os.getenv('PAYMENTS_RECONCILE_BATCH', '100'))
+# Un pago abierto no se consulta hasta que lleva este tiempo sin cambios
+RECONCILE_MIN_AGE = float(os.getenv('PAYMENTS_RECONCILE_MIN_AGE', '30'))
+
+# Orden del ciclo de vida; un estado no se sustituye por otro anterior
+_STATE_RANK = {'created': 0, 'approved': 1, 'completed': 2, 'cancelled': 2}
+
+# Función(payment_id) que devuelve el pago de la API (la registra routes/payments.py)
+_fetcher = None
+
+_start_lock = threading.Lock()
+_started_pid = None
+
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+_stats = {'reconciled': 0, 'reconcile_errors': 0}
+
+
+def register_fetcher(fetcher):
+    """
+    Registra la función con la que el reconciliador consulta un pago en la API.
+    """
+    global _fetcher
+    _fetcher = fetcher
+
+
+def _connection():
+    global _schema_ready
+    conn = get_connection(DB_NAME)
+    if not _schema_ready:
+        with _schema_lock:
+            if not _schema_ready:
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS payments (
+                        payment_id  TEXT PRIMARY KEY,
+                        uid         TEXT,
+                        status      TEXT NOT NULL,
+                        amount      REAL,
+                        memo        TEXT,
+                        txid        TEXT,
+                        payload     TEXT,
+                        created_at  REAL NOT NULL,
+                        updated_at  REAL NOT NULL,
+                        checked_at  REAL NOT NULL
+                    )
+                ''')
+                # Solo los pagos abiertos: el índice no crece con el histórico
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS payments_open ON payments (uid) "
+                    "WHERE status IN ('created', 'approved')"
+                )
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS payments_to_check ON payments (checked_at) "
+                    "WHERE status IN ('created', 'approved')"
+                )
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS payments_meta (
+                        key   TEXT PRIMARY KEY,
+                        value REAL NOT NULL
+                    )
+                ''')
+                _schema_ready = True
+    return conn
+
+
+def state_of(payment):
+    """
+    Estado local que corresponde a un pago tal y como lo devuelve la API.
+    """
+    status = payment.get('status') or {}
+    if status.get('cancelled') or status.get('user_cancelled'):
+        return 'cancelled'
+    if status.get('developer_completed'):
+        return 'completed'
+    if status.get('developer_approved'):
+        return 'approved'
+    return 'created'
+
+
+def _row_to_dict(row):
+    return {
+        'paymentId': row['payment_id'],
+        'uid': row['uid'],
+        'status': row['status'],
+        'amount': row['amount'],
+        'memo': row['memo'],
+        'txid': row['txid'],
+        'createdAt': row['created_at'],
+        'updatedAt': row['updated_at'],
+    }
+
+
+def record(payment_id, status, payment=None, txid=None):
+    """
+    Guarda el nuevo estado de un pago. `payment` es el cuerpo devuelto por la
+    API (si lo hay) y aporta el usuario, el importe y la transacción.
+    Si el pago ya estaba en un estado posterior, solo se completan los datos.
+    """
+    payment = payment if isinstance(payment, dict) else {}
+    transaction_data = payment.get('transaction') or {}
+    txid = txid or transaction_data.get('txid')
+    if payment and _STATE_RANK[state_of(payment)] > _STATE_RANK[status]:
+        status = state_of(payment)
+    now = time.time()
+    conn = _connection()
+    with transaction(conn):
+        row = conn.execute('SELECT status FROM payments WHERE payment_id = ?', (payment_id,)).fetchone()
+        if row is not None and _STATE_RANK[status] < _STATE_RANK[row['status']]:
+            status = row['status']
+        conn.execute(
+            '''
+            INSERT INTO payments (payment_id, uid, status, amount, memo, txid, payload,
+                                  created_at, updated_at, checked_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(payment_id) DO UPDATE SET
+                uid        = COALESCE(excluded.uid, uid),
+                status     = excluded.status,
+                amount     = COALESCE(excluded.amount, amount),
+                memo       = COALESCE(excluded.memo, memo),
+                txid       = COALESCE(excluded.txid, txid),
+                payload    = COALESCE(excluded.payload, payload),
+                updated_at = CASE WHEN excluded.status != status THEN excluded.updated_at ELSE updated_at END,
+                checked_at = excluded.checked_at
+            ''',
+            (
+                payment_id, payment.get('user_uid'), status, payment.get('amount'), payment.get('memo'),
+                txid, json.dumps(payment) if payment else None, now, now, now
+            )
+        )
+
+
+def get_payment(payment_id):
+    row = _connection().execute('SELECT * FROM payments WHERE payment_id = ?', (payment_id,)).fetchone()
+    return _row_to_dict(row) if row else None
+
+
+def open_payments(uid):
+    """
+    Pagos sin completar ni cancelar del usuario (consulta por índice, sin red).
+    """
+    rows = _connection().execute(
+        "SELECT * FROM payments WHERE uid = ? AND status IN ('created', 'approved') ORDER BY created_at",
+        (uid,)
+    ).fetchall()
+    return [_row_to_dict(row) for row in rows]
+
+
+def _claim_reconcile_lease():
+    """
+    True si este proceso hace la pasada de ahora (una por intervalo entre todos los workers).
+    """
+    conn = _connection()
+    now = time.time()
+    with transaction(conn):
+        row = conn.execute("SELECT value FROM payments_meta WHERE key = 'reconcile_until'").fetchone()
+        if row is not None and row['value'] > now:
+            return False
+        conn.execute(
+            "INSERT OR REPLACE INTO payments_meta (key, value) VALUES ('reconcile_until', ?)",
+            (now + RECONCILE_INTERVAL,)
+        )
+    return True
+
+
+def reconcile_once():
+    """
+    Consulta en la API los pagos abiertos más antiguos y actualiza su estado.
+    Devuelve cuántos pagos se consultaron.
+    """
+    if _fetcher is None:
+        return 0
+    rows = _connection().execute(
+        "SELECT payment_id FROM payments WHERE status IN ('created', 'approved') AND checked_at <= ? "
+        "ORDER BY checked_at LIMIT ?",
+        (time.time() - RECONCILE_MIN_AGE, RECONCILE_BATCH)
+    ).fetchall()
+    for row in rows:
+        payment_id = row['payment_id']
+        try:
+            payment = _fetcher(payment_id)
+        except Exception as e:
+            _stats['reconcile_errors'] += 1
+            logger.warning('No se pudo reconciliar el pago %s: %s', payment_id, e)
+            # Marcarlo como consultado para no atascar la pasada en el mismo pago
+            conn = _connection()
+            with transaction(conn):
+                conn.execute('UPDATE payments SET checked_at = ? WHERE payment_id = ?', (time.time(), payment_id))
+            continue
+        record(payment_id, state_of(payment), payment)
+        _stats['reconciled'] += 1
+    if rows:
+        logger.info('Reconciliados %s pagos abiertos con la API', len(rows))
+    return len(rows)
+
+
+def _reconcile_loop():
+    while True:
+        # Jitter para que los workers no compitan siempre a la vez por el lease
+        time.sleep(RECONCILE_INTERVAL * random.uniform(0.5, 1.0))
+        try:
+            if _claim_reconcile_lease():
+                reconcile_once()
+        except Exception:
+            logger.exception('Error reconciliando pagos')
+
+
+def start():
+    """
+    Arranca el reconciliador en este proceso (una vez, también tras un fork).
+    """
+    global _started_pid
+    if _started_pid == os.getpid() or RECONCILE_INTERVAL <= 0:
+        return
+    with _start_lock:
+        if _started_pid == os.getpid():
+            return
+        threading.Thread(target=_reconcile_loop, name='payments-reconciler', daemon=True).start()
+        _started_pid = os.getpid()
+
+
+def stats():
+    conn = _connection()
+    counts = dict(conn.execute('SELECT status, COUNT(*) FROM payments GROUP BY status').fetchall())
+    return {'by_status': counts, **_stats}
@@ -0,0 +1,292 @@
+import os
+import time
+import uuid
+import threading
+import logging
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+from backend.db import get_connection, transaction
+
+"""
+Motor de pagos de premios con libro de registro (ledger) en SQLite.
+Primero se guarda el plan completo de pagos; después se envían en paralelo
+con límite de ritmo, registrando el resultado de cada uno. Si el proceso se
+cae, se puede reanudar desde el ledger sin pagar dos veces a nadie.
+
+Estados de cada pago:
+  planned  -> pendiente de enviar
+  sending  -> marcado justo antes de llamar al envío
+  sent     -> el envío confirmó el pago
+  failed   -> el envío respondió que no se pagó (se reintenta al reanudar)
+  unknown  -> el envío lanzó una excepción o el proceso murió en 'sending':
+              no se sabe si se pagó, hay que conciliarlo a mano
+"""
+
+logger = logging.getLogger(__name__)
+
+DB_NAME = 'payouts'
+
+# Envíos simultáneos y envíos por segundo como máximo
+PAYOUT_CONCURRENCY = int(os.getenv('PAYOUT_CONCURRENCY', '8'))
+PAYOUT_RATE_PER_SEC = float(os.getenv('PAYOUT_RATE_PER_SEC', '5'))
+
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+
+def _connection():
+    global _schema_ready
+    conn = get_connection(DB_NAME)
+    if not _schema_ready:
+        with _schema_lock:
+            if not _schema_ready:
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS payout_runs (
+                        run_id     TEXT PRIMARY KEY,
+                        status     TEXT NOT NULL,
+                        pool       TEXT NOT NULL,
+                        entries    INTEGER NOT NULL,
+                        created_at REAL NOT NULL,
+                        closed_at  REAL,
+                        season     TEXT
+                    )
+                ''')
+                # Bases creadas antes de las temporadas del leaderboard
+                columns = [row['name'] for row in conn.execute('PRAGMA table_info(payout_runs)')]
+                if 'season' not in columns:
+                    conn.execute('ALTER TABLE payout_runs ADD COLUMN season TEXT')
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS payouts (
+                        run_id     TEXT NOT NULL,
+                        position   INTEGER NOT NULL,
+                        address    TEXT NOT NULL,
+                        amount     TEXT NOT NULL,
+                        status     TEXT NOT NULL,
+                        attempts   INTEGER NOT NULL DEFAULT 0,
+                        error      TEXT,
+                        updated_at REAL NOT NULL,
+                        PRIMARY KEY (run_id, position)
+                    )
+                ''')
+                conn.execute('CREATE INDEX IF NOT EXISTS payouts_status ON payouts (run_id, status)')
+                _schema_ready = True
+    return conn
+
+
+class RateLimiter:
+    """
+    Token bucket sencillo y seguro entre hilos: como mucho `rate` llamadas por segundo.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def wait(self):
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next, now)
+            self._next = slot + 1.0 / self.rate
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+def open_run():
+    """
+    Devuelve el run_id de la ejecución sin cerrar, si la hay.
+    """
+    row = _connection().execute(
+        "SELECT run_id FROM payout_runs WHERE status != 'closed' ORDER BY created_at LIMIT 1"
+    ).fetchone()
+    return row['run_id'] if row else None
+
+
+def create_run(plan, pool, entries, season=None):
+    """
+    Guarda el plan [(address, Decimal amount), ...] de la temporada `season`
+    en una sola transacción. Devuelve el run_id.
+    """
+    conn = _connection()
+    run_id = time.strftime('%Y%m%d-%H%M%S-') + uuid.uuid4().hex[:8]
+    now = time.time()
+    with transaction(conn):
+        if conn.execute("SELECT 1 FROM payout_runs WHERE status != 'closed'").fetchone():
+            raise RuntimeError('Ya hay una distribución sin cerrar; reanúdala antes de crear otra.')
+        conn.execute(
+            "INSERT INTO payout_runs (run_id, status, pool, entries, created_at, season) VALUES (?, 'open', ?, ?, ?, ?)",
+            (run_id, str(pool), entries, now, season)
+        )
+        conn.executemany(
+            "INSERT INTO payouts (run_id, position, address, amount, status, updated_at) VALUES (?, ?, ?, ?, 'planned', ?)",
+            [(run_id, position, address, str(amount), now) for position, (address, amount) in enumerate(plan)]
+        )
+    logger.info('Plan de pagos %s guardado: %s ganadores, pool %s', run_id, len(plan), pool)
+    return run_id
+
+
+def run_season(run_id):
+    """
+    Temporada del leaderboard que paga el run (None en runs anteriores a las temporadas).
+    """
+    row = _connection().execute('SELECT season FROM payout_runs WHERE run_id = ?', (run_id,)).fetchone()
+    return row['season'] if row else None
+
+
+def season_paid(season):
+    """
+    True si la temporada ya tiene una distribución cerrada.
+    """
+    row = _connection().execute(
+        "SELECT 1 FROM payout_runs WHERE season = ? AND status = 'closed'", (season,)
+    ).fetchone()
+    return row is not None
+
+
+def _set_status(run_id, position, status, error=None):
+    conn = _connection()
+    with transaction(conn):
+        conn.execute(
+            'UPDATE payouts SET status = ?, error = ?, updated_at = ? WHERE run_id = ? AND position = ?',
+            (status, error, time.time(), run_id, position)
+        )
+
+
+def _claim(run_id, position):
+    """
+    Pasa un pago de planned/failed a sending. Devuelve False si otro proceso ya lo tomó.
+    """
+    conn = _connection()
+    with transaction(conn):
+        cursor = conn.execute(
+            '''
+            UPDATE payouts SET status = 'sending', updated_at = ?, attempts = attempts + 1
+            WHERE run_id = ? AND position = ? AND status IN ('planned', 'failed')
+            ''',
+            (time.time(), run_id, position)
+        )
+        return cursor.rowcount == 1
+
+
+def execute_run(run_id, send, concurrency=None, rate=None):
+    """
+    Envía los pagos pendientes del run con `send(address, amount) -> bool`.
+    Los que quedaron en 'sending' de un intento anterior pasan a 'unknown'
+    y no se reenvían. Devuelve el resumen del run.
+    """
+    concurrency = concurrency or PAYOUT_CONCURRENCY
+    limiter = RateLimiter(PAYOUT_RATE_PER_SEC if rate is None else rate)
+    conn = _connection()
+
+    with transaction(conn):
+        stale = conn.execute(
+            "UPDATE payouts SET status = 'unknown', error = 'Interrumpido durante el envío', updated_at = ? "
+            "WHERE run_id = ? AND status = 'sending'",
+            (time.time(), run_id)
+        ).rowcount
+    if stale:
+        logger.warning('%s pagos del run %s quedaron a medias y requieren conciliación', stale, run_id)
+
+    pending = [
+        dict(row) for row in conn.execute(
+            "SELECT position, address, amount FROM payouts WHERE run_id = ? AND status IN ('planned', 'failed') ORDER BY position",
+            (run_id,)
+        )
+    ]
+
+    def pay(item):
+        limiter.wait()
+        if not _claim(run_id, item['position']):
+            return
+        try:
+            success = send(item['address'], float(Decimal(item['amount'])))
+        except Exception as e:
+            logger.error('Error enviando %s Pi a %s: %s', item['amount'], item['address'], e)
+            _set_status(run_id, item['position'], 'unknown', error=str(e))
+            return
+        _set_status(run_id, item['position'], 'sent' if success else 'failed',
+                    error=None if success else 'El envío devolvió fallo')
+        logger.info('Enviando %s Pi a %s: %s', item['amount'], item['address'], 'Éxito' if success else 'Fallo')
+
+    if pending:
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(pending))) as executor:
+            list(executor.map(pay, pending))
+
+    return run_summary(run_id)
+
+
+def run_summary(run_id):
+    """
+    Número de pagos por estado y total enviado del run.
+    """
+    conn = _connection()
+    counts = {
+        row['status']: row['n'] for row in conn.execute(
+            'SELECT status, COUNT(*) AS n FROM payouts WHERE run_id = ? GROUP BY status', (run_id,)
+        )
+    }
+    sent_total = sum(
+        (Decimal(row['amount']) for row in conn.execute(
+            "SELECT amount FROM payouts WHERE run_id = ? AND status = 'sent'", (run_id,)
+        )),
+        Decimal('0')
+    )
+    return {'run_id': run_id, 'counts': counts, 'sent_total': sent_total}
+
+
+def is_reconciled(run_id):
+    """
+    True si todos los pagos del run están confirmados como enviados.
+    """
+    row = _connection().execute(
+        "SELECT COUNT(*) FROM payouts WHERE run_id = ? AND status != 'sent'", (run_id,)
+    ).fetchone()
+    return row[0] == 0
+
+
+def unresolved_payouts(run_id):
+    """
+    Pagos en 'unknown' o 'failed' que impiden cerrar el run.
+    """
+    return [
+        dict(row) for row in _connection().execute(
+            "SELECT position, address, amount, status, attempts, error FROM payouts "
+            "WHERE run_id = ? AND status IN ('unknown', 'failed') ORDER BY position",
+            (run_id,)
+        )
+    ]
+
+
+def reconcile_payout(run_id, position, status):
+    """
+    Resolución manual de un pago tras comprobarlo en la blockchain:
+    'sent' si se pagó, 'failed' para que se reintente en la próxima reanudación.
+    """
+    if status not in ('sent', 'failed'):
+        raise ValueError("El estado de conciliación debe ser 'sent' o 'failed'")
+    conn = _connection()
+    with transaction(conn):
+        cursor = conn.execute(
+            "UPDATE payouts SET status = ?, error = 'Conciliado manualmente', updated_at = ? "
+            "WHERE run_id = ? AND position = ? AND status IN ('unknown', 'failed')",
+            (status, time.time(), run_id, position)
+        )
+        if cursor.rowcount != 1:
+            raise ValueError(f'Pago {position} del run {run_id} no está pendiente de conciliación')
+
+
+def close_run(run_id):
+    """
+    Marca el run como cerrado; solo se permite cuando está conciliado.
+    """
+    if not is_reconciled(run_id):
+        raise RuntimeError(f'El run {run_id} tiene pagos sin conciliar')
+    conn = _connection()
+    with transaction(conn):
+        conn.execute(
+            "UPDATE payout_runs SET status = 'closed', closed_at = ? WHERE run_id = ?",
+            (time.time(), run_id)
+        )
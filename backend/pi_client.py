@@ -0,0 +1,541 @@
+import os
+import math
+import asyncio
+import time
+import random
+import threading
+import logging
+from collections import deque
+from urllib.parse import urlsplit
+import requests
+from flask import jsonify
+from requests.adapters import HTTPAdapter
+from backend import metrics, admission, tracing
+
+try:
+    import httpx
+except ImportError:  # httpx solo hace falta en el modo ASGI (asgi.py)
+    httpx = None
+
+"""
+Cliente HTTP compartido para todas las llamadas a la API de Pi Network.
+Mantiene una sesión con conexiones keep-alive reutilizables por worker, de
+modo que el handshake TCP+TLS con api.minepi.com se paga una sola vez, y
+aplica un timeout a cada llamada. Cada llamada se registra en backend/metrics.py
+(latencia, código de respuesta y timeouts).
+
+Cada familia de endpoints (user, wallet, payments, horizon) tiene su propio
+circuit breaker: si en la ventana reciente fallan demasiadas llamadas (timeout,
+error de conexión, 5xx o 429) el circuito se abre y las llamadas fallan al
+instante con CircuitOpenError durante BREAKER_OPEN_SECONDS; después se deja
+pasar una sola llamada de prueba (half-open) que decide si se cierra o se
+vuelve a abrir. El timeout de lectura se adapta al p99 observado de cada
+familia, y solo las llamadas idempotentes (GET) se reintentan.
+
+Cada intento ocupa además un slot de backend/admission.py, que limita las
+llamadas simultáneas a la API entre todos los workers; si no hay slot a
+tiempo la llamada falla con UpstreamBusyError (sin contar como fallo de la
+familia en su circuit breaker).
+
+Cada llamada lleva el X-Request-ID de la petición en curso y se apunta como
+tramo pi_<familia> en su traza (backend/tracing.py).
+
+arequest() es la versión asíncrona (httpx) para el modo ASGI: comparte los
+circuit breakers, los timeouts adaptativos y las métricas, y lanza las mismas
+excepciones de requests para que las rutas traten los errores igual.
+"""
+
+logger = logging.getLogger(__name__)
+
+# Base URL de la API de Pi Network
+PI_API_BASE_URL = os.getenv('PI_API_BASE_URL', 'https://api.minepi.com/v2')
+
+# Tamaño del pool: número de hosts distintos y conexiones por host
+POOL_CONNECTIONS = int(os.getenv('PI_HTTP_POOL_CONNECTIONS', '4'))
+POOL_MAXSIZE = int(os.getenv('PI_HTTP_POOL_MAXSIZE', '20'))
+
+# Timeouts por defecto (segundos) para conectar y para leer la respuesta
+CONNECT_TIMEOUT = float(os.getenv('PI_HTTP_CONNECT_TIMEOUT', '3.05'))
+READ_TIMEOUT = float(os.getenv('PI_HTTP_READ_TIMEOUT', '10'))
+
+# Timeout de lectura adaptativo: p99 observado * multiplicador, entre el mínimo y READ_TIMEOUT
+MIN_READ_TIMEOUT = float(os.getenv('PI_HTTP_MIN_READ_TIMEOUT', '1.0'))
+TIMEOUT_P99_MULTIPLIER = float(os.getenv('PI_HTTP_TIMEOUT_P99_MULTIPLIER', '3'))
+LATENCY_SAMPLES = int(os.getenv('PI_HTTP_LATENCY_SAMPLES', '200'))
+TIMEOUT_MIN_SAMPLES = 20
+
+# Circuit breaker: ventana de observación, mínimo de llamadas y tasa de fallos que lo abren
+BREAKER_WINDOW_SECONDS = float(os.getenv('PI_BREAKER_WINDOW_SECONDS', '30'))
+BREAKER_MIN_CALLS = int(os.getenv('PI_BREAKER_MIN_CALLS', '10'))
+BREAKER_FAILURE_RATE = float(os.getenv('PI_BREAKER_FAILURE_RATE', '0.5'))
+BREAKER_OPEN_SECONDS = float(os.getenv('PI_BREAKER_OPEN_SECONDS', '15'))
+
+# Reintentos de llamadas idempotentes: backoff exponencial con jitter y tope
+RETRY_MAX = int(os.getenv('PI_HTTP_RETRY_MAX', '2'))
+RETRY_BACKOFF_BASE = float(os.getenv('PI_HTTP_RETRY_BACKOFF_BASE', '0.1'))
+RETRY_BACKOFF_CAP = float(os.getenv('PI_HTTP_RETRY_BACKOFF_CAP', '2.0'))
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS')
+RETRY_STATUSES = (429, 502, 503, 504)
+
+_lock = threading.Lock()
+_session = None
+_session_pid = None
+_stats = {'requests': 0, 'in_flight': 0, 'errors': 0}
+
+# Conexiones simultáneas del cliente asíncrono (un proceso ASGI puede tener miles en vuelo)
+ASYNC_MAX_CONNECTIONS = int(os.getenv('PI_HTTP_ASYNC_MAX_CONNECTIONS', '1000'))
+ASYNC_MAX_KEEPALIVE = int(os.getenv('PI_HTTP_ASYNC_MAX_KEEPALIVE', '100'))
+
+_async_client = None
+_async_client_loop = None
+
+
+def get_session():
+    """
+    Devuelve la sesión del proceso actual (se crea de nuevo tras un fork).
+    """
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        with _lock:
+            if _session is None or _session_pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+                _session_pid = os.getpid()
+    return _session
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """
+    El circuito de la familia está abierto: la llamada no se ha hecho.
+    """
+
+    def __init__(self, family, retry_after, message=None):
+        super().__init__(message or f'API de Pi no disponible ({family}); reintentar en {retry_after:.0f}s')
+        self.family = family
+        self.retry_after = retry_after
+
+
+class UpstreamBusyError(CircuitOpenError):
+    """
+    Ya hay demasiadas llamadas a la API en curso y la cola de espera está
+    llena: la llamada no se ha hecho. Las rutas la tratan como CircuitOpenError.
+    """
+
+    def __init__(self, family, retry_after):
+        super().__init__(
+            family, retry_after, f'Demasiadas llamadas simultáneas a la API de Pi ({family}); reintentar en {retry_after:.0f}s'
+        )
+
+
+def unavailable_response(error):
+    """
+    Respuesta 503 con Retry-After para una CircuitOpenError.
+    """
+    busy = isinstance(error, UpstreamBusyError)
+    response = jsonify({
+        'error': 'El servidor está saturado, inténtalo más tarde' if busy
+        else 'La API de Pi Network no está disponible en este momento, inténtalo más tarde',
+        'upstream': error.family,
+        'retryAfter': math.ceil(error.retry_after),
+    })
+    response.status_code = 503
+    response.headers['Retry-After'] = str(math.ceil(error.retry_after))
+    return response
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker por tasa de fallos en una ventana de tiempo, con una
+    llamada de prueba en half-open. También guarda las latencias recientes
+    para calcular el timeout adaptativo.
+    """
+
+    def __init__(self, family):
+        self.family = family
+        self.state = 'closed'
+        self._lock = threading.Lock()
+        # (instante, éxito) de las llamadas de la ventana
+        self._outcomes = deque()
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.stats = {'opened': 0, 'rejected': 0}
+
+    def before_call(self):
+        """
+        Lanza CircuitOpenError si la llamada no puede pasar. Devuelve True si
+        es la llamada de prueba del estado half-open.
+        """
+        with self._lock:
+            if self.state == 'open':
+                remaining = self._opened_at + BREAKER_OPEN_SECONDS - time.monotonic()
+                if remaining > 0:
+                    self._reject(remaining)
+                self.state = 'half_open'
+                self._probing = False
+            if self.state == 'half_open':
+                if self._probing:
+                    self._reject(1.0)
+                self._probing = True
+                return True
+            return False
+
+    def _reject(self, retry_after):
+        self.stats['rejected'] += 1
+        metrics.inc('pi_upstream_short_circuits_total', (('family', self.family),))
+        raise CircuitOpenError(self.family, retry_after)
+
+    def record(self, ok, seconds=None, probe=False):
+        with self._lock:
+            now = time.monotonic()
+            if ok and seconds is not None:
+                self._latencies.append(seconds)
+            if probe:
+                self._probing = False
+                if ok:
+                    logger.info('Circuito %s cerrado tras la llamada de prueba', self.family)
+                    self.state = 'closed'
+                    self._outcomes.clear()
+                    self._failures = 0
+                else:
+                    self._open(now)
+                return
+            if self.state != 'closed':
+                # Resultado de una llamada que empezó antes de abrirse el circuito
+                return
+            self._outcomes.append((now, ok))
+            if not ok:
+                self._failures += 1
+            while self._outcomes and self._outcomes[0][0] < now - BREAKER_WINDOW_SECONDS:
+                _, old_ok = self._outcomes.popleft()
+                if not old_ok:
+                    self._failures -= 1
+            calls = len(self._outcomes)
+            if calls >= BREAKER_MIN_CALLS and self._failures / calls >= BREAKER_FAILURE_RATE:
+                logger.warning(
+                    'Circuito %s abierto: %s de %s llamadas fallidas en %ss',
+                    self.family, self._failures, calls, BREAKER_WINDOW_SECONDS
+                )
+                self._open(now)
+
+    def _open(self, now):
+        self.state = 'open'
+        self._opened_at = now
+        self._outcomes.clear()
+        self._failures = 0
+        self.stats['opened'] += 1
+
+    def read_timeout(self):
+        """
+        p99 de las latencias recientes * TIMEOUT_P99_MULTIPLIER, acotado; READ_TIMEOUT sin datos suficientes.
+        """
+        with self._lock:
+            samples = sorted(self._latencies)
+        if len(samples) < TIMEOUT_MIN_SAMPLES:
+            return READ_TIMEOUT
+        p99 = samples[math.ceil(0.99 * len(samples)) - 1]
+        return min(READ_TIMEOUT, max(MIN_READ_TIMEOUT, p99 * TIMEOUT_P99_MULTIPLIER))
+
+    def snapshot(self):
+        with self._lock:
+            calls = len(self._outcomes)
+            snapshot = {
+                'state': self.state,
+                'calls_in_window': calls,
+                'failure_rate': self._failures / calls if calls else 0.0,
+                'latency_samples': len(self._latencies),
+                **self.stats,
+            }
+        snapshot['read_timeout'] = self.read_timeout()
+        return snapshot
+
+
+FAMILIES = ('user', 'wallet', 'payments', 'horizon', 'other')
+_breakers = {family: CircuitBreaker(family) for family in FAMILIES}
+
+
+def endpoint_family(url):
+    """
+    Familia de endpoints de una URL de la API de Pi.
+    """
+    path = urlsplit(url).path.rstrip('/')
+    if '/transactions/' in path:
+        return 'horizon'
+    if path.endswith('/me'):
+        return 'user'
+    if path.endswith('/wallet'):
+        return 'wallet'
+    if '/payments' in path:
+        return 'payments'
+    return 'other'
+
+
+def _send(session, method, url, timeout, **kwargs):
+    with _lock:
+        _stats['requests'] += 1
+        _stats['in_flight'] += 1
+    started = time.perf_counter()
+    status = 'error'
+    try:
+        response = session.request(method, url, timeout=timeout, **kwargs)
+        status = response.status_code
+        return response
+    except requests.exceptions.Timeout:
+        status = 'timeout'
+        with _lock:
+            _stats['errors'] += 1
+        raise
+    except requests.exceptions.RequestException:
+        with _lock:
+            _stats['errors'] += 1
+        raise
+    finally:
+        with _lock:
+            _stats['in_flight'] -= 1
+        _record(method, url, status, started)
+
+
+def _record(method, url, status, started):
+    elapsed = time.perf_counter() - started
+    metrics.record_upstream(method, url, status, elapsed)
+    if tracing.active():
+        tracing.record(
+            f'pi_{endpoint_family(url)}', started, elapsed,
+            method=method, endpoint=metrics.upstream_endpoint(url), status=status
+        )
+
+
+def _backoff_delay(attempt):
+    # Backoff exponencial con tope y jitter completo
+    return random.uniform(0, min(RETRY_BACKOFF_CAP, RETRY_BACKOFF_BASE * 2 ** attempt))
+
+
+def _acquire_slot(family):
+    try:
+        return admission.acquire()
+    except admission.QueueFull:
+        raise UpstreamBusyError(family, admission.BUSY_RETRY_AFTER) from None
+
+
+async def _acquire_slot_async(family):
+    try:
+        return await admission.acquire_async()
+    except admission.QueueFull:
+        raise UpstreamBusyError(family, admission.BUSY_RETRY_AFTER) from None
+
+
+def request(method, url, timeout=None, **kwargs):
+    """
+    Hace una petición a través del pool compartido y del circuit breaker de
+    su familia. `timeout` por defecto: (CONNECT_TIMEOUT, timeout adaptativo).
+    Lanza CircuitOpenError sin llamar a la API si el circuito está abierto.
+    """
+    session = get_session()
+    breaker = _breakers[endpoint_family(url)]
+    kwargs['headers'] = tracing.propagate(kwargs.get('headers'))
+    attempts = 1 + (RETRY_MAX if method.upper() in IDEMPOTENT_METHODS else 0)
+
+    for attempt in range(attempts):
+        slot = _acquire_slot(breaker.family)
+        try:
+            probe = breaker.before_call()
+            started = time.perf_counter()
+            try:
+                response = _send(session, method, url, timeout or (CONNECT_TIMEOUT, breaker.read_timeout()), **kwargs)
+                error = None
+            except Exception as e:
+                breaker.record(False, probe=probe)
+                error = e
+        finally:
+            # El slot se libera antes de esperar al reintento
+            admission.release(slot)
+        if error is not None:
+            retryable = isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError))
+            if retryable and attempt + 1 < attempts:
+                metrics.inc('pi_upstream_retries_total', (('family', breaker.family),))
+                time.sleep(_backoff_delay(attempt))
+                continue
+            raise error
+        failed = response.status_code >= 500 or response.status_code == 429
+        breaker.record(not failed, time.perf_counter() - started, probe=probe)
+        if response.status_code in RETRY_STATUSES and attempt + 1 < attempts:
+            response.close()
+            metrics.inc('pi_upstream_retries_total', (('family', breaker.family),))
+            time.sleep(_backoff_delay(attempt))
+            continue
+        return response
+
+
+def get_async_client():
+    """
+    Cliente httpx del bucle de eventos actual (se crea de nuevo si cambia el bucle).
+    """
+    global _async_client, _async_client_loop
+    if httpx is None:
+        raise RuntimeError('El modo ASGI necesita httpx (pip install httpx)')
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client_loop is not loop:
+        _async_client = httpx.AsyncClient(limits=httpx.Limits(
+            max_connections=ASYNC_MAX_CONNECTIONS,
+            max_keepalive_connections=ASYNC_MAX_KEEPALIVE,
+        ))
+        _async_client_loop = loop
+    return _async_client
+
+
+async def close_async_client():
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+
+async def _asend(client, method, url, timeout, **kwargs):
+    with _lock:
+        _stats['requests'] += 1
+        _stats['in_flight'] += 1
+    started = time.perf_counter()
+    status = 'error'
+    connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+    try:
+        response = await client.request(
+            method, url, timeout=httpx.Timeout(read_timeout, connect=connect_timeout), **kwargs
+        )
+        status = response.status_code
+        return response
+    except httpx.TimeoutException as e:
+        status = 'timeout'
+        with _lock:
+            _stats['errors'] += 1
+        raise requests.exceptions.Timeout(str(e) or 'Timeout') from e
+    except httpx.HTTPError as e:
+        with _lock:
+            _stats['errors'] += 1
+        raise requests.exceptions.ConnectionError(str(e) or type(e).__name__) from e
+    finally:
+        with _lock:
+            _stats['in_flight'] -= 1
+        _record(method, url, status, started)
+
+
+async def arequest(method, url, timeout=None, **kwargs):
+    """
+    Versión asíncrona de request() con httpx. Devuelve un httpx.Response
+    (status_code, text y json() como en requests) y lanza las mismas
+    excepciones de requests, incluida CircuitOpenError.
+    """
+    client = get_async_client()
+    breaker = _breakers[endpoint_family(url)]
+    kwargs['headers'] = tracing.propagate(kwargs.get('headers'))
+    attempts = 1 + (RETRY_MAX if method.upper() in IDEMPOTENT_METHODS else 0)
+
+    for attempt in range(attempts):
+        slot = await _acquire_slot_async(breaker.family)
+        try:
+            probe = breaker.before_call()
+            started = time.perf_counter()
+            try:
+                response = await _asend(client, method, url, timeout or (CONNECT_TIMEOUT, breaker.read_timeout()), **kwargs)
+                error = None
+            except asyncio.CancelledError:
+                if probe:
+                    # La llamada de prueba no terminó: reabrir para que se haga otra más adelante
+                    breaker.record(False, probe=True)
+                raise
+            except Exception as e:
+                breaker.record(False, probe=probe)
+                error = e
+        finally:
+            admission.release(slot)
+        if error is not None:
+            retryable = isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError))
+            if retryable and attempt + 1 < attempts:
+                metrics.inc('pi_upstream_retries_total', (('family', breaker.family),))
+                await asyncio.sleep(_backoff_delay(attempt))
+                continue
+            raise error
+        failed = response.status_code >= 500 or response.status_code == 429
+        breaker.record(not failed, time.perf_counter() - started, probe=probe)
+        if response.status_code in RETRY_STATUSES and attempt + 1 < attempts:
+            metrics.inc('pi_upstream_retries_total', (('family', breaker.family),))
+            await asyncio.sleep(_backoff_delay(attempt))
+            continue
+        return response
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def prewarm(urls, connections=1):
+    """
+    Abre `connections` conexiones keep-alive por URL (en paralelo, con una
+    petición HEAD que no cuenta en métricas ni circuit breakers) para que
+    las primeras peticiones reales no paguen el handshake TCP+TLS.
+    Devuelve {url: conexiones abiertas}.
+    """
+    session = get_session()
+    connections = max(1, min(connections, POOL_MAXSIZE))
+
+    def open_one(url):
+        try:
+            session.head(url, timeout=(CONNECT_TIMEOUT, CONNECT_TIMEOUT)).close()
+            return True
+        except requests.exceptions.RequestException as e:
+            logger.warning('No se pudo precalentar la conexión con %s: %s', url, e)
+            return False
+
+    opened = {}
+    for url in urls:
+        # Peticiones simultáneas: cada una ocupa (y deja en el pool) una conexión distinta
+        threads = []
+        results = []
+        for _ in range(connections):
+            thread = threading.Thread(target=lambda: results.append(open_one(url)), daemon=True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        opened[url] = sum(results)
+    return opened
+
+
+def pool_stats():
+    """
+    Estadísticas de uso del pool de este worker: peticiones totales, en curso,
+    errores y, por host, conexiones abiertas, ociosas y peticiones servidas.
+    """
+    with _lock:
+        stats = dict(_stats)
+    stats['pool_maxsize'] = POOL_MAXSIZE
+    hosts = {}
+    if _session is not None and _session_pid == os.getpid():
+        adapter = _session.get_adapter('https://')
+        for key in adapter.poolmanager.pools.keys():
+            pool = adapter.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            hosts[f'{pool.scheme}://{pool.host}:{pool.port}'] = {
+                'connections_opened': pool.num_connections,
+                'requests_served': pool.num_requests,
+                # La cola del pool se rellena con None; solo cuentan las conexiones reales
+                'idle': sum(1 for conn in list(pool.pool.queue) if conn is not None)
+                if pool.pool is not None else 0,
+            }
+    stats['hosts'] = hosts
+    return stats
+
+
+def breaker_stats():
+    """
+    Estado del circuit breaker y timeout de lectura actual de cada familia.
+    """
+    return {family: breaker.snapshot() for family, breaker in _breakers.items()}
@@ -0,0 +1,126 @@
+import os
+import heapq
+from decimal import Decimal, ROUND_DOWN
+from fractions import Fraction
+
+"""
+Planificación de los premios semanales sin cargar el leaderboard en memoria.
+
+Los ganadores (el top PRIZE_TOP_FRACTION, al menos 1) se eligen recorriendo
+las entradas una sola vez con un heap de tamaño k: O(n log k) en tiempo y
+O(k) en memoria, así el plan de una temporada con millones de participantes
+no depende de cuánta RAM tenga la máquina.
+
+Orden de los ganadores: el mismo que leaderboard_store.RANK_ORDER (puntaje
+descendente, a igual puntaje quien lo consiguió antes, y luego la address),
+de modo que dos ejecuciones sobre los mismos datos dan el mismo plan.
+
+Reparto del pool:
+  1.º 40%, 2.º 20%, 3.º 10% y el 30% restante a partes iguales entre los
+  demás. Con menos de 4 ganadores los porcentajes del podio que quedan
+  vacantes se reparten en proporción (1 ganador: 100%; 2: 2/3 y 1/3; 3:
+  4/7, 2/7 y 1/7).
+
+Los importes se calculan en unidades enteras de 10^-PRIZE_DECIMALS Pi y se
+redondean por el método del mayor resto: la suma de los premios es
+exactamente el pool (redondeado hacia abajo a esa precisión).
+"""
+
+# Pi por cada participante que se destina al pool
+PRIZE_PER_ENTRY = Decimal(os.getenv('PRIZE_PER_ENTRY', '0.009'))
+# Fracción del leaderboard que recibe premio
+PRIZE_TOP_FRACTION = Decimal(os.getenv('PRIZE_TOP_FRACTION', '0.10'))
+# Decimales de los importes (la red de Pi admite 7)
+PRIZE_DECIMALS = int(os.getenv('PRIZE_DECIMALS', '7'))
+
+# Pesos del podio y del resto de ganadores (en %)
+PODIUM_WEIGHTS = (40, 20, 10)
+REST_WEIGHT = 30
+
+
+def _quantum(decimals):
+    return Decimal(1).scaleb(-decimals)
+
+
+def prize_pool(num_entries, decimals=PRIZE_DECIMALS):
+    """
+    Pool de premios para `num_entries` participantes, redondeado hacia abajo a `decimals` decimales.
+    """
+    return (PRIZE_PER_ENTRY * num_entries).quantize(_quantum(decimals), rounding=ROUND_DOWN)
+
+
+def winner_count(num_entries):
+    """
+    Ganadores para `num_entries` participantes (al menos 1 si hay alguno).
+    """
+    if num_entries <= 0:
+        return 0
+    return max(1, int(num_entries * PRIZE_TOP_FRACTION))
+
+
+def prize_weights(count):
+    """
+    Peso exacto (Fraction) del premio de cada puesto para `count` ganadores.
+    """
+    if count <= len(PODIUM_WEIGHTS):
+        return [Fraction(weight) for weight in PODIUM_WEIGHTS[:count]]
+    share = Fraction(REST_WEIGHT, count - len(PODIUM_WEIGHTS))
+    return [Fraction(weight) for weight in PODIUM_WEIGHTS] + [share] * (count - len(PODIUM_WEIGHTS))
+
+
+def allocate(pool, weights, decimals=PRIZE_DECIMALS):
+    """
+    Reparte `pool` (Decimal) según `weights` con el método del mayor resto.
+    Devuelve una lista de Decimal con `decimals` decimales que suma
+    exactamente el pool redondeado hacia abajo a esa precisión. A igual resto
+    la unidad sobrante va al puesto mejor clasificado.
+    """
+    if not weights:
+        return []
+    units = int(pool.quantize(_quantum(decimals), rounding=ROUND_DOWN).scaleb(decimals))
+    total = sum(weights)
+
+    shares = []
+    remainders = []
+    for position, weight in enumerate(weights):
+        exact = units * weight / total
+        share = exact.numerator // exact.denominator
+        shares.append(share)
+        remainders.append((exact - share, -position))
+
+    leftover = units - sum(shares)
+    for _, negative_position in heapq.nlargest(leftover, remainders):
+        shares[-negative_position] += 1
+
+    return [Decimal(share).scaleb(-decimals) for share in shares]
+
+
+def _rank_key(entry):
+    # Mismo orden que leaderboard_store.RANK_ORDER
+    return -entry['score'], entry['timestamp'], entry['address']
+
+
+def select_winners(entries, count):
+    """
+    Las `count` mejores entradas de un iterable, en orden de clasificación,
+    manteniendo en memoria solo `count` a la vez.
+    """
+    if count <= 0:
+        return []
+    return heapq.nsmallest(count, entries, key=_rank_key)
+
+
+def plan_prizes(entries, num_entries=None):
+    """
+    Calcula [(address, Decimal premio), ...] y el pool. `entries` puede ser
+    cualquier iterable de {address, score, timestamp} (p.ej.
+    leaderboard_store.iter_entries); si se indica `num_entries` se recorre
+    una sola vez.
+    """
+    if num_entries is None:
+        entries = list(entries)
+        num_entries = len(entries)
+    pool = prize_pool(num_entries)
+    winners = select_winners(entries, winner_count(num_entries))
+    prizes = allocate(pool, prize_weights(len(winners)))
+    return [(winner['address'], prize) for winner, prize in zip(winners, prizes)], pool
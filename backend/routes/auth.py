@@ -1,7 +1,13 @@
-from flask import Blueprint, request, jsonify
 import os
-import requests
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from flask import Blueprint, request, jsonify
 import logging
+from backend import pi_client, user_cache, payment_store
+from backend.pi_client import PI_API_BASE_URL
+from backend.leaderboard_index import leaderboard_index
 
 # Configurar logging
 logger = logging.getLogger(__name__)
@@ -9,9 +15,133 @@ logger = logging.getLogger(__name__)
 # Crear Blueprint para rutas de autenticación
 auth_routes = Blueprint('auth', __name__, url_prefix='/api')
 
-# Obtener configuración desde variables de entorno
-PI_API_KEY = os.getenv('PI_API_KEY')
-PI_API_BASE_URL  = os.getenv('PI_API_BASE_URL', 'https://api.minepi.com/v2')
+
+def _load_from_pi(path, access_token):
+    """
+    Llama a la API de Pi Network con el token del usuario.
+    Devuelve (status_code, datos JSON o texto del error).
+    """
+    user_headers = {
+        'Authorization': f'Bearer {access_token}'
+    }
+    response = pi_client.get(f"{PI_API_BASE_URL}{path}", headers=user_headers)
+    if response.status_code != 200:
+        return response.status_code, response.text
+    return 200, response.json()
+
+
+def fetch_user(access_token):
+    """
+    Datos de /me para el token (cacheados por USER_CACHE_TTL segundos).
+    """
+    return user_cache.fetch('user', access_token, lambda: _load_from_pi('/me', access_token))
+
+
+def fetch_wallet(access_token):
+    """
+    Datos de /wallet para el token (cacheados por WALLET_CACHE_TTL segundos).
+    """
+    return user_cache.fetch('wallet', access_token, lambda: _load_from_pi('/wallet', access_token))
+
+
+# Hilos por worker para pedir /me y /wallet a la vez en /api/session
+SESSION_FANOUT_THREADS = int(os.getenv('SESSION_FANOUT_THREADS', '8'))
+# Datos extra que /api/session puede incluir (locales, sin llamar a la API)
+SESSION_INCLUDES = ('payments', 'rank')
+
+_fanout_lock = threading.Lock()
+_fanout = None
+_fanout_pid = None
+
+
+def _fanout_executor():
+    """
+    Pool de este proceso para las consultas en paralelo (se crea de nuevo tras un fork).
+    """
+    global _fanout, _fanout_pid
+    if _fanout is None or _fanout_pid != os.getpid():
+        with _fanout_lock:
+            if _fanout is None or _fanout_pid != os.getpid():
+                _fanout = ThreadPoolExecutor(max_workers=SESSION_FANOUT_THREADS, thread_name_prefix='session-fanout')
+                _fanout_pid = os.getpid()
+    return _fanout
+
+
+def _user_info_response(status_code, user_data):
+    if status_code != 200:
+        logger.error('Error al obtener información del usuario: %s', user_data)
+        return jsonify({'error': f'Error al obtener información del usuario: {user_data}'}), status_code
+
+    logger.debug('Información de usuario obtenida correctamente: %s', user_data)
+
+    return jsonify(user_data)
+
+
+def _wallet_info_response(status_code, wallet_data):
+    if status_code != 200:
+        logger.error('Error al obtener información de la wallet: %s', wallet_data)
+        return jsonify({'error': f'Error al obtener información de la wallet: {wallet_data}'}), status_code
+
+    # Copia para no modificar la entrada cacheada
+    wallet_data = dict(wallet_data)
+    logger.debug('Información de wallet obtenida correctamente: %s', wallet_data)
+
+    # Si no hay balance, establecer un valor predeterminado
+    if 'balance' not in wallet_data:
+        wallet_data['balance'] = '0'
+        logger.warning('Balance no encontrado en datos de wallet, usando valor predeterminado')
+
+    return jsonify(wallet_data)
+
+
+def _verify_response(status_code, user_data):
+    if status_code != 200:
+        logger.error('Token de acceso inválido: %s', user_data)
+        return jsonify({'valid': False, 'error': 'Token de acceso inválido'}), 200
+
+    # El token es válido
+    logger.debug('Token de acceso válido para usuario: %s', user_data.get('username'))
+
+    return jsonify({'valid': True, 'user': user_data})
+
+
+def _session_includes(data):
+    include = data.get('include') or []
+    if isinstance(include, str):
+        include = include.split(',')
+    return {item for item in include if item in SESSION_INCLUDES}
+
+
+def _session_response(user_result, wallet_result, include):
+    """
+    Documento de /api/session a partir de los resultados (status, datos) de
+    /me y /wallet, o de la excepción que lanzó cada consulta.
+    """
+    if isinstance(user_result, BaseException):
+        raise user_result
+    status_code, user_data = user_result
+    if status_code != 200:
+        logger.error('Token de acceso inválido al iniciar sesión: %s', user_data)
+        return jsonify({'valid': False, 'error': 'Token de acceso inválido'}), 401
+
+    session = {'valid': True, 'user': user_data, 'wallet': None}
+    # Sin wallet la sesión sigue siendo válida (p.ej. el token no tiene el scope wallet_address)
+    if isinstance(wallet_result, BaseException):
+        logger.warning('No se pudo obtener la wallet para la sesión: %s', wallet_result)
+        session['walletError'] = 'La API de Pi Network no está disponible en este momento'
+    elif wallet_result[0] != 200:
+        logger.warning('No se pudo obtener la wallet para la sesión: %s', wallet_result[1])
+        session['walletError'] = f'Error al obtener información de la wallet: {wallet_result[0]}'
+    else:
+        session['wallet'] = {'balance': '0', **wallet_result[1]}
+
+    if 'payments' in include:
+        session['pendingPayments'] = payment_store.open_payments(user_data.get('uid'))
+    if 'rank' in include:
+        address = (session['wallet'] or {}).get('address')
+        session['rank'] = leaderboard_index.rank_of(address) if address else None
+
+    return jsonify(session)
 
 
 @auth_routes.route('/me', methods=['POST'])
@@ -26,27 +156,14 @@ def get_user_info():
             return jsonify({'error': 'Token de acceso no proporcionado'}), 400
 
         access_token = data['accessToken']
-        logger.debug(f'Obteniendo información de usuario con token: {access_token[:10]}...')
-
-        # Configurar headers para la petición a la API de Pi Network
-        user_headers = {
-            'Authorization': f'Bearer {access_token}'
-        }
-
-        # Hacer la petición a la API de Pi Network
-        user_url = f"{PI_API_BASE_URL}/me"
-        response = requests.get(user_url, headers=user_headers)
+        logger.debug('Obteniendo información de usuario con token: %s...', access_token[:10])
 
-        # Verificar respuesta
-        if response.status_code != 200:
-            logger.error(f'Error al obtener información del usuario: {response.text}')
-            return jsonify({'error': f'Error al obtener información del usuario: {response.text}'}), response.status_code
+        # Hacer la petición a la API de Pi Network (o usar la caché)
+        status_code, user_data = fetch_user(access_token)
+        return _user_info_response(status_code, user_data)
 
-        # Procesar respuesta
-        user_data = response.json()
-        logger.debug(f'Información de usuario obtenida correctamente: {user_data}')
-
-        return jsonify(user_data)
+    except pi_client.CircuitOpenError as e:
+        return pi_client.unavailable_response(e)
 
     except Exception as e:
         logger.exception('Error en la petición de información de usuario')
@@ -64,32 +181,14 @@ def get_wallet_info():
             return jsonify({'error': 'Token de acceso no proporcionado'}), 400
 
         access_token = data['accessToken']
-        logger.debug(f'Obteniendo información de wallet con token: {access_token[:10]}...')
-
-        # Configurar headers para la petición a la API de Pi Network
-        user_headers = {
-            'Authorization': f'Bearer {access_token}'
-        }
-
-        # Hacer la petición a la API de Pi Network
-        wallet_url = f"{PI_API_BASE_URL}/wallet"
-        response = requests.get(wallet_url, headers=user_headers)
-
-        # Verificar respuesta
-        if response.status_code != 200:
-            logger.error(f'Error al obtener información de la wallet: {response.text}')
-            return jsonify({'error': f'Error al obtener información de la wallet: {response.text}'}), response.status_code
+        logger.debug('Obteniendo información de wallet con token: %s...', access_token[:10])
 
-        # Procesar respuesta
-        wallet_data = response.json()
-        logger.debug(f'Información de wallet obtenida correctamente: {wallet_data}')
-        
-        # Si no hay balance, establecer un valor predeterminado
-        if 'balance' not in wallet_data:
-            wallet_data['balance'] = '0'
-            logger.warning('Balance no encontrado en datos de wallet, usando valor predeterminado')
+        # Hacer la petición a la API de Pi Network (o usar la caché)
+        status_code, wallet_data = fetch_wallet(access_token)
+        return _wallet_info_response(status_code, wallet_data)
 
-        return jsonify(wallet_data)
+    except pi_client.CircuitOpenError as e:
+        return pi_client.unavailable_response(e)
 
     except Exception as e:
         logger.exception('Error en la petición de información de wallet')
@@ -107,28 +206,150 @@ def verify_auth():
             return jsonify({'error': 'Token de acceso no proporcionado'}), 400
 
         access_token = data['accessToken']
-        logger.debug(f'Verificando token de acceso: {access_token[:10]}...')
+        logger.debug('Verificando token de acceso: %s...', access_token[:10])
+
+        # Verificar el token reutilizando la consulta de wallet (compartida con /wallet)
+        status_code, user_data = fetch_wallet(access_token)
+        return _verify_response(status_code, user_data)
+
+    except pi_client.CircuitOpenError as e:
+        return pi_client.unavailable_response(e)
+
+    except Exception as e:
+        logger.exception('Error al verificar token de acceso')
+        return jsonify({'valid': False, 'error': f'Error interno del servidor: {str(e)}'}), 200  # Devolvemos 200 para que el frontend pueda manejar esto
+
+@auth_routes.route('/session', methods=['POST'])
+def get_session():
+    """
+    Todo lo que necesita el dashboard al cargar en una sola petición: verifica
+    el token y devuelve usuario y wallet (pedidos a la API a la vez) y, si se
+    piden en `include`, los pagos pendientes y el ranking del usuario.
+    """
+    try:
+        data = request.get_json()
+        if not data or 'accessToken' not in data:
+            return jsonify({'error': 'Token de acceso no proporcionado'}), 400
+
+        access_token = data['accessToken']
+        logger.debug('Cargando sesión con token: %s...', access_token[:10])
+
+        # /wallet en otro hilo mientras este pide /me: una sola espera a la API
+        # copy_context: la llamada del otro hilo también cuenta en la traza de la petición
+        wallet_future = _fanout_executor().submit(contextvars.copy_context().run, fetch_wallet, access_token)
+        try:
+            user_result = fetch_user(access_token)
+        except Exception as e:
+            user_result = e
+        try:
+            wallet_result = wallet_future.result()
+        except Exception as e:
+            wallet_result = e
+        return _session_response(user_result, wallet_result, _session_includes(data))
+
+    except pi_client.CircuitOpenError as e:
+        return pi_client.unavailable_response(e)
+
+    except Exception as e:
+        logger.exception('Error al cargar la sesión')
+        return jsonify({'error': f'Error interno del servidor: {str(e)}'}), 500
+
+
+# --- Versiones asíncronas (modo ASGI, ver asgi.py) ---
+# Mismas respuestas que las vistas de arriba, pero la llamada a Pi se hace con
+# pi_client.arequest y no ocupa un hilo mientras espera.
+
+async def _load_from_pi_async(path, access_token):
+    response = await pi_client.arequest(
+        'GET', f"{PI_API_BASE_URL}{path}", headers={'Authorization': f'Bearer {access_token}'}
+    )
+    if response.status_code != 200:
+        return response.status_code, response.text
+    return 200, response.json()
+
+
+async def fetch_user_async(access_token):
+    return await user_cache.fetch_async('user', access_token, lambda: _load_from_pi_async('/me', access_token))
+
+
+async def fetch_wallet_async(access_token):
+    return await user_cache.fetch_async('wallet', access_token, lambda: _load_from_pi_async('/wallet', access_token))
+
+
+async def get_user_info_async():
+    try:
+        data = request.get_json()
+        if not data or 'accessToken' not in data:
+            return jsonify({'error': 'Token de acceso no proporcionado'}), 400
+
+        status_code, user_data = await fetch_user_async(data['accessToken'])
+        return _user_info_response(status_code, user_data)
+
+    except pi_client.CircuitOpenError as e:
+        return pi_client.unavailable_response(e)
+
+    except Exception as e:
+        logger.exception('Error en la petición de información de usuario')
+        return jsonify({'error': f'Error interno del servidor: {str(e)}'}), 500
 
-        # Configurar headers para la petición a la API de Pi Network
-        user_headers = {
-            'Authorization': f'Bearer {access_token}'
-        }
 
-        # Hacer una petición simple a la API para verificar el token
-        user_url = f"{PI_API_BASE_URL}/wallet"
-        response = requests.get(user_url, headers=user_headers)
+async def get_wallet_info_async():
+    try:
+        data = request.get_json()
+        if not data or 'accessToken' not in data:
+            return jsonify({'error': 'Token de acceso no proporcionado'}), 400
 
-        # Verificar respuesta
-        if response.status_code != 200:
-            logger.error(f'Token de acceso inválido: {response.text}')
-            return jsonify({'valid': False, 'error': 'Token de acceso inválido'}), 200
+        status_code, wallet_data = await fetch_wallet_async(data['accessToken'])
+        return _wallet_info_response(status_code, wallet_data)
+
+    except pi_client.CircuitOpenError as e:
+        return pi_client.unavailable_response(e)
+
+    except Exception as e:
+        logger.exception('Error en la petición de información de wallet')
+        return jsonify({'error': f'Error interno del servidor: {str(e)}'}), 500
+
+
+async def verify_auth_async():
+    try:
+        data = request.get_json()
+        if not data or 'accessToken' not in data:
+            return jsonify({'error': 'Token de acceso no proporcionado'}), 400
 
-        # El token es válido
-        user_data = response.json()
-        logger.debug(f'Token de acceso válido para usuario: {user_data.get("username")}')
+        status_code, user_data = await fetch_wallet_async(data['accessToken'])
+        return _verify_response(status_code, user_data)
 
-        return jsonify({'valid': True, 'user': user_data})
+    except pi_client.CircuitOpenError as e:
+        return pi_client.unavailable_response(e)
 
     except Exception as e:
         logger.exception('Error al verificar token de acceso')
-        return jsonify({'valid': False, 'error': f'Error interno del servidor: {str(e)}'}), 200  # Devolvemos 200 para que el frontend pueda manejar esto
+        return jsonify({'valid': False, 'error': f'Error interno del servidor: {str(e)}'}), 200
+
+
+async def get_session_async():
+    try:
+        data = request.get_json()
+        if not data or 'accessToken' not in data:
+            return jsonify({'error': 'Token de acceso no proporcionado'}), 400
+
+        user_result, wallet_result = await asyncio.gather(
+            fetch_user_async(data['accessToken']), fetch_wallet_async(data['accessToken']), return_exceptions=True
+        )
+        return _session_response(user_result, wallet_result, _session_includes(data))
+
+    except pi_client.CircuitOpenError as e:
+        return pi_client.unavailable_response(e)
+
+    except Exception as e:
+        logger.exception('Error al cargar la sesión')
+        return jsonify({'error': f'Error interno del servidor: {str(e)}'}), 500
+
+
+# Nombre de la vista síncrona -> versión asíncrona
+async_views = {
+    'get_user_info': get_user_info_async,
+    'get_wallet_info': get_wallet_info_async,
+    'verify_auth': verify_auth_async,
+    'get_session': get_session_async,
+}
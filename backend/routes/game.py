@@ -1,7 +1,19 @@
-from flask import Blueprint, request, jsonify, current_app
-import json, os
-from datetime import datetime
-from backend.routes.payments import verify_pi_transaction, send_pi_to_user
+import asyncio
+import math
+from flask import Blueprint, Response, request, jsonify
+from backend.routes.payments import check_pi_transaction
+from backend import pi_client, score_buffer, leaderboard_store, leaderboard_stream
+from backend.leaderboard_index import leaderboard_index
+from backend.txid_index import txid_index
+
+# Monto de la apuesta por partida (Pi)
+DRIBBLE_STAKE = 0.01
+
+# Puntaje máximo admitido (el mayor entero que cabe en una columna INTEGER de SQLite)
+MAX_SCORE = 2 ** 63 - 1
+
+# Límite máximo de entradas por página en /dribble/leaderboard
+MAX_LEADERBOARD_LIMIT = 1000
 
 # Blueprint para las rutas de juego
 game_bp = Blueprint('game', __name__, url_prefix='/api/game')
@@ -18,44 +30,167 @@ def dribble_play():
     """
     Recibe JSON con { txid, score, user_address }.
     Verifica la transacción de 0.01 Pi, guarda el mejor puntaje
-    en leaderboard.json y responde estado.
+    en el leaderboard y responde estado.
     """
     data = request.get_json()
+    if not data:
+        return jsonify({'error': 'Datos de partida no proporcionados.'}), 400
     txid = data.get('txid')
     score = data.get('score')
     user_addr = data.get('user_address')
 
-    # 1. Verificar transacción de 0.01 Pi
-    valid = verify_pi_transaction(txid, required_amount=0.01)
+    if (not txid or not isinstance(txid, str) or not user_addr or not isinstance(user_addr, str)
+            or not isinstance(score, int) or isinstance(score, bool)):
+        return jsonify({'error': 'txid, score y user_address son obligatorios.'}), 400
+    # SQLite guarda enteros de 64 bits con signo
+    if not 0 <= score <= MAX_SCORE:
+        return jsonify({'error': f'score debe estar entre 0 y {MAX_SCORE}.'}), 400
+
+    # 1. Rechazar txid ya usados sin consultar la blockchain
+    if txid_index.is_consumed(txid):
+        return jsonify({'error': 'Transacción ya utilizada.'}), 409
+
+    # 2. Verificar transacción de 0.01 Pi (el resultado queda guardado)
+    try:
+        valid = txid_index.verify(txid, lambda t: check_pi_transaction(t, required_amount=DRIBBLE_STAKE))
+    except pi_client.CircuitOpenError as e:
+        return pi_client.unavailable_response(e)
     if not valid:
         return jsonify({'error': 'Transacción inválida o monto incorrecto.'}), 400
 
-    # 2. Leer o crear leaderboard.json
-    lb_path = os.path.join(current_app.root_path, 'backend', 'leaderboard.json')
-    if not os.path.exists(lb_path):
-        with open(lb_path, 'w') as f:
-            json.dump([], f)
-
-    with open(lb_path, 'r') as f:
-        leaderboard = json.load(f)
-
-    # 3. Actualizar mejor puntaje del usuario
-    updated = False
-    for entry in leaderboard:
-        if entry['address'] == user_addr:
-            if score > entry['score']:
-                entry['score'] = score
-                entry['timestamp'] = datetime.utcnow().isoformat()
-            updated = True
-            break
-    if not updated:
-        leaderboard.append({
-            'address': user_addr,
-            'score': score,
-            'timestamp': datetime.utcnow().isoformat()
-        })
-
-    with open(lb_path, 'w') as f:
-        json.dump(leaderboard, f, indent=2)
-
-    return jsonify({'status': 'ok', 'message': 'Puntaje registrado.'}), 200
\ No newline at end of file
+    # 3. Consumir el txid; si otro worker lo acaba de usar, rechazar
+    if not txid_index.consume(txid, user_addr):
+        return jsonify({'error': 'Transacción ya utilizada.'}), 409
+
+    # 4. Guardar el mejor puntaje del usuario: se agrupa con otras partidas en un
+    #    solo commit, que también actualiza el índice de ranking en memoria.
+    #    Si falla, devolver el txid para que el reintento no reciba 409 (si el
+    #    puntaje llegara a escribirse tras agotar la espera, el reintento solo
+    #    vuelve a enviar el mismo mejor puntaje)
+    try:
+        score_buffer.submit(user_addr, score)
+    except score_buffer.FlushError as e:
+        txid_index.release(txid, user_addr)
+        return jsonify({'error': f'No se pudo guardar el puntaje: {str(e)}'}), 503
+
+    return jsonify({'status': 'ok', 'message': 'Puntaje registrado.'}), 200
+
+def _page_args():
+    """
+    Lee ?limit&offset. Devuelve (limit, offset, None) o (None, None, respuesta de error).
+    """
+    try:
+        limit = int(request.args.get('limit', 100))
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return None, None, (jsonify({'error': 'limit y offset deben ser enteros.'}), 400)
+    if limit < 1 or limit > MAX_LEADERBOARD_LIMIT or offset < 0:
+        return None, None, (jsonify({'error': f'limit debe estar entre 1 y {MAX_LEADERBOARD_LIMIT} y offset ser >= 0.'}), 400)
+    return limit, offset, None
+
+@game_bp.route('/dribble/leaderboard', methods=['GET'])
+def dribble_leaderboard():
+    """
+    Devuelve una página del leaderboard ordenado: ?limit=100&offset=0
+    """
+    limit, offset, error = _page_args()
+    if error:
+        return error
+
+    entries, total = leaderboard_index.top(limit, offset)
+    return jsonify({
+        'total': total,
+        'limit': limit,
+        'offset': offset,
+        'entries': entries
+    }), 200
+
+@game_bp.route('/dribble/seasons', methods=['GET'])
+def dribble_seasons():
+    """
+    Lista las temporadas del leaderboard (activa, cerradas y archivadas).
+    """
+    return jsonify({'seasons': leaderboard_store.list_seasons()}), 200
+
+@game_bp.route('/dribble/seasons/<season>/leaderboard', methods=['GET'])
+def dribble_season_leaderboard(season):
+    """
+    Página del leaderboard de una temporada concreta: ?limit=100&offset=0
+    """
+    limit, offset, error = _page_args()
+    if error:
+        return error
+
+    if season == leaderboard_store.active_season():
+        entries, total = leaderboard_index.top(limit, offset)
+    else:
+        result = leaderboard_store.season_top(season, limit, offset)
+        if result is None:
+            return jsonify({'error': 'Temporada no encontrada.'}), 404
+        entries, total = result
+    return jsonify({
+        'season': season,
+        'total': total,
+        'limit': limit,
+        'offset': offset,
+        'entries': entries
+    }), 200
+
+@game_bp.route('/dribble/rank/<address>', methods=['GET'])
+def dribble_rank(address):
+    """
+    Devuelve el puesto de una dirección en el leaderboard.
+    """
+    result = leaderboard_index.rank_of(address)
+    if result is None:
+        return jsonify({'error': 'Dirección sin puntaje registrado.'}), 404
+    return jsonify(result), 200
+
+def _stream_response(body):
+    return Response(body, mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # Que nginx y similares no acumulen los eventos
+        'X-Accel-Buffering': 'no',
+    })
+
+def _stream_full(error):
+    # Reintento sugerido: el intervalo de reconexión del propio SSE
+    response = jsonify({'error': str(error)})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(math.ceil(leaderboard_stream.RETRY_MS / 1000))
+    return response
+
+@game_bp.route('/dribble/stream', methods=['GET'])
+def dribble_stream():
+    """
+    Server-Sent Events con el top del leaderboard (event: top) y, con
+    ?address=..., el puesto de esa dirección cuando cambia (event: rank).
+    """
+    try:
+        subscriber = leaderboard_stream.subscribe(request.args.get('address'))
+    except leaderboard_stream.TooManyClients as e:
+        return _stream_full(e)
+    return _stream_response(leaderboard_stream.stream(subscriber))
+
+async def dribble_stream_async():
+    try:
+        subscriber = leaderboard_stream.subscribe(request.args.get('address'), asyncio.get_running_loop())
+    except leaderboard_stream.TooManyClients as e:
+        return _stream_full(e)
+    return _stream_response(leaderboard_stream.stream_async(subscriber))
+
+# Vistas sin límite de ritmo por IP (ver admission.init_app): leen el índice o
+# la base local y no llaman a la API de Pi; el stream tiene su propio límite
+rate_exempt = (
+    'dribble_init',
+    'dribble_leaderboard',
+    'dribble_seasons',
+    'dribble_season_leaderboard',
+    'dribble_rank',
+    'dribble_stream',
+)
+
+# Nombre de la vista síncrona -> versión asíncrona (modo ASGI, ver asgi.py)
+async_views = {
+    'dribble_stream': dribble_stream_async,
+}
@@ -1,7 +1,15 @@
 from flask import Blueprint, request, jsonify
 import os
+import math
+import asyncio
+import threading
 import requests
 import logging
+from decimal import Decimal, InvalidOperation
+from concurrent.futures import ThreadPoolExecutor
+from backend import pi_client, user_cache, payment_jobs, payment_store, payment_ledger, tracing
+from backend.pi_client import PI_API_BASE_URL
+from backend.routes.auth import fetch_user, fetch_user_async
 
 # Configurar logging
 logger = logging.getLogger(__name__)
@@ -9,58 +17,314 @@ logger = logging.getLogger(__name__)
 # Crear Blueprint para rutas de pagos
 payment_routes = Blueprint('payments', __name__, url_prefix='/api/payments')
 
-# Obtener configuración desde variables de entorno
-PI_API_KEY = os.getenv('PI_API_KEY')
-
-# Verificar que la API key está configurada
-if not PI_API_KEY:
-    logger.error('PI_API_KEY no encontrada en variables de entorno')
-    raise ValueError('PI_API_KEY no encontrada en variables de entorno. Por favor, configura la API key en el archivo .env')
+def api_key():
+    """
+    API key del servidor (PI_API_KEY). Se lee al usarla y no al importar, para
+    que la app arranque sin ella: las rutas de pagos responden 500 mientras falte.
+    """
+    return os.getenv('PI_API_KEY')
 
-# Configurar headers para la petición a la API de Pi Network
+# Configurar headers para la petición a la API de Pi Network (Authorization se añade en cada llamada)
 server_headers = {
-    'Authorization': f'Bearer {PI_API_KEY}',
     'Content-Type': 'application/json',
     'Accept': 'application/json',
     'X-Pi-SDK-Version': '2.0',
     'User-Agent': 'Pi-Starter/1.0'
 }
 
-# Base URL de la API de Pi Network
-PI_API_BASE_URL = 'https://api.minepi.com/v2'
+# Llamadas simultáneas a la API por cada petición a /batch y tamaño máximo del lote
+BATCH_CONCURRENCY = int(os.getenv('PAYMENTS_BATCH_CONCURRENCY', '16'))
+BATCH_MAX_ITEMS = int(os.getenv('PAYMENTS_BATCH_MAX_ITEMS', '1000'))
+
+# Horizon de la blockchain de Pi y wallet de la app que recibe las apuestas (opcional)
+PI_HORIZON_URL = os.getenv('PI_HORIZON_URL', 'https://api.mainnet.minepi.com')
+PI_APP_WALLET_ADDRESS = os.getenv('PI_APP_WALLET_ADDRESS')
+
+# Formatos de Authorization que acepta la API, en el orden en que se prueban
+AUTH_SCHEMES = ('Bearer', 'Key')
+
+# Formato que funcionó la última vez en este proceso (PI_API_AUTH_SCHEME lo fija de antemano)
+_auth_scheme = os.getenv('PI_API_AUTH_SCHEME') or None
+_auth_lock = threading.Lock()
+_auth_stats = {'negotiations': 0, 'retries_avoided': 0}
+
+
+def auth_scheme_stats():
+    """
+    Formato de Authorization en uso, cuántas veces se negoció y cuántas
+    peticiones duplicadas (primer intento con 401) se evitaron.
+    """
+    with _auth_lock:
+        return {'scheme': _auth_scheme, **_auth_stats}
+
+
+def _schemes_to_try():
+    # Primero el formato que ya funcionó, después el resto
+    cached_scheme = _auth_scheme
+    if cached_scheme:
+        return [cached_scheme] + [s for s in AUTH_SCHEMES if s != cached_scheme]
+    return list(AUTH_SCHEMES)
+
+
+def _remember_scheme(scheme, attempt):
+    global _auth_scheme
+    with _auth_lock:
+        if scheme != _auth_scheme:
+            _auth_scheme = scheme
+            _auth_stats['negotiations'] += 1
+            logger.info('Formato de Authorization negociado: %s', scheme)
+        elif attempt == 0 and scheme != AUTH_SCHEMES[0]:
+            # Sin caché se habría hecho antes un intento inútil con Bearer
+            _auth_stats['retries_avoided'] += 1
+
+
+def _all_schemes_failed():
+    global _auth_scheme
+    with _auth_lock:
+        _auth_scheme = None
+    logger.error('Todos los formatos de API key fallaron')
+    raise ValueError('Error de autenticación. Ambos formatos de API key fallaron.')
+
 
 # Función auxiliar para hacer peticiones a la API
 def make_api_request(url, method='POST', data=None):
     """
-    Hace una petición a la API de Pi Network con manejo de errores mejorado
+    Hace una petición a la API de Pi Network con manejo de errores mejorado.
+    Usa directamente el formato de Authorization que ya funcionó; solo si
+    responde 401 vuelve a probar los demás formatos.
     """
     try:
-        # Intentar la petición con Bearer
-        headers = {**server_headers, 'Authorization': f'Bearer {PI_API_KEY}'}
-        response = requests.request(method, url, json=data, headers=headers, timeout=10)
-        
-        # Verificar si es un error de autenticación
-        if response.status_code == 401:
-            logger.warning(f'Primer intento falló con Bearer: {response.text}')
-            
-            # Intentar con Key
-            headers['Authorization'] = f'Key {PI_API_KEY}'
-            response = requests.request(method, url, json=data, headers=headers, timeout=10)
-            
-            if response.status_code == 401:
-                logger.error(f'Segundo intento falló con Key: {response.text}')
-                raise ValueError('Error de autenticación. Ambos formatos de API key fallaron.')
-                
+        for attempt, scheme in enumerate(_schemes_to_try()):
+            headers = {**server_headers, 'Authorization': f'{scheme} {api_key()}'}
+            with tracing.span('pi_auth_scheme', scheme=scheme) as detail:
+                response = pi_client.request(method, url, json=data, headers=headers)
+                detail['status'] = response.status_code
+            if response.status_code != 401:
+                break
+            logger.warning('Intento con %s falló con 401: %s', scheme, response.text)
+        else:
+            _all_schemes_failed()
+
+        _remember_scheme(scheme, attempt)
+
         response.raise_for_status()
         return response.json()
         
     except requests.exceptions.RequestException as e:
-        logger.error(f'Error en la petición HTTP: {str(e)}')
+        logger.error('Error en la petición HTTP: %s', e)
         raise
         
     except ValueError as e:
-        logger.error(f'Error de autenticación: {str(e)}')
+        logger.error('Error de autenticación: %s', e)
+        raise
+
+def check_pi_transaction(txid, required_amount):
+    """
+    Consulta la transacción en Horizon y comprueba que contiene un pago nativo
+    exitoso de al menos `required_amount` Pi a PI_APP_WALLET_ADDRESS.
+    Devuelve True/False, o None si no hay respuesta definitiva: no se pudo
+    consultar, Horizon aún no la conoce (404) o PI_APP_WALLET_ADDRESS no está
+    configurada (sin ella cualquier pago de la blockchain valdría).
+    Lanza pi_client.CircuitOpenError si el circuito de Horizon está abierto.
+    """
+    if not PI_APP_WALLET_ADDRESS:
+        logger.error('PI_APP_WALLET_ADDRESS no está configurada: no se puede verificar la transacción %s', txid)
+        return None
+
+    url = f"{PI_HORIZON_URL}/transactions/{txid}/payments"
+    try:
+        response = pi_client.get(url)
+    except pi_client.CircuitOpenError:
+        # Horizon caído: que la ruta responda 503 en lugar de "transacción no válida"
         raise
+    except requests.exceptions.RequestException as e:
+        logger.error('Error al consultar la transacción %s: %s', txid, e)
+        return None
+
+    if response.status_code == 404:
+        # Puede que Horizon aún no haya indexado una transacción recién enviada:
+        # no es un "no" definitivo (txid_index no lo guarda y se puede reintentar)
+        logger.info('Horizon todavía no conoce la transacción %s', txid)
+        return None
+    if response.status_code != 200:
+        logger.error('Horizon respondió %s para %s: %s', response.status_code, txid, response.text)
+        return None
+
+    required = Decimal(str(required_amount))
+    records = response.json().get('_embedded', {}).get('records', [])
+    for operation in records:
+        if operation.get('type') != 'payment' or operation.get('asset_type') != 'native':
+            continue
+        if not operation.get('transaction_successful', True):
+            continue
+        if operation.get('to') != PI_APP_WALLET_ADDRESS:
+            continue
+        try:
+            if Decimal(operation.get('amount', '0')) >= required:
+                return True
+        except InvalidOperation:
+            continue
+    return False
+
+
+def verify_pi_transaction(txid, required_amount):
+    """
+    True si la transacción es un pago válido de al menos `required_amount` Pi.
+    """
+    return bool(check_pi_transaction(txid, required_amount))
+
+
+def _track(payment_id, status, payment=None, txid=None):
+    """
+    Guarda el estado del pago en el almacén local. Un fallo aquí no debe
+    convertir en error un pago que la API ya procesó: el reconciliador lo
+    corregirá.
+    """
+    try:
+        payment_store.record(payment_id, status, payment, txid)
+    except Exception:
+        logger.exception('No se pudo guardar el estado %s del pago %s', status, payment_id)
+
+
+def fetch_payment(payment_id):
+    """
+    Pago tal y como lo tiene la API de Pi Network (usado por el reconciliador).
+    """
+    return make_api_request(f"{PI_API_BASE_URL}/payments/{payment_id}", method='GET')
+
+
+def approve_upstream(payment_id, txid=None):
+    """
+    Aprueba el pago en la API de Pi Network y devuelve el cuerpo de respuesta de la ruta.
+    """
+    approve_url = f"{PI_API_BASE_URL}/payments/{payment_id}/approve"
+    approval_result = make_api_request(approve_url, method='POST', data={})
+    return _approved_body(payment_id, approval_result)
+
+
+def _approved_body(payment_id, approval_result):
+    _track(payment_id, 'approved', approval_result)
+    return {
+        'status': 'approved',
+        'paymentId': payment_id,
+        'message': 'Pago aprobado correctamente'
+    }
+
+
+def complete_upstream(payment_id, txid, access_token=None):
+    """
+    Completa el pago en la API de Pi Network y devuelve el cuerpo de respuesta de la ruta.
+    """
+    complete_url = f"{PI_API_BASE_URL}/payments/{payment_id}/complete"
+    completion_result = make_api_request(complete_url, method='POST', data={'txid': txid})
+    return _completed_body(payment_id, txid, access_token, completion_result)
+
+
+def _completed_body(payment_id, txid, access_token, completion_result):
+    logger.debug('Pago completado correctamente: %s', completion_result)
+    _track(payment_id, 'completed', completion_result, txid)
+
+    # El balance del usuario cambió: olvidar sus datos de /me y /wallet cacheados
+    if isinstance(completion_result, dict):
+        user_cache.invalidate_user(completion_result.get('user_uid'))
+    if access_token:
+        user_cache.invalidate_token(access_token)
+
+    return {
+        'status': 'completed',
+        'paymentId': payment_id,
+        'txid': txid,
+        'message': 'Pago completado correctamente'
+    }
+
+
+def approve_once(payment_id, idempotency_key=None):
+    """
+    approve_upstream() pasando por el registro de idempotencia: si el pago ya
+    se aprobó (o se está aprobando) no se repite la llamada a la API.
+    Devuelve (cuerpo, repetido); lanza payment_ledger.IdempotencyMismatch si
+    se repite con otra Idempotency-Key.
+    """
+    key = payment_ledger.ledger_key('approve', payment_id)
+    return payment_ledger.run(key, lambda: approve_upstream(payment_id), idempotency_key)
+
+
+def complete_once(payment_id, txid, access_token=None, idempotency_key=None):
+    """
+    Igual que approve_once() para complete_upstream().
+    """
+    key = payment_ledger.ledger_key('complete', payment_id)
+    return payment_ledger.run(key, lambda: complete_upstream(payment_id, txid, access_token), idempotency_key)
+
+
+def _idempotency_key():
+    return request.headers.get('Idempotency-Key') or None
+
+
+def _mismatch_response(error, payment_id):
+    logger.warning('Idempotency-Key distinta para el pago %s: %s', payment_id, error)
+    return jsonify({
+        'error': str(error),
+        'status': 'failed',
+        'paymentId': payment_id
+    }), 409
+
+
+def _ledger_response(body, replayed):
+    response = jsonify(body)
+    if replayed:
+        response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+# Los trabajos en segundo plano ejecutan las mismas llamadas que las rutas síncronas
+payment_jobs.register_action('approve', lambda payment_id, txid=None: approve_once(payment_id)[0])
+payment_jobs.register_action('complete', lambda payment_id, txid: complete_once(payment_id, txid)[0])
+payment_store.register_fetcher(fetch_payment)
+
+
+def start_background():
+    """
+    Arranca los hilos de pagos de este worker. Lo llama backend/warmup.py ya
+    en el worker (no al registrar el blueprint, que con preload ocurre en el
+    maestro antes del fork).
+    """
+    # Retomar los trabajos que quedaron pendientes antes de un reinicio
+    payment_jobs.start()
+    # Sincronizar periódicamente los pagos abiertos con la API
+    payment_store.start()
+
+
+def _wants_async(data):
+    """
+    El cliente pide modo asíncrono con {"async": true} o ?async=1.
+    """
+    flag = data.get('async') if isinstance(data, dict) else None
+    if flag is None:
+        flag = request.args.get('async')
+    return flag in (True, 1, '1', 'true', 'True')
+
+
+def _enqueue_response(action, payment_id, txid=None):
+    """
+    Encola el trabajo y responde 202 con su jobId (503 si la cola está llena).
+    """
+    try:
+        job = payment_jobs.enqueue(action, payment_id, txid)
+    except payment_jobs.QueueFull as e:
+        logger.warning('No se pudo encolar %s para %s: %s', action, payment_id, e)
+        return jsonify({
+            'error': 'Cola de pagos llena, inténtalo de nuevo más tarde',
+            'status': 'failed',
+            'paymentId': payment_id
+        }), 503
+    return jsonify({
+        'status': 'queued',
+        'jobId': job['jobId'],
+        'paymentId': payment_id,
+        'statusUrl': f"{payment_routes.url_prefix}/status/{job['jobId']}"
+    }), 202
+
 
 @payment_routes.route('/approve', methods=['POST'])
 def approve_payment():
@@ -74,20 +338,32 @@ def approve_payment():
             return jsonify({'error': 'ID de pago no proporcionado'}), 400
 
         payment_id = data['paymentId']
-        logger.debug(f'Aprobando pago: {payment_id}')
+        logger.debug('Aprobando pago: %s', payment_id)
+
+        # Verificar que tenemos la API Key
+        if not api_key():
+            logger.error('No se encontró la API Key de Pi Network en las variables de entorno')
+            return jsonify({
+                'error': 'Configuración de servidor incompleta (API Key faltante)',
+                'status': 'failed',
+                'paymentId': payment_id
+            }), 500
+
+        # Modo asíncrono: encolar y responder con el jobId
+        if _wants_async(data):
+            return _enqueue_response('approve', payment_id)
 
         # Hacer la petición a la API
-        approve_url = f"{PI_API_BASE_URL}/payments/{payment_id}/approve"
-        result = make_api_request(approve_url, method='POST', data={})
-        
-        return jsonify({
-            'status': 'approved',
-            'paymentId': payment_id,
-            'message': 'Pago aprobado correctamente'
-        })
+        return _ledger_response(*approve_once(payment_id, _idempotency_key()))
+
+    except pi_client.CircuitOpenError as e:
+        return pi_client.unavailable_response(e)
+
+    except payment_ledger.IdempotencyMismatch as e:
+        return _mismatch_response(e, payment_id)
         
     except ValueError as e:
-        logger.error(f'Error de autenticación: {str(e)}')
+        logger.error('Error de autenticación: %s', e)
         return jsonify({
             'error': str(e),
             'status': 'failed',
@@ -95,7 +371,7 @@ def approve_payment():
         }), 401
         
     except Exception as e:
-        logger.error(f'Error al aprobar pago: {str(e)}')
+        logger.error('Error al aprobar pago: %s', e)
         return jsonify({
             'error': f'Error interno del servidor: {str(e)}',
             'status': 'failed',
@@ -104,7 +380,7 @@ def approve_payment():
 
         # Verificar respuesta
         if response.status_code != 200:
-            logger.error(f'Error al aprobar pago: {response.text}')
+            logger.error('Error al aprobar pago: %s', response.text)
             return jsonify({
                 'error': f'Error al aprobar pago: {response.text}',
                 'status': 'failed',
@@ -113,7 +389,7 @@ def approve_payment():
 
         # Procesar respuesta
         approval_result = response.json()
-        logger.debug(f'Pago aprobado correctamente: {approval_result}')
+        logger.debug('Pago aprobado correctamente: %s', approval_result)
 
         return jsonify({
             'status': 'approved',
@@ -144,18 +420,18 @@ def complete_payment():
         txid = data.get('txid')
         debug = data.get('debug')
         
-        logger.debug(f'Completando pago: {payment_id}, txid: {txid}, debug: {debug}')
+        logger.debug('Completando pago: %s, txid: %s, debug: %s', payment_id, txid, debug)
 
         # Si es una cancelación o un error simulado para propósitos de depuración
         if debug == 'cancel':
-            logger.info(f'Pago {payment_id} fue cancelado (modo depuración)')
+            logger.info('Pago %s fue cancelado (modo depuración)', payment_id)
             return jsonify({
                 'status': 'cancelled',
                 'paymentId': payment_id,
                 'message': 'Pago cancelado correctamente'
             })
         elif debug == 'error':
-            logger.info(f'Pago {payment_id} tuvo un error (modo depuración)')
+            logger.info('Pago %s tuvo un error (modo depuración)', payment_id)
             return jsonify({
                 'status': 'error',
                 'paymentId': payment_id,
@@ -164,7 +440,7 @@ def complete_payment():
 
         # Para completar un pago real, necesitamos el txid
         if not txid:
-            logger.warning(f'No se proporcionó txid para el pago {payment_id}')
+            logger.warning('No se proporcionó txid para el pago %s', payment_id)
             return jsonify({
                 'status': 'incomplete',
                 'paymentId': payment_id,
@@ -172,7 +448,7 @@ def complete_payment():
             }), 400
 
         # Verificar que tenemos la API Key
-        if not PI_API_KEY:
+        if not api_key():
             logger.error('No se encontró la API Key de Pi Network en las variables de entorno')
             return jsonify({
                 'error': 'Configuración de servidor incompleta (API Key faltante)',
@@ -180,56 +456,18 @@ def complete_payment():
                 'paymentId': payment_id
             }), 500
 
-        # Configurar headers para la petición a la API de Pi Network
-        server_headers = {
-            'Authorization': f'Key {PI_API_KEY}',
-            'Content-Type': 'application/json'
-        }
-
-        # Datos para la petición
-        complete_data = {
-            'txid': txid
-        }
+        # Modo asíncrono: encolar y responder con el jobId
+        if _wants_async(data):
+            return _enqueue_response('complete', payment_id, txid)
 
         # Hacer la petición a la API de Pi Network
-        complete_url = f"{PI_API_BASE_URL}/payments/{payment_id}/complete"
-        
-        try:
-            response = requests.post(complete_url, json=complete_data, headers=server_headers, timeout=10)
-            
-            # Verificar si es un error de autenticación específico
-            if response.status_code == 401:
-                logger.error(f'Error de autenticación: {response.text}')
-                raise ValueError('Error de autenticación. Por favor, verifica que la API key es correcta y tiene los permisos necesarios.')
-                
-            response.raise_for_status()  # Lanzar excepción para códigos de error HTTP
-            
-        except requests.exceptions.RequestException as e:
-            logger.error(f'Error en la petición HTTP: {str(e)}')
-            raise
+        return _ledger_response(*complete_once(payment_id, txid, data.get('accessToken'), _idempotency_key()))
 
-        # Verificar respuesta
-        if response.status_code != 200:
-            logger.error(f'Error al completar pago: {response.text}')
-            return jsonify({
-                'error': f'Error al completar pago: {response.text}',
-                'status': 'failed',
-                'paymentId': payment_id
-            }), response.status_code
-
-        # Procesar respuesta
-        completion_result = response.json()
-        logger.debug(f'Pago completado correctamente: {completion_result}')
-        
-        # Aquí podrías añadir lógica adicional como actualizar una base de datos,
-        # enviar notificaciones, etc.
+    except pi_client.CircuitOpenError as e:
+        return pi_client.unavailable_response(e)
 
-        return jsonify({
-            'status': 'completed',
-            'paymentId': payment_id,
-            'txid': txid,
-            'message': 'Pago completado correctamente'
-        })
+    except payment_ledger.IdempotencyMismatch as e:
+        return _mismatch_response(e, payment_id)
 
     except Exception as e:
         logger.exception('Error al completar pago')
@@ -251,41 +489,137 @@ def cancel_payment():
             return jsonify({'error': 'ID de pago no proporcionado'}), 400
 
         payment_id = data['paymentId']
-        logger.debug(f'Cancelando pago: {payment_id}')
+        logger.debug('Cancelando pago: %s', payment_id)
 
         # Verificar que tenemos la API Key
-        if not PI_API_KEY:
+        if not api_key():
             logger.error('No se encontró la API Key de Pi Network en las variables de entorno')
             return jsonify({'error': 'Configuración de servidor incompleta (API Key faltante)'}), 500
 
-        # Configurar headers para la petición a la API de Pi Network
-        server_headers = {
-            'Authorization': f'Key {PI_API_KEY}'
-        }
-
         # Hacer la petición a la API de Pi Network
-        cancel_url = f"https://api.minepi.com/v2/payments/{payment_id}/cancel"
-        response = requests.post(cancel_url, json={}, headers=server_headers)
-
-        # Verificar respuesta
-        if response.status_code != 200:
-            logger.error(f'Error al cancelar pago: {response.text}')
-            return jsonify({'error': f'Error al cancelar pago: {response.text}'}), response.status_code
+        cancel_url = f"{PI_API_BASE_URL}/payments/{payment_id}/cancel"
+        try:
+            cancellation_result = make_api_request(cancel_url, method='POST', data={})
+        except requests.exceptions.HTTPError as e:
+            logger.error('Error al cancelar pago: %s', e.response.text)
+            return jsonify({'error': f'Error al cancelar pago: {e.response.text}'}), e.response.status_code
+        except ValueError as e:
+            return jsonify({'error': f'Error al cancelar pago: {str(e)}'}), 401
 
-        # Procesar respuesta
-        cancellation_result = response.json()
-        logger.debug(f'Pago cancelado correctamente: {cancellation_result}')
+        logger.debug('Pago cancelado correctamente: %s', cancellation_result)
+        _track(payment_id, 'cancelled', cancellation_result)
 
         return jsonify(cancellation_result)
 
+    except pi_client.CircuitOpenError as e:
+        return pi_client.unavailable_response(e)
+
     except Exception as e:
         logger.exception('Error al cancelar pago')
         return jsonify({'error': f'Error interno del servidor: {str(e)}'}), 500
 
+def _run_batch_item(item):
+    """
+    Ejecuta una operación del lote y devuelve su resultado sin lanzar excepciones.
+    """
+    payment_id = item.get('paymentId') if isinstance(item, dict) else None
+    action = item.get('action') if isinstance(item, dict) else None
+    txid = item.get('txid') if isinstance(item, dict) else None
+    base = {'paymentId': payment_id, 'action': action}
+
+    if not payment_id:
+        return {**base, 'ok': False, 'statusCode': 400, 'error': 'ID de pago no proporcionado'}
+    if action not in ('approve', 'complete'):
+        return {**base, 'ok': False, 'statusCode': 400, 'error': f'Acción no soportada: {action}'}
+    if action == 'complete' and not txid:
+        return {**base, 'ok': False, 'statusCode': 400, 'error': 'ID de transacción no proporcionado'}
+
+    try:
+        if action == 'approve':
+            result, _ = approve_once(payment_id)
+        else:
+            result, _ = complete_once(payment_id, txid)
+        return {**base, 'ok': True, 'statusCode': 200, 'result': result}
+    except pi_client.CircuitOpenError as e:
+        return {**base, 'ok': False, 'statusCode': 503, 'error': str(e), 'retryAfter': math.ceil(e.retry_after)}
+    except requests.exceptions.HTTPError as e:
+        status_code = e.response.status_code if e.response is not None else 502
+        return {**base, 'ok': False, 'statusCode': status_code, 'error': e.response.text if e.response is not None else str(e)}
+    except ValueError as e:
+        return {**base, 'ok': False, 'statusCode': 401, 'error': str(e)}
+    except Exception as e:
+        logger.error('Error en lote para %s (%s): %s', payment_id, action, e)
+        return {**base, 'ok': False, 'statusCode': 500, 'error': f'Error interno del servidor: {str(e)}'}
+
+
+@payment_routes.route('/batch', methods=['POST'])
+def batch_payments():
+    """
+    Aprueba o completa varios pagos a la vez, con llamadas concurrentes a la API.
+    Recibe {"payments": [{paymentId, action, txid}], "concurrency": N}
+    """
+    try:
+        data = request.get_json()
+        items = data.get('payments') if isinstance(data, dict) else data
+        if not isinstance(items, list) or not items:
+            return jsonify({'error': 'Lista de pagos no proporcionada'}), 400
+        if len(items) > BATCH_MAX_ITEMS:
+            return jsonify({'error': f'Máximo {BATCH_MAX_ITEMS} pagos por lote'}), 400
+
+        if not api_key():
+            logger.error('No se encontró la API Key de Pi Network en las variables de entorno')
+            return jsonify({'error': 'Configuración de servidor incompleta (API Key faltante)'}), 500
+
+        concurrency = BATCH_CONCURRENCY
+        if isinstance(data, dict) and isinstance(data.get('concurrency'), int) and data['concurrency'] > 0:
+            concurrency = min(data['concurrency'], BATCH_CONCURRENCY)
+        concurrency = min(concurrency, len(items))
+
+        logger.debug('Procesando lote de %s pagos con concurrencia %s', len(items), concurrency)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(_run_batch_item, items))
+
+        succeeded = sum(1 for r in results if r['ok'])
+        return jsonify({
+            'total': len(results),
+            'succeeded': succeeded,
+            'failed': len(results) - succeeded,
+            'results': results
+        })
+
+    except Exception as e:
+        logger.exception('Error al procesar lote de pagos')
+        return jsonify({'error': f'Error interno del servidor: {str(e)}'}), 500
+
+@payment_routes.route('/status/<job_id>', methods=['GET'])
+def get_job_status(job_id):
+    """
+    Devuelve el estado de un trabajo de pago encolado en modo asíncrono
+    """
+    job = payment_jobs.get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Trabajo no encontrado', 'jobId': job_id}), 404
+    return jsonify(job)
+
+def _incomplete_response(status_code, user_data):
+    """
+    Pagos abiertos del usuario desde el almacén local (sin llamar a la API de pagos).
+    """
+    if status_code != 200:
+        # Mismo contrato que antes del almacén local: 200 con la lista vacía y un aviso
+        logger.warning('Token no válido al buscar pagos incompletos: %s', user_data)
+        return jsonify({'pendingPayments': [], 'warning': 'Token de acceso inválido'})
+
+    pending = payment_store.open_payments(user_data.get('uid'))
+    logger.debug('Pagos incompletos encontrados: %s', pending)
+    return jsonify({'pendingPayments': pending})
+
+
 @payment_routes.route('/incomplete', methods=['POST'])
 def get_incomplete_payments():
     """
-    Obtiene la lista de pagos incompletos para un usuario
+    Obtiene la lista de pagos incompletos (aprobados y sin completar ni
+    cancelar) del usuario del token, desde el almacén local de pagos
     """
     try:
         # Obtener el token de acceso desde el frontend
@@ -294,34 +628,247 @@ def get_incomplete_payments():
             return jsonify({'error': 'Token de acceso no proporcionado'}), 400
 
         access_token = data['accessToken']
-        logger.debug(f'Buscando pagos incompletos con token: {access_token[:10]}...')
+        logger.debug('Buscando pagos incompletos con token: %s...', access_token[:10])
 
-        # Configurar headers para la petición a la API de Pi Network
-        user_headers = {
-            'Authorization': f'Bearer {access_token}'
-        }
+        # El uid sale de la caché de /me (el frontend ya lo pidió al autenticarse)
+        status_code, user_data = fetch_user(access_token)
+        return _incomplete_response(status_code, user_data)
 
-        # Hacer la petición a la API de Pi Network
-        # Nota: Este endpoint exacto puede no existir, esto es un ejemplo
-        payments_url = "https://api.minepi.com/v2/payments/incomplete"
-        
+    except pi_client.CircuitOpenError as e:
+        return pi_client.unavailable_response(e)
+
+    except Exception as e:
+        logger.exception('Error al buscar pagos incompletos')
+        return jsonify({'error': f'Error interno del servidor: {str(e)}'}), 500
+
+# --- Versiones asíncronas (modo ASGI, ver asgi.py) ---
+# Solo el camino que llama a la API de Pi es asíncrono; las validaciones, el
+# modo depuración y el encolado se delegan en las vistas síncronas de arriba,
+# que no hacen E/S de red, para que las respuestas sean idénticas.
+
+async def make_api_request_async(url, method='POST', data=None):
+    """
+    Versión asíncrona de make_api_request() (comparte el formato negociado).
+    """
+    try:
+        for attempt, scheme in enumerate(_schemes_to_try()):
+            headers = {**server_headers, 'Authorization': f'{scheme} {api_key()}'}
+            with tracing.span('pi_auth_scheme', scheme=scheme) as detail:
+                response = await pi_client.arequest(method, url, json=data, headers=headers)
+                detail['status'] = response.status_code
+            if response.status_code != 401:
+                break
+            logger.warning('Intento con %s falló con 401: %s', scheme, response.text)
+        else:
+            _all_schemes_failed()
+
+        _remember_scheme(scheme, attempt)
+
+        if response.status_code >= 400:
+            raise requests.exceptions.HTTPError(
+                f'{response.status_code} Error: {response.reason_phrase} for url: {url}', response=response
+            )
+        return response.json()
+
+    except requests.exceptions.RequestException as e:
+        logger.error('Error en la petición HTTP: %s', e)
+        raise
+
+    except ValueError as e:
+        logger.error('Error de autenticación: %s', e)
+        raise
+
+
+async def approve_upstream_async(payment_id, txid=None):
+    approve_url = f"{PI_API_BASE_URL}/payments/{payment_id}/approve"
+    approval_result = await make_api_request_async(approve_url, method='POST', data={})
+    return _approved_body(payment_id, approval_result)
+
+
+async def complete_upstream_async(payment_id, txid, access_token=None):
+    complete_url = f"{PI_API_BASE_URL}/payments/{payment_id}/complete"
+    completion_result = await make_api_request_async(complete_url, method='POST', data={'txid': txid})
+    return _completed_body(payment_id, txid, access_token, completion_result)
+
+
+async def approve_once_async(payment_id, idempotency_key=None):
+    key = payment_ledger.ledger_key('approve', payment_id)
+    return await payment_ledger.run_async(key, lambda: approve_upstream_async(payment_id), idempotency_key)
+
+
+async def complete_once_async(payment_id, txid, access_token=None, idempotency_key=None):
+    key = payment_ledger.ledger_key('complete', payment_id)
+    return await payment_ledger.run_async(
+        key, lambda: complete_upstream_async(payment_id, txid, access_token), idempotency_key
+    )
+
+
+async def approve_payment_async():
+    data = request.get_json(silent=True)
+    if not data or 'paymentId' not in data or not api_key() or _wants_async(data):
+        return approve_payment()
+
+    payment_id = data['paymentId']
+    try:
+        return _ledger_response(*await approve_once_async(payment_id, _idempotency_key()))
+
+    except pi_client.CircuitOpenError as e:
+        return pi_client.unavailable_response(e)
+
+    except payment_ledger.IdempotencyMismatch as e:
+        return _mismatch_response(e, payment_id)
+
+    except ValueError as e:
+        logger.error('Error de autenticación: %s', e)
+        return jsonify({
+            'error': str(e),
+            'status': 'failed',
+            'paymentId': payment_id
+        }), 401
+
+    except Exception as e:
+        logger.error('Error al aprobar pago: %s', e)
+        return jsonify({
+            'error': f'Error interno del servidor: {str(e)}',
+            'status': 'failed',
+            'paymentId': payment_id
+        }), 500
+
+
+async def complete_payment_async():
+    data = request.get_json(silent=True)
+    if (not data or 'paymentId' not in data or data.get('debug') in ('cancel', 'error')
+            or not data.get('txid') or not api_key() or _wants_async(data)):
+        return complete_payment()
+
+    payment_id = data['paymentId']
+    try:
+        return _ledger_response(*await complete_once_async(
+            payment_id, data['txid'], data.get('accessToken'), _idempotency_key()
+        ))
+
+    except pi_client.CircuitOpenError as e:
+        return pi_client.unavailable_response(e)
+
+    except payment_ledger.IdempotencyMismatch as e:
+        return _mismatch_response(e, payment_id)
+
+    except Exception as e:
+        logger.exception('Error al completar pago')
+        return jsonify({
+            'error': f'Error interno del servidor: {str(e)}',
+            'status': 'failed',
+            'paymentId': payment_id
+        }), 500
+
+
+async def cancel_payment_async():
+    data = request.get_json(silent=True)
+    if not data or 'paymentId' not in data or not api_key():
+        return cancel_payment()
+
+    payment_id = data['paymentId']
+    try:
+        cancel_url = f"{PI_API_BASE_URL}/payments/{payment_id}/cancel"
+        try:
+            cancellation_result = await make_api_request_async(cancel_url, method='POST', data={})
+        except requests.exceptions.HTTPError as e:
+            logger.error('Error al cancelar pago: %s', e.response.text)
+            return jsonify({'error': f'Error al cancelar pago: {e.response.text}'}), e.response.status_code
+        except ValueError as e:
+            return jsonify({'error': f'Error al cancelar pago: {str(e)}'}), 401
+
+        logger.debug('Pago cancelado correctamente: %s', cancellation_result)
+        _track(payment_id, 'cancelled', cancellation_result)
+
+        return jsonify(cancellation_result)
+
+    except pi_client.CircuitOpenError as e:
+        return pi_client.unavailable_response(e)
+
+    except Exception as e:
+        logger.exception('Error al cancelar pago')
+        return jsonify({'error': f'Error interno del servidor: {str(e)}'}), 500
+
+
+async def _run_batch_item_async(item, semaphore):
+    payment_id = item.get('paymentId') if isinstance(item, dict) else None
+    action = item.get('action') if isinstance(item, dict) else None
+    txid = item.get('txid') if isinstance(item, dict) else None
+    base = {'paymentId': payment_id, 'action': action}
+
+    if not payment_id or action not in ('approve', 'complete') or (action == 'complete' and not txid):
+        # Errores de validación: mismo resultado que la versión síncrona
+        return _run_batch_item(item)
+
+    async with semaphore:
         try:
-            response = requests.get(payments_url, headers=user_headers)
-            
-            # Si el endpoint existe y responde correctamente
-            if response.status_code == 200:
-                payments_data = response.json()
-                logger.debug(f'Pagos incompletos encontrados: {payments_data}')
-                return jsonify({'pendingPayments': payments_data})
+            if action == 'approve':
+                result, _ = await approve_once_async(payment_id)
             else:
-                # Si la API no tiene el endpoint, devolvemos una lista vacía
-                logger.warning(f'No se pudo obtener pagos pendientes de la API: {response.text}')
-                return jsonify({'pendingPayments': [], 'warning': 'Endpoint no disponible'})
-                
-        except Exception as api_error:
-            logger.error(f'Error al verificar pagos pendientes con la API: {str(api_error)}')
-            return jsonify({'pendingPayments': [], 'error': str(api_error)})
+                result, _ = await complete_once_async(payment_id, txid)
+            return {**base, 'ok': True, 'statusCode': 200, 'result': result}
+        except pi_client.CircuitOpenError as e:
+            return {**base, 'ok': False, 'statusCode': 503, 'error': str(e), 'retryAfter': math.ceil(e.retry_after)}
+        except requests.exceptions.HTTPError as e:
+            status_code = e.response.status_code if e.response is not None else 502
+            return {**base, 'ok': False, 'statusCode': status_code, 'error': e.response.text if e.response is not None else str(e)}
+        except ValueError as e:
+            return {**base, 'ok': False, 'statusCode': 401, 'error': str(e)}
+        except Exception as e:
+            logger.error('Error en lote para %s (%s): %s', payment_id, action, e)
+            return {**base, 'ok': False, 'statusCode': 500, 'error': f'Error interno del servidor: {str(e)}'}
+
+
+async def batch_payments_async():
+    data = request.get_json(silent=True)
+    items = data.get('payments') if isinstance(data, dict) else data
+    if not isinstance(items, list) or not items or len(items) > BATCH_MAX_ITEMS or not api_key():
+        return batch_payments()
+
+    try:
+        concurrency = BATCH_CONCURRENCY
+        if isinstance(data, dict) and isinstance(data.get('concurrency'), int) and data['concurrency'] > 0:
+            concurrency = min(data['concurrency'], BATCH_CONCURRENCY)
+
+        logger.debug('Procesando lote de %s pagos con concurrencia %s', len(items), concurrency)
+        semaphore = asyncio.Semaphore(concurrency)
+        results = await asyncio.gather(*(_run_batch_item_async(item, semaphore) for item in items))
+
+        succeeded = sum(1 for r in results if r['ok'])
+        return jsonify({
+            'total': len(results),
+            'succeeded': succeeded,
+            'failed': len(results) - succeeded,
+            'results': results
+        })
+
+    except Exception as e:
+        logger.exception('Error al procesar lote de pagos')
+        return jsonify({'error': f'Error interno del servidor: {str(e)}'}), 500
+
+
+async def get_incomplete_payments_async():
+    data = request.get_json(silent=True)
+    if not data or 'accessToken' not in data:
+        return get_incomplete_payments()
+
+    try:
+        status_code, user_data = await fetch_user_async(data['accessToken'])
+        return _incomplete_response(status_code, user_data)
+
+    except pi_client.CircuitOpenError as e:
+        return pi_client.unavailable_response(e)
 
     except Exception as e:
         logger.exception('Error al buscar pagos incompletos')
         return jsonify({'error': f'Error interno del servidor: {str(e)}'}), 500
+
+# Nombre de la vista síncrona -> versión asíncrona (/status no llama a la API)
+async_views = {
+    'approve_payment': approve_payment_async,
+    'complete_payment': complete_payment_async,
+    'cancel_payment': cancel_payment_async,
+    'batch_payments': batch_payments_async,
+    'get_incomplete_payments': get_incomplete_payments_async,
+}
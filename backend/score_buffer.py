@@ -0,0 +1,199 @@
+import os
+import time
+import atexit
+import threading
+import logging
+from datetime import datetime
+from backend import leaderboard_store, leaderboard_stream, tracing
+from backend.leaderboard_index import leaderboard_index
+
+"""
+Buffer de escritura agrupada (group commit) para los puntajes de dribble_play.
+Las partidas se acumulan en memoria quedándose con el máximo por dirección,
+y un hilo en segundo plano las escribe en leaderboard_store en un solo
+commit (con un fsync por lote) cada SCORE_FLUSH_INTERVAL_MS milisegundos o
+cuando se juntan SCORE_FLUSH_MAX_BATCH direcciones.
+
+SCORE_DURABILITY:
+  flush  -> la petición responde cuando su lote ya está escrito (por defecto)
+  buffer -> la petición responde en cuanto el puntaje entra al buffer
+"""
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = float(os.getenv('SCORE_FLUSH_INTERVAL_MS', '50')) / 1000
+FLUSH_MAX_BATCH = int(os.getenv('SCORE_FLUSH_MAX_BATCH', '500'))
+DURABILITY = os.getenv('SCORE_DURABILITY', 'flush')
+# Máximo que una petición espera a que su lote se escriba
+FLUSH_WAIT_TIMEOUT = float(os.getenv('SCORE_FLUSH_WAIT_TIMEOUT', '10'))
+
+if DURABILITY not in ('flush', 'buffer'):
+    raise ValueError(f"SCORE_DURABILITY debe ser 'flush' o 'buffer', no '{DURABILITY}'")
+
+
+class FlushError(Exception):
+    """
+    El lote que contenía el puntaje no se pudo escribir.
+    """
+
+
+class _Batch:
+    __slots__ = ('entries', 'done', 'errors')
+
+    def __init__(self):
+        # address -> (score, timestamp)
+        self.entries = {}
+        self.done = threading.Event()
+        # address -> excepción, para las entradas que no se pudieron escribir
+        self.errors = {}
+
+
+_cond = threading.Condition()
+_batch = _Batch()
+_started_pid = None
+_stats = {
+    'submitted': 0,
+    'merged': 0,
+    'flushes': 0,
+    'flush_errors': 0,
+    'entry_errors': 0,
+    'batch_size_max': 0,
+    'batch_size_total': 0,
+    'flush_seconds_total': 0.0,
+    'flush_seconds_max': 0.0,
+}
+
+
+@tracing.traced('lb_write')
+def submit(address, score):
+    """
+    Añade un puntaje al buffer. En modo 'flush' espera a que se escriba y
+    lanza FlushError si el lote falló.
+    """
+    _ensure_flusher()
+    timestamp = datetime.utcnow().isoformat()
+    with _cond:
+        batch = _batch
+        current = batch.entries.get(address)
+        _stats['submitted'] += 1
+        if current is None or score > current[0]:
+            batch.entries[address] = (score, timestamp)
+        if current is not None:
+            _stats['merged'] += 1
+        # Despertar al hilo de escritura con el primer puntaje del lote o al llenarlo
+        if len(batch.entries) == 1 or len(batch.entries) >= FLUSH_MAX_BATCH:
+            _cond.notify()
+
+    if DURABILITY == 'flush':
+        if not batch.done.wait(FLUSH_WAIT_TIMEOUT):
+            raise FlushError('Tiempo de espera agotado escribiendo el leaderboard')
+        error = batch.errors.get(address)
+        if error is not None:
+            raise FlushError(str(error))
+
+
+def flush():
+    """
+    Escribe el lote actual (también lo usa el hilo en segundo plano).
+    """
+    global _batch
+    with _cond:
+        batch = _batch
+        _batch = _Batch()
+    if not batch.entries:
+        batch.done.set()
+        return 0
+
+    started = time.perf_counter()
+    entries = [(address, score, timestamp) for address, (score, timestamp) in batch.entries.items()]
+    try:
+        leaderboard_store.upsert_many(entries, durable=True)
+    except Exception:
+        # Una entrada mala no debe tumbar a las demás del lote: reintentar una a una
+        logger.exception('Error escribiendo lote de %s puntajes; se reintentan uno a uno', len(entries))
+        _write_one_by_one(batch, entries)
+    elapsed = time.perf_counter() - started
+    batch.done.set()
+
+    size = len(batch.entries) - len(batch.errors)
+    if not size:
+        return 0
+
+    with _cond:
+        _stats['flushes'] += 1
+        _stats['batch_size_total'] += size
+        _stats['batch_size_max'] = max(_stats['batch_size_max'], size)
+        _stats['flush_seconds_total'] += elapsed
+        _stats['flush_seconds_max'] = max(_stats['flush_seconds_max'], elapsed)
+
+    leaderboard_index.sync()
+    # Los clientes de /dribble/stream reciben el cambio en la siguiente difusión
+    leaderboard_stream.notify()
+    return size
+
+
+def _write_one_by_one(batch, entries):
+    """
+    Escribe las entradas de un lote fallido por separado y apunta en
+    batch.errors las que vuelven a fallar.
+    """
+    for entry in entries:
+        try:
+            leaderboard_store.upsert_many([entry], durable=True)
+        except Exception as e:
+            logger.error('No se pudo guardar el puntaje de %s: %s', entry[0], e)
+            batch.errors[entry[0]] = e
+    with _cond:
+        _stats['flush_errors'] += 1
+        _stats['entry_errors'] += len(batch.errors)
+
+
+def _flusher_loop():
+    while True:
+        with _cond:
+            # Esperar al primer puntaje, y después como mucho FLUSH_INTERVAL
+            while not _batch.entries:
+                _cond.wait()
+            deadline = time.monotonic() + FLUSH_INTERVAL
+            while len(_batch.entries) < FLUSH_MAX_BATCH:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                _cond.wait(remaining)
+        # Un fallo al sincronizar el índice o avisar al stream no debe parar al escritor
+        try:
+            flush()
+        except Exception:
+            logger.exception('Error en el hilo de escritura de puntajes')
+
+
+def _ensure_flusher():
+    """
+    Arranca el hilo de escritura en este proceso (una vez, también tras un fork).
+    """
+    global _started_pid
+    if _started_pid == os.getpid():
+        return
+    with _cond:
+        if _started_pid == os.getpid():
+            return
+        threading.Thread(target=_flusher_loop, name='score-flusher', daemon=True).start()
+        _started_pid = os.getpid()
+
+
+# En modo 'buffer' no perder lo pendiente al apagar el worker
+atexit.register(flush)
+
+
+def stats():
+    """
+    Métricas del buffer: tamaño de lote y latencia de escritura.
+    """
+    with _cond:
+        stats = dict(_stats)
+        stats['pending'] = len(_batch.entries)
+    flushes = stats['flushes'] or 1
+    stats['batch_size_avg'] = stats['batch_size_total'] / flushes
+    stats['flush_seconds_avg'] = stats['flush_seconds_total'] / flushes
+    stats['durability'] = DURABILITY
+    return stats
@@ -0,0 +1,206 @@
+import os
+import gzip
+import hashlib
+import mimetypes
+import threading
+import time
+import logging
+from flask import Response, request, send_file
+
+try:
+    import brotli
+except ImportError:  # brotli es opcional: sin él solo se sirve gzip
+    brotli = None
+
+"""
+Índice de archivos estáticos del frontend construido al arrancar.
+Mapea cada URL a su archivo (sin comprobar el disco en cada petición),
+guarda en memoria los archivos pequeños junto con sus variantes gzip/brotli,
+y responde con ETag fuerte y 304 cuando el navegador ya tiene la versión.
+"""
+
+logger = logging.getLogger(__name__)
+
+# Archivos hasta este tamaño se guardan en memoria
+MAX_CACHED_BYTES = int(os.getenv('STATIC_MAX_CACHED_BYTES', str(512 * 1024)))
+# Tamaño mínimo para que compense comprimir
+MIN_COMPRESS_BYTES = 1024
+
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+ENCODING_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+
+class Asset:
+    __slots__ = ('path', 'mimetype', 'size', 'mtime', 'etag', 'body', 'variants')
+
+    def __init__(self, path, mimetype, size, mtime, etag, body, variants):
+        self.path = path
+        self.mimetype = mimetype
+        self.size = size
+        self.mtime = mtime
+        self.etag = etag
+        self.body = body
+        # codificación -> bytes comprimidos
+        self.variants = variants
+
+
+def _is_compressible(mimetype):
+    return any(mimetype.startswith(t) for t in COMPRESSIBLE_TYPES)
+
+
+def _load_asset(path):
+    stat = os.stat(path)
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    hasher = hashlib.sha256()
+    body = None
+    with open(path, 'rb') as f:
+        if stat.st_size <= MAX_CACHED_BYTES:
+            body = f.read()
+            hasher.update(body)
+        else:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                hasher.update(chunk)
+    etag = hasher.hexdigest()[:32]
+
+    variants = {}
+    if body is not None:
+        # Variantes precomprimidas en disco (archivo.js.br / archivo.js.gz)
+        for encoding, suffix in ENCODING_SUFFIXES.items():
+            if os.path.isfile(path + suffix):
+                with open(path + suffix, 'rb') as f:
+                    variants[encoding] = f.read()
+        # Si no existen, comprimir una vez en memoria
+        if len(body) >= MIN_COMPRESS_BYTES and _is_compressible(mimetype):
+            if 'gzip' not in variants:
+                variants['gzip'] = gzip.compress(body, compresslevel=9, mtime=0)
+            if 'br' not in variants and brotli is not None:
+                variants['br'] = brotli.compress(body)
+        # Solo vale la pena si de verdad es más pequeño
+        variants = {enc: data for enc, data in variants.items() if len(data) < len(body)}
+
+    return Asset(path, mimetype, stat.st_size, stat.st_mtime, etag, body, variants)
+
+
+class AssetIndex:
+    """
+    Manifiesto URL -> archivo de una carpeta de frontend.
+    Una URL se resuelve primero relativa a la carpeta raíz y después a cada
+    subcarpeta de `subfolders` (mismo orden que la búsqueda original).
+    """
+
+    def __init__(self, root, subfolders=('js', 'css', 'img', 'assets')):
+        self.root = str(root)
+        self.subfolders = subfolders
+        self._manifest = {}
+        self._lock = threading.Lock()
+        self._watcher = None
+        self.build()
+
+    def build(self):
+        """
+        Recorre la carpeta y reconstruye el manifiesto completo.
+        """
+        started = time.perf_counter()
+        assets = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for name in filenames:
+                if name.startswith('.') or name.endswith(('.gz', '.br')):
+                    continue
+                full = os.path.join(dirpath, name)
+                assets[os.path.relpath(full, self.root).replace(os.sep, '/')] = _load_asset(full)
+
+        manifest = dict(assets)
+        for sub in self.subfolders:
+            prefix = f'{sub}/'
+            for rel, asset in assets.items():
+                if rel.startswith(prefix):
+                    manifest.setdefault(rel[len(prefix):], asset)
+
+        with self._lock:
+            self._manifest = manifest
+        logger.info(
+            'Índice de estáticos: %s archivos en %.1f ms',
+            len(assets), (time.perf_counter() - started) * 1000
+        )
+
+    def reload(self):
+        """
+        Hook para desarrollo: vuelve a leer los archivos del disco.
+        """
+        self.build()
+
+    def _changed(self):
+        with self._lock:
+            assets = set(self._manifest.values())
+        for asset in assets:
+            try:
+                if os.stat(asset.path).st_mtime != asset.mtime:
+                    return True
+            except FileNotFoundError:
+                return True
+        count = sum(
+            1 for _, dirnames, filenames in os.walk(self.root)
+            for name in filenames if not name.startswith('.') and not name.endswith(('.gz', '.br'))
+        )
+        return count != len(assets)
+
+    def watch(self, interval=1.0):
+        """
+        Arranca un hilo que reconstruye el índice cuando cambian los archivos.
+        Pensado solo para desarrollo (FLASK_DEBUG).
+        """
+        if self._watcher is not None:
+            return
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    if self._changed():
+                        logger.info('Cambios en el frontend detectados, recargando estáticos')
+                        self.build()
+                except Exception:
+                    logger.exception('Error vigilando los archivos estáticos')
+
+        self._watcher = threading.Thread(target=loop, name='static-assets-watcher', daemon=True)
+        self._watcher.start()
+
+    def lookup(self, url_path):
+        return self._manifest.get(url_path)
+
+    def serve(self, url_path, mimetype=None):
+        """
+        Respuesta Flask para `url_path`, o None si no está en el índice.
+        """
+        asset = self.lookup(url_path)
+        if asset is None:
+            return None
+        mimetype = mimetype or asset.mimetype
+
+        if asset.body is None:
+            # Archivo grande: se transmite desde disco con el mismo ETag
+            response = send_file(asset.path, mimetype=mimetype, etag=asset.etag, conditional=True)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+
+        encoding = None
+        for candidate in ('br', 'gzip'):
+            if candidate in asset.variants and request.accept_encodings[candidate]:
+                encoding = candidate
+                break
+        # Cada representación tiene su propio ETag fuerte
+        etag = f'{asset.etag}-{encoding}' if encoding else asset.etag
+
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            body = asset.variants[encoding] if encoding else asset.body
+            response = Response(body, mimetype=mimetype)
+            if encoding:
+                response.headers['Content-Encoding'] = encoding
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        if asset.variants:
+            response.headers['Vary'] = 'Accept-Encoding'
+        return response
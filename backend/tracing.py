@@ -0,0 +1,347 @@
+import os
+import re
+import hmac
+import json
+import time
+import uuid
+import queue
+import threading
+import logging
+import contextvars
+from contextlib import contextmanager
+from functools import wraps
+from flask import Request, request, jsonify
+from backend.db import get_connection, transaction
+
+"""
+Trazas por petición: identificador, tramos (spans) con tiempos, cabecera
+Server-Timing y registro de peticiones lentas.
+
+Cada petición recibe un id (el X-Request-ID del cliente si es válido, o uno
+nuevo) que se devuelve en la respuesta y se envía en las llamadas a la API
+de Pi. Mientras dura se apuntan tramos con su inicio y duración:
+
+  pi_<familia>      cada llamada HTTP a la API de Pi (método, endpoint, estado)
+  pi_auth_scheme    cada formato de Authorization probado en make_api_request
+  upstream_queue    espera de un slot libre para llamar a la API (admission)
+  json_parse        lectura del JSON del cuerpo
+  lb_read/lb_write  lecturas y escrituras del leaderboard
+
+La respuesta lleva Server-Timing con el tiempo acumulado de cada tipo de
+tramo (visible en las herramientas de desarrollo del navegador). Si la
+petición tarda más de TRACE_SLOW_MS, el desglose completo se guarda en un
+buffer circular de TRACE_SLOW_LOG_SIZE entradas (SQLite, compartido entre
+workers; lo escribe un hilo en segundo plano para no bloquear la petición
+ni, en modo ASGI, el event loop) que se consulta en GET /admin/slow-requests con la cabecera
+X-Admin-Token (ADMIN_TOKEN; sin ella el endpoint no existe).
+
+El contexto es una ContextVar: lo ven las corrutinas de la petición (modo
+ASGI) pero no otros hilos, salvo que se lancen con copy_context().run.
+Fuera de una petición todas las funciones no hacen nada.
+"""
+
+logger = logging.getLogger(__name__)
+
+DB_NAME = 'tracing'
+
+# TRACING_ENABLED=0 desactiva las trazas
+ENABLED = os.getenv('TRACING_ENABLED', '1') not in ('0', 'false', 'False')
+# Peticiones más lentas que esto (ms) van al registro de lentas
+SLOW_MS = float(os.getenv('TRACE_SLOW_MS', '1000'))
+# Entradas que guarda el registro (las más antiguas se sobrescriben)
+SLOW_LOG_SIZE = int(os.getenv('TRACE_SLOW_LOG_SIZE', '200'))
+# Token para /admin/slow-requests
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+# Peticiones lentas pendientes de guardar como mucho (las que no caben se descartan)
+SLOW_QUEUE_SIZE = 1000
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+_VALID_REQUEST_ID = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+_current = contextvars.ContextVar('trace', default=None)
+
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+_writer_lock = threading.Lock()
+_writer_pid = None
+_slow_queue = None
+
+
+class Trace:
+    """
+    Id y tramos de una petición; cada tramo es (nombre, inicio, duración, detalle)
+    con tiempos en segundos relativos al inicio de la petición.
+    """
+    __slots__ = ('request_id', 'started', 'spans')
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.started = time.perf_counter()
+        # list.append es atómico: pueden añadir tramos varios hilos o corrutinas
+        self.spans = []
+
+
+def active():
+    return _current.get() is not None
+
+
+def request_id():
+    trace = _current.get()
+    return trace.request_id if trace is not None else None
+
+
+def record(name, started, seconds, **detail):
+    """
+    Apunta un tramo que empezó en `started` (time.perf_counter()) y duró `seconds`.
+    """
+    trace = _current.get()
+    if trace is not None:
+        trace.spans.append((name, started - trace.started, seconds, detail))
+
+
+@contextmanager
+def span(name, **detail):
+    """
+    Mide el bloque como un tramo. Devuelve el dict de detalle, que el bloque
+    puede completar (p.ej. con el estado de la respuesta).
+    """
+    trace = _current.get()
+    if trace is None:
+        yield detail
+        return
+    started = time.perf_counter()
+    try:
+        yield detail
+    finally:
+        trace.spans.append((name, started - trace.started, time.perf_counter() - started, detail))
+
+
+def traced(name):
+    """
+    Decorador: cada llamada a la función es un tramo `name`.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _current.get() is None:
+                return fn(*args, **kwargs)
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def propagate(headers):
+    """
+    Cabeceras de una llamada saliente con el id de la petición en curso.
+    """
+    trace = _current.get()
+    if trace is None:
+        return headers
+    return {**(headers or {}), REQUEST_ID_HEADER: trace.request_id}
+
+
+class TracedRequest(Request):
+    """
+    Request de Flask que mide la lectura del JSON del cuerpo.
+    """
+
+    def get_json(self, *args, **kwargs):
+        with span('json_parse'):
+            return super().get_json(*args, **kwargs)
+
+
+# -----------------------------
+# Hooks de la aplicación
+# -----------------------------
+def _start():
+    incoming = request.headers.get(REQUEST_ID_HEADER, '')
+    rid = incoming if _VALID_REQUEST_ID.match(incoming) else uuid.uuid4().hex
+    _current.set(Trace(rid))
+
+
+def _end(exc=None):
+    # Los hilos de gunicorn atienden muchas peticiones: no dejar la traza puesta
+    _current.set(None)
+
+
+def server_timing(trace, total):
+    """
+    Valor de Server-Timing: tiempo acumulado por tipo de tramo y el total.
+    """
+    totals = {}
+    for name, _, seconds, _ in trace.spans:
+        count, accumulated = totals.get(name, (0, 0.0))
+        totals[name] = (count + 1, accumulated + seconds)
+    parts = [
+        f'{name};dur={seconds * 1000:.1f}' + (f';desc="x{count}"' if count > 1 else '')
+        for name, (count, seconds) in sorted(totals.items(), key=lambda item: -item[1][1])
+    ]
+    parts.append(f'total;dur={total * 1000:.1f}')
+    return ', '.join(parts)
+
+
+def finish(response):
+    """
+    Añade X-Request-ID y Server-Timing a la respuesta (desde el after_request
+    de app.py) y guarda la petición si fue lenta.
+    """
+    trace = _current.get()
+    if trace is None:
+        return response
+    total = time.perf_counter() - trace.started
+    response.headers[REQUEST_ID_HEADER] = trace.request_id
+    response.headers['Server-Timing'] = server_timing(trace, total)
+    if total * 1000 >= SLOW_MS:
+        _log_slow(trace, total, response.status_code)
+    return response
+
+
+# -----------------------------
+# Registro de peticiones lentas
+# -----------------------------
+def _connection():
+    global _schema_ready
+    conn = get_connection(DB_NAME)
+    if not _schema_ready:
+        with _schema_lock:
+            if not _schema_ready:
+                # slot = número de entrada % SLOW_LOG_SIZE: la tabla nunca crece más
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS slow_requests (
+                        slot        INTEGER PRIMARY KEY,
+                        seq         INTEGER NOT NULL,
+                        request_id  TEXT NOT NULL,
+                        at          REAL NOT NULL,
+                        method      TEXT NOT NULL,
+                        route       TEXT NOT NULL,
+                        path        TEXT NOT NULL,
+                        status      INTEGER NOT NULL,
+                        duration_ms REAL NOT NULL,
+                        pid         INTEGER NOT NULL,
+                        spans       TEXT NOT NULL
+                    )
+                ''')
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS slow_requests_meta (
+                        key   TEXT PRIMARY KEY,
+                        value INTEGER NOT NULL
+                    )
+                ''')
+                conn.execute("INSERT OR IGNORE INTO slow_requests_meta (key, value) VALUES ('seq', 0)")
+                _schema_ready = True
+    return conn
+
+
+def _log_slow(trace, total, status):
+    """
+    Recoge los datos de la petición lenta y los deja en la cola del hilo que
+    los guarda: la escritura en SQLite puede esperar al lock de otro worker.
+    """
+    spans = [
+        {'name': name, 'startMs': round(start * 1000, 1), 'durationMs': round(seconds * 1000, 1), **detail}
+        for name, start, seconds, detail in sorted(trace.spans, key=lambda s: s[1])
+    ]
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    logger.warning(
+        'Petición lenta %s %s: %.0f ms (id %s, %s tramos)',
+        request.method, route, total * 1000, trace.request_id, len(spans)
+    )
+    row = (
+        trace.request_id, time.time(), request.method, route, request.path, status,
+        round(total * 1000, 1), os.getpid(), json.dumps(spans, default=str)
+    )
+    try:
+        _writer_queue().put_nowait(row)
+    except queue.Full:
+        logger.warning('Cola de peticiones lentas llena: se descarta %s', trace.request_id)
+
+
+def _writer_queue():
+    """
+    Cola del hilo que guarda las peticiones lentas de este proceso (se crea
+    de nuevo tras un fork).
+    """
+    global _slow_queue, _writer_pid
+    if _writer_pid != os.getpid():
+        with _writer_lock:
+            if _writer_pid != os.getpid():
+                _slow_queue = queue.Queue(SLOW_QUEUE_SIZE)
+                threading.Thread(
+                    target=_writer_loop, args=(_slow_queue,), name='slow-request-log', daemon=True
+                ).start()
+                _writer_pid = os.getpid()
+    return _slow_queue
+
+
+def _writer_loop(pending):
+    while True:
+        row = pending.get()
+        try:
+            _store_slow(row)
+        except Exception:
+            logger.exception('No se pudo guardar la petición lenta %s', row[0])
+
+
+def _store_slow(row):
+    conn = _connection()
+    with transaction(conn):
+        conn.execute("UPDATE slow_requests_meta SET value = value + 1 WHERE key = 'seq'")
+        seq = conn.execute("SELECT value FROM slow_requests_meta WHERE key = 'seq'").fetchone()[0]
+        conn.execute(
+            '''
+            INSERT OR REPLACE INTO slow_requests
+                (slot, seq, request_id, at, method, route, path, status, duration_ms, pid, spans)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''',
+            (seq % SLOW_LOG_SIZE, seq) + row
+        )
+
+
+def slow_requests(limit=50):
+    """
+    Últimas peticiones lentas (la más reciente primero) con su desglose.
+    """
+    rows = _connection().execute(
+        'SELECT * FROM slow_requests ORDER BY seq DESC LIMIT ?', (limit,)
+    ).fetchall()
+    return [
+        {
+            'requestId': row['request_id'],
+            'at': row['at'],
+            'method': row['method'],
+            'route': row['route'],
+            'path': row['path'],
+            'status': row['status'],
+            'durationMs': row['duration_ms'],
+            'pid': row['pid'],
+            'spans': json.loads(row['spans']),
+        }
+        for row in rows
+    ]
+
+
+def slow_requests_endpoint():
+    token = request.headers.get('X-Admin-Token', '')
+    if not hmac.compare_digest(token.encode('utf-8'), ADMIN_TOKEN.encode('utf-8')):
+        return jsonify({'error': 'No autorizado'}), 401
+    try:
+        limit = max(1, min(int(request.args.get('limit', 50)), SLOW_LOG_SIZE))
+    except ValueError:
+        return jsonify({'error': 'limit debe ser un número'}), 400
+    return jsonify({'thresholdMs': SLOW_MS, 'size': SLOW_LOG_SIZE, 'requests': slow_requests(limit)})
+
+
+def init_app(app):
+    """
+    Activa las trazas. Debe llamarse antes de registrar otros before_request
+    (admisión, métricas) para que también se midan.
+    """
+    if not ENABLED:
+        return
+    app.request_class = TracedRequest
+    app.before_request(_start)
+    app.teardown_request(_end)
+    if ADMIN_TOKEN:
+        app.add_url_rule('/admin/slow-requests', 'slow_requests', slow_requests_endpoint, methods=['GET'])
@@ -0,0 +1,180 @@
+import os
+import math
+import time
+import hashlib
+import threading
+import logging
+from backend.db import get_connection, transaction
+
+"""
+Índice persistente de transacciones (txid) ya usadas en partidas.
+Un txid solo puede registrar una partida: los ya consumidos se rechazan
+sin volver a consultar la blockchain. Un filtro de Bloom en memoria evita
+incluso la consulta a SQLite para los txid que seguro no se han visto.
+También guarda el resultado de cada verificación para no repetirla.
+"""
+
+logger = logging.getLogger(__name__)
+
+DB_NAME = 'txids'
+
+# Dimensionado del filtro de Bloom: capacidad esperada y tasa de falsos positivos
+BLOOM_CAPACITY = int(os.getenv('TXID_BLOOM_CAPACITY', '1000000'))
+BLOOM_ERROR_RATE = float(os.getenv('TXID_BLOOM_ERROR_RATE', '0.001'))
+# Cada cuánto se incorporan al filtro los txid consumidos por otros workers
+BLOOM_REFRESH_SECONDS = float(os.getenv('TXID_BLOOM_REFRESH_SECONDS', '1.0'))
+
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+
+def _connection():
+    global _schema_ready
+    conn = get_connection(DB_NAME)
+    if not _schema_ready:
+        with _schema_lock:
+            if not _schema_ready:
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS consumed_txids (
+                        txid        TEXT PRIMARY KEY,
+                        address     TEXT NOT NULL,
+                        consumed_at REAL NOT NULL
+                    )
+                ''')
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS verified_txids (
+                        txid       TEXT PRIMARY KEY,
+                        valid      INTEGER NOT NULL,
+                        checked_at REAL NOT NULL
+                    )
+                ''')
+                _schema_ready = True
+    return conn
+
+
+class BloomFilter:
+    """
+    Filtro de Bloom sobre un bytearray: puede dar falsos positivos, nunca falsos negativos.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+class TxidIndex:
+    """
+    Vista de este proceso sobre las tablas de txid, con el filtro de Bloom delante.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bloom = None
+        self._last_rowid = 0
+        self._refreshed_at = 0.0
+        self.stats = {'bloom_negative': 0, 'rejected': 0, 'verify_cache_hits': 0}
+
+    def _refresh(self, force=False):
+        """
+        Añade al filtro los txid consumidos desde la última lectura (de cualquier worker).
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._bloom is None:
+                self._bloom = BloomFilter(BLOOM_CAPACITY, BLOOM_ERROR_RATE)
+            elif not force and now - self._refreshed_at < BLOOM_REFRESH_SECONDS:
+                return
+            rows = _connection().execute(
+                'SELECT rowid, txid FROM consumed_txids WHERE rowid > ? ORDER BY rowid', (self._last_rowid,)
+            )
+            for rowid, txid in rows:
+                self._bloom.add(txid)
+                self._last_rowid = rowid
+            self._refreshed_at = now
+
+    def load(self):
+        """
+        Carga el filtro de Bloom con todos los txid consumidos (arranque del worker).
+        """
+        self._refresh(force=True)
+
+    def is_consumed(self, txid):
+        """
+        True si el txid ya registró una partida.
+        """
+        self._refresh()
+        if txid not in self._bloom:
+            self.stats['bloom_negative'] += 1
+            return False
+        row = _connection().execute('SELECT 1 FROM consumed_txids WHERE txid = ?', (txid,)).fetchone()
+        if row:
+            self.stats['rejected'] += 1
+        return row is not None
+
+    def consume(self, txid, address):
+        """
+        Marca el txid como usado. Devuelve False si ya lo estaba (p.ej. otro
+        worker lo consumió en paralelo); la clave primaria lo garantiza.
+        """
+        conn = _connection()
+        with transaction(conn):
+            cursor = conn.execute(
+                'INSERT OR IGNORE INTO consumed_txids (txid, address, consumed_at) VALUES (?, ?, ?)',
+                (txid, address, time.time())
+            )
+        if cursor.rowcount != 1:
+            self.stats['rejected'] += 1
+            return False
+        with self._lock:
+            if self._bloom is not None:
+                self._bloom.add(txid)
+        return True
+
+    def release(self, txid, address):
+        """
+        Deshace consume() cuando la partida no se pudo registrar, para que el
+        jugador pueda reintentarla con el mismo txid. El filtro de Bloom no
+        admite borrados: el txid seguirá pasando por SQLite, que ya no lo tiene.
+        """
+        conn = _connection()
+        with transaction(conn):
+            conn.execute('DELETE FROM consumed_txids WHERE txid = ? AND address = ?', (txid, address))
+
+    def verify(self, txid, checker):
+        """
+        Resultado de verificación del txid, consultando `checker(txid)` solo
+        si no hay uno guardado. `checker` devuelve True/False, o None si no
+        pudo comprobarlo (ese caso no se guarda).
+        """
+        conn = _connection()
+        row = conn.execute('SELECT valid FROM verified_txids WHERE txid = ?', (txid,)).fetchone()
+        if row is not None:
+            self.stats['verify_cache_hits'] += 1
+            return bool(row['valid'])
+        valid = checker(txid)
+        if valid is None:
+            return False
+        with transaction(conn):
+            conn.execute(
+                'INSERT OR REPLACE INTO verified_txids (txid, valid, checked_at) VALUES (?, ?, ?)',
+                (txid, 1 if valid else 0, time.time())
+            )
+        return valid
+
+
+# Índice compartido por las peticiones de este worker
+txid_index = TxidIndex()
@@ -0,0 +1,135 @@
+import os
+import asyncio
+import hashlib
+import threading
+import logging
+from backend.cache import TTLCache, SingleFlight
+
+"""
+Caché de las respuestas de /me y /wallet de la API de Pi Network por token
+de acceso. Las claves son el SHA-256 del token (el token nunca se guarda),
+y las peticiones concurrentes con el mismo token comparten una sola llamada.
+"""
+
+logger = logging.getLogger(__name__)
+
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', '300'))
+WALLET_CACHE_TTL = float(os.getenv('WALLET_CACHE_TTL', '30'))
+USER_CACHE_MAX_ENTRIES = int(os.getenv('USER_CACHE_MAX_ENTRIES', '10000'))
+
+_caches = {
+    'user': TTLCache(USER_CACHE_MAX_ENTRIES, USER_CACHE_TTL),
+    'wallet': TTLCache(USER_CACHE_MAX_ENTRIES, WALLET_CACHE_TTL),
+}
+_flight = SingleFlight()
+# Equivalente de _flight para el modo ASGI: (kind, key) -> tarea en curso
+_async_flights = {}
+
+# uid del usuario -> claves de token vistas, para invalidar tras un pago
+_uid_tokens = {}
+_uid_lock = threading.Lock()
+
+
+def token_key(access_token):
+    return hashlib.sha256(access_token.encode('utf-8')).hexdigest()
+
+
+def _remember_uid(key, payload):
+    uid = payload.get('uid') if isinstance(payload, dict) else None
+    if not uid:
+        return
+    with _uid_lock:
+        keys = _uid_tokens.setdefault(uid, set())
+        keys.add(key)
+        # Acotar por si un mismo usuario genera muchos tokens
+        while len(keys) > 16:
+            keys.pop()
+        if len(_uid_tokens) > USER_CACHE_MAX_ENTRIES:
+            _uid_tokens.pop(next(iter(_uid_tokens)))
+
+
+def fetch(kind, access_token, loader):
+    """
+    Devuelve (status_code, payload) para `kind` ('user' o 'wallet').
+    `loader()` hace la llamada real y devuelve (status_code, payload);
+    solo se guardan en caché las respuestas 200.
+    """
+    cache = _caches[kind]
+    key = token_key(access_token)
+    cached = cache.get(key)
+    if cached is not None:
+        return 200, cached
+
+    def load():
+        status_code, payload = loader()
+        if status_code == 200:
+            cache.set(key, payload)
+            _remember_uid(key, payload)
+        return status_code, payload
+
+    return _flight.do((kind, key), load)
+
+
+async def fetch_async(kind, access_token, loader):
+    """
+    Versión asíncrona de fetch(): `loader` es una corrutina que devuelve
+    (status_code, payload). Las peticiones concurrentes del mismo bucle con
+    el mismo token esperan a la misma tarea.
+    """
+    cache = _caches[kind]
+    key = token_key(access_token)
+    cached = cache.get(key)
+    if cached is not None:
+        return 200, cached
+
+    flight_key = (kind, key)
+    task = _async_flights.get(flight_key)
+    if task is not None and task.get_loop() is asyncio.get_running_loop():
+        _flight.shared += 1
+        # shield: si se cancela quien espera, la carga sigue para los demás
+        return await asyncio.shield(task)
+
+    async def load():
+        try:
+            status_code, payload = await loader()
+            if status_code == 200:
+                cache.set(key, payload)
+                _remember_uid(key, payload)
+            return status_code, payload
+        finally:
+            if _async_flights.get(flight_key) is task:
+                del _async_flights[flight_key]
+
+    task = _async_flights[flight_key] = asyncio.ensure_future(load())
+    return await asyncio.shield(task)
+
+
+def invalidate_token(access_token):
+    """
+    Olvida todo lo guardado para un token.
+    """
+    key = token_key(access_token)
+    for cache in _caches.values():
+        cache.pop(key)
+
+
+def invalidate_user(uid):
+    """
+    Olvida los datos de todos los tokens conocidos de un usuario
+    (p.ej. tras completar un pago, porque el balance cambió).
+    """
+    if not uid:
+        return
+    with _uid_lock:
+        keys = _uid_tokens.pop(uid, set())
+    for key in keys:
+        for cache in _caches.values():
+            cache.pop(key)
+    if keys:
+        logger.debug('Caché invalidada para el usuario %s (%s tokens)', uid, len(keys))
+
+
+def stats():
+    stats = {kind: cache.stats() for kind, cache in _caches.items()}
+    stats['single_flight_shared'] = _flight.shared
+    return stats
@@ -0,0 +1,168 @@
+import os
+import time
+import threading
+import logging
+from flask import jsonify
+from backend import metrics
+
+"""
+Fase de arranque de cada worker y sondas de salud.
+
+create_app() solo hace trabajo barato (sin hilos ni conexiones) para que
+gunicorn --preload pueda cargar la app una vez en el proceso maestro. Lo
+caro se hace aquí, en un hilo de cada worker nada más arrancar:
+
+  leaderboard  índice de ranking en memoria (leaderboard_index)
+  txids        filtro de Bloom de transacciones ya usadas
+  payments     hilos de trabajos de pago y del reconciliador
+  pi_api       conexiones keep-alive abiertas con la API de Pi y Horizon
+
+/healthz responde 200 mientras el proceso atienda peticiones (liveness).
+/readyz responde 503 hasta que termina el arranque y 200 después
+(readiness), con lo que tardó cada paso. Un fallo al precalentar la API de
+Pi no impide estar listo (los circuit breakers ya cubren una caída); un
+fallo cargando datos locales sí.
+
+Con preload, load_data() puede llamarse en el maestro (gunicorn.conf.py):
+los workers heredan los datos ya cargados y solo sincronizan lo nuevo.
+"""
+
+logger = logging.getLogger(__name__)
+
+# Conexiones keep-alive que se abren por host de la API al arrancar
+PREWARM_CONNECTIONS = int(os.getenv('WARMUP_PI_CONNECTIONS', '4'))
+# WARMUP_PREWARM=0 desactiva el precalentamiento de conexiones (p.ej. sin red en desarrollo)
+PREWARM = os.getenv('WARMUP_PREWARM', '1') not in ('0', 'false', 'False')
+
+# Pasos que deben salir bien para estar listo
+REQUIRED_STEPS = ('leaderboard', 'txids')
+
+_lock = threading.Lock()
+_started_pid = None
+_boot_at = None
+_boot_pid = None
+_state = {}
+
+
+def mark_boot():
+    """
+    Marca el inicio del worker (hook post_fork de gunicorn) para medir el tiempo hasta estar listo.
+    """
+    global _boot_at, _boot_pid
+    _boot_at = time.time()
+    _boot_pid = os.getpid()
+
+
+def _load_leaderboard():
+    from backend.leaderboard_index import leaderboard_index
+    leaderboard_index.sync()
+    return {'entries': leaderboard_index.total()}
+
+
+def _load_txids():
+    from backend.txid_index import txid_index
+    txid_index.load()
+
+
+def _prewarm_pi():
+    from backend import pi_client
+    from backend.routes.payments import PI_HORIZON_URL
+    if not PREWARM:
+        return {'skipped': True}
+    opened = pi_client.prewarm([pi_client.PI_API_BASE_URL, PI_HORIZON_URL], PREWARM_CONNECTIONS)
+    if not all(opened.values()):
+        raise RuntimeError(f'Conexiones abiertas: {opened}')
+    return {'connections': opened}
+
+
+def _start_payments():
+    from backend.routes.payments import start_background
+    start_background()
+
+
+DATA_STEPS = (('leaderboard', _load_leaderboard), ('txids', _load_txids))
+STEPS = DATA_STEPS + (('payments', _start_payments), ('pi_api', _prewarm_pi))
+
+
+def _run_steps(steps, checks):
+    for name, step in steps:
+        started = time.perf_counter()
+        try:
+            detail = step()
+            checks[name] = {'ok': True, 'seconds': round(time.perf_counter() - started, 4), **(detail or {})}
+        except Exception as e:
+            logger.exception('Falló el paso de arranque %s', name)
+            checks[name] = {'ok': False, 'seconds': round(time.perf_counter() - started, 4), 'error': str(e)}
+
+
+def load_data():
+    """
+    Carga los datos locales sin abrir conexiones ni hilos (apta para el maestro con preload).
+    """
+    checks = {}
+    _run_steps(DATA_STEPS, checks)
+    return checks
+
+
+def _warmup(state):
+    _run_steps(STEPS, state['checks'])
+    ready = all(state['checks'][name]['ok'] for name in REQUIRED_STEPS)
+    elapsed = time.time() - state['boot_at']
+    with _lock:
+        state['status'] = 'ready' if ready else 'failed'
+        state['time_to_ready'] = round(elapsed, 4) if ready else None
+    if ready:
+        metrics.observe('worker_time_to_ready_seconds', (), elapsed)
+        logger.info('Worker %s listo en %.2fs', os.getpid(), elapsed)
+    else:
+        logger.error('El worker %s no pudo completar el arranque: %s', os.getpid(), state['checks'])
+
+
+def start():
+    """
+    Lanza la fase de arranque en este proceso (una vez, también tras un fork).
+    """
+    global _started_pid, _state
+    if _started_pid == os.getpid():
+        return
+    with _lock:
+        if _started_pid == os.getpid():
+            return
+        boot_at = _boot_at if _boot_pid == os.getpid() else time.time()
+        _state = {'status': 'starting', 'boot_at': boot_at, 'time_to_ready': None, 'checks': {}}
+        threading.Thread(target=_warmup, args=(_state,), name='warmup', daemon=True).start()
+        _started_pid = os.getpid()
+
+
+def healthz():
+    return jsonify({'status': 'ok', 'pid': os.getpid()}), 200
+
+
+def readyz():
+    start()
+    with _lock:
+        state = dict(_state)
+        checks = dict(state['checks'])
+    body = {
+        'status': state['status'],
+        'pid': os.getpid(),
+        'timeToReady': state['time_to_ready'],
+        'uptime': round(time.time() - state['boot_at'], 4),
+        'checks': checks,
+    }
+    if state['status'] != 'ready':
+        response = jsonify(body)
+        response.status_code = 503
+        response.headers['Retry-After'] = '1'
+        return response
+    return jsonify(body), 200
+
+
+def init_app(app):
+    """
+    Añade /healthz y /readyz, y arranca el calentamiento con la primera
+    petición si el servidor no lo hizo antes (python app.py, uvicorn).
+    """
+    app.before_request(start)
+    app.add_url_rule('/healthz', 'healthz', healthz, methods=['GET'])
+    app.add_url_rule('/readyz', 'readyz', readyz, methods=['GET'])
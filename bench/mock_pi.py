@@ -0,0 +1,179 @@
+import json
+import time
+import socket
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+"""
+Sustituto local de la API de Pi Network (api.minepi.com/v2) y de Horizon
+para pruebas de carga, sin tocar los servicios reales.
+
+Responde a:
+  GET  /v2/me                                   usuario del token
+  GET  /v2/wallet                               balance
+  GET  /v2/payments/incomplete_server_payments  lista vacía
+  GET  /v2/payments/<id>                        pago aprobado sin completar
+  POST /v2/payments/<id>/approve|complete|cancel
+  GET  /transactions/<txid>/payments            pago nativo de 0.01 Pi a APP_WALLET (Horizon)
+
+Opciones de comportamiento (MockConfig):
+  latency_ms / jitter_ms  retardo de cada respuesta
+  error_rate              fracción de respuestas 500
+  reject_bearer           los endpoints de pagos responden 401 a
+                          "Authorization: Bearer <API key>" (solo aceptan "Key")
+"""
+
+
+# Wallet de la app que reciben los pagos de Horizon (PI_APP_WALLET_ADDRESS)
+APP_WALLET = 'GMOCKAPPWALLET'
+
+
+class MockConfig:
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, reject_bearer=False, stake='0.0100000'):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.reject_bearer = reject_bearer
+        self.stake = stake
+
+
+class MockPiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    config = MockConfig()
+    stats = {'requests': 0, 'errors_injected': 0, 'bearer_rejected': 0}
+    stats_lock = threading.Lock()
+
+    def setup(self):
+        super().setup()
+        # Cabeceras y cuerpo van en escrituras separadas: sin esto Nagle añade ~40 ms
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _delay_and_fail(self):
+        """
+        Aplica la latencia configurada; devuelve True si se inyectó un error.
+        """
+        config = self.config
+        with self.stats_lock:
+            self.stats['requests'] += 1
+        delay = config.latency_ms + random.uniform(-config.jitter_ms, config.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000)
+        if config.error_rate and random.random() < config.error_rate:
+            with self.stats_lock:
+                self.stats['errors_injected'] += 1
+            self._send(500, {'error': 'mock_error'})
+            return True
+        return False
+
+    def do_HEAD(self):
+        # Solo lo usa el precalentamiento de conexiones de backend/warmup.py
+        self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        if self._delay_and_fail():
+            return
+        path = urlsplit(self.path).path.rstrip('/')
+        token = self.headers.get('Authorization', '').split(' ', 1)[-1]
+
+        if path.startswith('/transactions/') and path.endswith('/payments'):
+            self._send(200, {'_embedded': {'records': [{
+                'type': 'payment',
+                'asset_type': 'native',
+                'amount': self.config.stake,
+                'to': APP_WALLET,
+                'transaction_successful': True,
+            }]}})
+        elif path.endswith('/v2/me'):
+            self._send(200, {'uid': f'uid-{token}', 'username': f'user-{token[:8]}'})
+        elif path.endswith('/v2/wallet'):
+            self._send(200, {'balance': 3.14, 'address': f'G{token[:20].upper()}'})
+        elif path.endswith('/v2/payments/incomplete_server_payments'):
+            self._send(200, {'incomplete_server_payments': []})
+        elif path.startswith('/v2/payments/'):
+            self._send(200, self._payment(path.rsplit('/', 1)[-1], 'approve'))
+        else:
+            self._send(404, {'error': 'not_found'})
+
+    def _payment(self, payment_id, action, txid=None):
+        return {
+            'identifier': payment_id,
+            'user_uid': f'uid-{payment_id}',
+            'amount': 0.01,
+            'status': {
+                'developer_approved': True,
+                'transaction_verified': action == 'complete',
+                'developer_completed': action == 'complete',
+                'cancelled': action == 'cancel',
+            },
+            'transaction': {'txid': txid} if action == 'complete' else None,
+        }
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'{}')
+        if self._delay_and_fail():
+            return
+        parts = urlsplit(self.path).path.strip('/').split('/')
+        # v2 / payments / <id> / <acción>
+        if len(parts) != 4 or parts[1] != 'payments' or parts[3] not in ('approve', 'complete', 'cancel'):
+            return self._send(404, {'error': 'not_found'})
+
+        if self.config.reject_bearer and self.headers.get('Authorization', '').startswith('Bearer '):
+            with self.stats_lock:
+                self.stats['bearer_rejected'] += 1
+            return self._send(401, {'error': 'invalid_api_key'})
+
+        payment_id, action = parts[2], parts[3]
+        self._send(200, self._payment(payment_id, action, body.get('txid')))
+
+
+def start(port=0, config=None):
+    """
+    Arranca el mock en un hilo. Devuelve el servidor (server.server_port es el puerto real).
+    """
+    handler = type('ConfiguredMockPiHandler', (MockPiHandler,), {
+        'config': config or MockConfig(),
+        'stats': {'requests': 0, 'errors_injected': 0, 'bearer_rejected': 0},
+    })
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='mock-pi', daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='API de Pi Network simulada para pruebas de carga')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--reject-bearer', action='store_true')
+    args = parser.parse_args(argv)
+
+    server = start(args.port, MockConfig(args.latency_ms, args.jitter_ms, args.error_rate, args.reject_bearer))
+    print(f'Mock de Pi escuchando en http://127.0.0.1:{server.server_port}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+import os
+import sys
+import math
+import json
+import time
+import uuid
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from datetime import datetime, timezone
+from pathlib import Path
+import requests
+from bench import mock_pi
+
+"""
+Pruebas de carga del backend contra la API de Pi simulada (bench/mock_pi.py).
+
+Arranca el mock y la app con gunicorn (con DATA_DIR temporal), lanza cada
+escenario con `--concurrency` clientes durante `--duration` segundos y
+muestra peticiones por segundo y latencias p50/p95/p99. El resultado se
+guarda en JSON para compararlo con una línea base de otro commit:
+
+  python -m bench.run --output bench/results/base.json
+  python -m bench.run --compare bench/results/base.json
+
+Escenarios: me, wallet, approve, complete, play
+"""
+
+ROOT = Path(__file__).resolve().parent.parent
+RESULTS_DIR = ROOT / 'bench' / 'results'
+API_KEY = 'bench-api-key'
+
+
+# -----------------------------
+# Escenarios: (método, ruta, cuerpo JSON) para la petición número i
+# -----------------------------
+def _token(i, args):
+    return f'bench-token-{i % args.tokens}'
+
+
+def scenario_me(i, args):
+    return 'POST', '/api/me', {'accessToken': _token(i, args)}
+
+
+def scenario_wallet(i, args):
+    return 'POST', '/api/wallet', {'accessToken': _token(i, args)}
+
+
+def scenario_approve(i, args):
+    return 'POST', '/api/payments/approve', {'paymentId': f'bench{uuid.uuid4().hex}'}
+
+
+def scenario_complete(i, args):
+    return 'POST', '/api/payments/complete', {
+        'paymentId': f'bench{uuid.uuid4().hex}',
+        'txid': uuid.uuid4().hex,
+        'accessToken': _token(i, args),
+    }
+
+
+def scenario_play(i, args):
+    # Cada partida necesita un txid nuevo: los usados se rechazan con 409
+    return 'POST', '/api/game/dribble/play', {
+        'txid': uuid.uuid4().hex,
+        'score': random.randint(0, 10000),
+        'user_address': f'GBENCH{i % args.players:08d}',
+    }
+
+
+SCENARIOS = {
+    'me': scenario_me,
+    'wallet': scenario_wallet,
+    'approve': scenario_approve,
+    'complete': scenario_complete,
+    'play': scenario_play,
+}
+
+
+# -----------------------------
+# Servidor bajo prueba
+# -----------------------------
+def start_server(args, mock_port):
+    """
+    Arranca gunicorn con la app apuntando al mock. Devuelve (proceso, DATA_DIR).
+    """
+    data_dir = tempfile.mkdtemp(prefix='pi-bench-')
+    env = dict(
+        os.environ,
+        PI_API_KEY=API_KEY,
+        PI_API_BASE_URL=f'http://127.0.0.1:{mock_port}/v2',
+        PI_HORIZON_URL=f'http://127.0.0.1:{mock_port}',
+        PI_APP_WALLET_ADDRESS=mock_pi.APP_WALLET,
+        DATA_DIR=data_dir,
+        LOG_LEVEL=os.getenv('LOG_LEVEL', 'WARNING'),
+        # Toda la carga sale de una sola IP: sin límite de ritmo salvo que se pida
+        ADMISSION_ENABLED=os.getenv('ADMISSION_ENABLED', '0'),
+    )
+    command = [
+        sys.executable, '-m', 'gunicorn', 'app:app',
+        '--bind', f'127.0.0.1:{args.port}',
+        '--workers', str(args.workers),
+        '--worker-class', 'gthread',
+        '--threads', str(args.threads),
+        '--log-level', 'warning',
+    ]
+    process = subprocess.Popen(command, cwd=ROOT, env=env)
+    base_url = f'http://127.0.0.1:{args.port}'
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'gunicorn terminó al arrancar (código {process.returncode})')
+        try:
+            if requests.get(f'{base_url}/readyz', timeout=1).status_code == 200:
+                return process, data_dir
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('gunicorn no respondió en 30 segundos')
+
+
+def stop_server(process, data_dir):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+    shutil.rmtree(data_dir, ignore_errors=True)
+
+
+# -----------------------------
+# Generador de carga
+# -----------------------------
+def percentile(sorted_values, pct):
+    """
+    Percentil por rango más cercano sobre una lista ya ordenada.
+    """
+    if not sorted_values:
+        return None
+    index = max(0, math.ceil(pct / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3) if seconds is not None else None
+
+
+def run_scenario(name, base_url, args):
+    """
+    Lanza el escenario con `args.concurrency` hilos cliente. Devuelve el resumen.
+    """
+    build = SCENARIOS[name]
+    counter = iter(range(sys.maxsize))
+    counter_lock = threading.Lock()
+    latencies = []
+    statuses = {}
+    results_lock = threading.Lock()
+    start_at = time.monotonic() + args.warmup
+    stop_at = start_at + args.duration
+
+    def client():
+        session = requests.Session()
+        local_latencies = []
+        local_statuses = {}
+        while True:
+            now = time.monotonic()
+            if now >= stop_at:
+                break
+            with counter_lock:
+                i = next(counter)
+            method, path, body = build(i, args)
+            started = time.perf_counter()
+            try:
+                status = session.request(method, base_url + path, json=body, timeout=args.timeout).status_code
+            except requests.exceptions.RequestException as e:
+                status = type(e).__name__
+            elapsed = time.perf_counter() - started
+            # Lo que termina durante el calentamiento no cuenta
+            if now >= start_at:
+                local_latencies.append(elapsed)
+                local_statuses[status] = local_statuses.get(status, 0) + 1
+        with results_lock:
+            latencies.extend(local_latencies)
+            for status, count in local_statuses.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+    total = len(latencies)
+    ok = sum(count for status, count in statuses.items() if isinstance(status, int) and status < 400)
+    return {
+        'requests': total,
+        'rps': round(total / args.duration, 1),
+        'ok': ok,
+        'errors': total - ok,
+        'statuses': {str(status): count for status, count in sorted(statuses.items(), key=str)},
+        'mean_ms': _ms(sum(latencies) / total) if total else None,
+        'p50_ms': _ms(percentile(latencies, 50)),
+        'p95_ms': _ms(percentile(latencies, 95)),
+        'p99_ms': _ms(percentile(latencies, 99)),
+        'max_ms': _ms(latencies[-1]) if latencies else None,
+    }
+
+
+# -----------------------------
+# Informe y comparación
+# -----------------------------
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(results):
+    print(f"{'escenario':<10} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errores':>8}")
+    for name, result in results.items():
+        print(
+            f"{name:<10} {result['rps']:>9} {result['p50_ms'] or '-':>9} {result['p95_ms'] or '-':>9} "
+            f"{result['p99_ms'] or '-':>9} {result['errors']:>8}"
+        )
+
+
+def compare(results, config, baseline, threshold):
+    """
+    Compara con una línea base. Devuelve la lista de regresiones mayores que
+    `threshold` % (menos req/s, o más p95/p99).
+    """
+    regressions = []
+    print(f"\nComparación con {baseline['meta'].get('commit')} ({baseline['meta'].get('date')}):")
+    changed = {
+        key: (value, config.get(key)) for key, value in baseline['meta'].get('config', {}).items()
+        if config.get(key) != value
+    }
+    if changed:
+        print(f'  Aviso: configuración distinta a la línea base: {changed}')
+    for name, result in results.items():
+        base = baseline['results'].get(name)
+        if not base:
+            continue
+        deltas = []
+        for key, higher_is_worse in (('rps', False), ('p95_ms', True), ('p99_ms', True)):
+            old, new = base.get(key), result.get(key)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * 100
+            deltas.append(f'{key} {old} -> {new} ({change:+.1f}%)')
+            if (change > threshold) if higher_is_worse else (change < -threshold):
+                regressions.append(f'{name} {key} {change:+.1f}%')
+        print(f"  {name:<10} " + ', '.join(deltas))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pruebas de carga con la API de Pi simulada')
+    parser.add_argument('scenarios', nargs='*', default=list(SCENARIOS), help=f"De: {', '.join(SCENARIOS)}")
+    parser.add_argument('--concurrency', type=int, default=16, help='Clientes simultáneos')
+    parser.add_argument('--duration', type=float, default=10.0, help='Segundos medidos por escenario')
+    parser.add_argument('--warmup', type=float, default=1.0, help='Segundos de calentamiento sin medir')
+    parser.add_argument('--timeout', type=float, default=30.0, help='Timeout de cada petición')
+    parser.add_argument('--tokens', type=int, default=100, help='Tokens de usuario distintos')
+    parser.add_argument('--players', type=int, default=1000, help='Direcciones distintas en play')
+    parser.add_argument('--target', help='URL de un servidor ya arrancado (no se lanza gunicorn)')
+    parser.add_argument('--port', type=int, default=8099, help='Puerto de gunicorn')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--mock-port', type=int, default=0, help='Puerto del mock (0: libre)')
+    parser.add_argument('--latency-ms', type=float, default=50.0, help='Latencia del mock')
+    parser.add_argument('--jitter-ms', type=float, default=10.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fracción de 500 del mock')
+    parser.add_argument('--reject-bearer', action='store_true', help="El mock solo acepta 'Key' en pagos")
+    parser.add_argument('--output', help='Fichero JSON de resultados (por defecto bench/results/<fecha>-<commit>.json)')
+    parser.add_argument('--compare', help='Línea base JSON con la que comparar')
+    parser.add_argument('--threshold', type=float, default=10.0, help='% de empeoramiento tolerado')
+    args = parser.parse_args(argv)
+
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"Escenarios desconocidos: {', '.join(unknown)}")
+
+    mock = mock_pi.start(args.mock_port, mock_pi.MockConfig(
+        args.latency_ms, args.jitter_ms, args.error_rate, args.reject_bearer
+    ))
+    process = data_dir = None
+    if args.target:
+        base_url = args.target.rstrip('/')
+    else:
+        process, data_dir = start_server(args, mock.server_port)
+        base_url = f'http://127.0.0.1:{args.port}'
+
+    results = {}
+    try:
+        for name in args.scenarios:
+            print(f'Ejecutando {name} ({args.concurrency} clientes, {args.duration}s)...', flush=True)
+            results[name] = run_scenario(name, base_url, args)
+    finally:
+        if process is not None:
+            stop_server(process, data_dir)
+        mock.shutdown()
+
+    print()
+    print_table(results)
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'config': {
+                key: getattr(args, key) for key in (
+                    'concurrency', 'duration', 'warmup', 'tokens', 'players', 'workers', 'threads',
+                    'latency_ms', 'jitter_ms', 'error_rate', 'reject_bearer', 'target'
+                )
+            },
+            'mock': dict(mock.RequestHandlerClass.stats),
+        },
+        'results': results,
+    }
+    output = Path(args.output) if args.output else RESULTS_DIR / (
+        f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{report['meta']['commit'] or 'nogit'}.json"
+    )
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2, ensure_ascii=False))
+    print(f'\nResultados guardados en {output}')
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        regressions = compare(results, report['meta']['config'], baseline, args.threshold)
+        if regressions:
+            print(f"\nRegresiones (> {args.threshold}%): {'; '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
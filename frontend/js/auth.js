@@ -11,6 +11,7 @@ const PiAuth = {
         connectBtn: null,
         loadingIndicator: null,
         redirectUrl: 'dashboard.html',
+        baseUrl: '',
         onSuccess: null,
         onError: null,
         debug: false
@@ -146,8 +147,6 @@ const PiAuth = {
             
             this.log('Verificando sesión existente');
             
-            // En una aplicación real, aquí verificaríamos la validez del token en el backend
-            
             // Re-autenticar para mantener la sesión activa
             try {
                 // Asegurarse de que el SDK está inicializado antes de usarlo
@@ -181,6 +180,18 @@ const PiAuth = {
                     }
                     
                     // Actualizar UI si elementos están disponibles
+                    // Verificar el token y cargar wallet, pagos pendientes y ranking en una sola petición
+                    const session = await this.loadSession(userData.accessToken);
+                    if (session && session.valid === false) {
+                        this.warn('El backend rechazó el token de la sesión');
+                        return null;
+                    }
+                    if (session && session.wallet) {
+                        userData.balance = session.wallet.balance;
+                        localStorage.setItem('piUserData', JSON.stringify(userData));
+                    }
+                    this.session = session;
+                    
                     if (window.usernameDisplay && userData.username) {
                         window.usernameDisplay.textContent = userData.username;
                     }
@@ -209,6 +220,33 @@ const PiAuth = {
         }
     },
     
+    /**
+     * Pide al backend la sesión completa (/api/session): usuario, wallet,
+     * pagos pendientes y ranking, consultados a la vez en el servidor
+     * @param {string} accessToken - Token de acceso de Pi
+     * @returns {Object|null} Sesión ({ valid: false } si el token no es válido) o null si falló la petición
+     */
+    loadSession: async function(accessToken) {
+        try {
+            const response = await fetch(this.config.baseUrl + '/api/session', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ accessToken: accessToken, include: ['payments', 'rank'] })
+            });
+            if (response.status === 401) {
+                return { valid: false };
+            }
+            if (!response.ok) {
+                this.warn('No se pudo cargar la sesión:', response.status);
+                return null;
+            }
+            return await response.json();
+        } catch (error) {
+            this.warn('Error al cargar la sesión:', error);
+            return null;
+        }
+    },
+    
     /**
      * Cierra la sesión actual
      */
@@ -0,0 +1,45 @@
+import os
+
+"""
+Configuración de gunicorn (se carga sola al ejecutar `gunicorn app:app`
+desde la raíz del proyecto).
+
+Con preload_app la app se crea una vez en el maestro (estáticos indexados y
+comprimidos, leaderboard cargado) y los workers la heredan al hacer fork, de
+modo que un worker nuevo arranca en milisegundos. Cada worker abre después
+sus propias conexiones con la API de Pi (backend/warmup.py) y /readyz
+responde 200 cuando ha terminado.
+
+Variables de entorno:
+  PORT              puerto (por defecto 8000)
+  WEB_CONCURRENCY   workers (por defecto 2)
+  GUNICORN_THREADS  hilos por worker (por defecto 8)
+  GUNICORN_PRELOAD  0 para cargar la app en cada worker en lugar de en el maestro
+"""
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+preload_app = os.getenv('GUNICORN_PRELOAD', '1') not in ('0', 'false', 'False')
+# Las conexiones SSE (/api/game/dribble/stream) no deben retrasar un reinicio
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '10'))
+
+
+def when_ready(server):
+    if preload_app:
+        # Datos locales cargados en el maestro: los workers los heredan ya listos
+        from backend import warmup
+        checks = warmup.load_data()
+        server.log.info('Datos precargados en el maestro: %s', checks)
+
+
+def post_fork(server, worker):
+    from backend import warmup
+    warmup.mark_boot()
+
+
+def post_worker_init(worker):
+    # Conexiones con la API de Pi, hilos de pagos y comprobación del leaderboard
+    from backend import warmup
+    warmup.start()